@@ -3,18 +3,16 @@
 # =============================================================================
 # System imports
 import argparse
-import datetime
 import json
 import logging
 import logging.config
 import os
-import queue
+import threading
 import yaml
-from time import sleep
 
 # =============================================================================
 # Local imports
-from chronosoft8puppeteer import Parameters,Remote
+from chronosoft8puppeteer import Chronosoft8Simulator,Clock,Command,ConfigWatcher,Dispatcher,EventBus,GPIOWorker,Parameters,RecordingBackend,Remote,RemotePool
 
 # =============================================================================
 # Logger setup
@@ -34,6 +32,13 @@ class Chronosoft8Puppeteer:
     CMD_INT  = 'int'
     CMD_SHUTDOWN = 'shutdown'
 
+    # Name of the remote configured by the gpio entry of the main config
+    DEFAULT_REMOTE = 'main'
+
+    # GPIO workers by remote name, they are kept across restarts so remotes
+    # stay powered and their state can be restored
+    workers = dict()
+
     def __init__(self):
         # Initialize restart request
         self._restart = False
@@ -48,32 +53,25 @@ class Chronosoft8Puppeteer:
             raise
 
         # Load shutters config
-        shutters_config_file = os.path.join( config_path
-                                           , 'shutters.json')
-        try:
-            shutters_config = json.load(open(shutters_config_file))
-            self._shutters = shutters_config['shutters']
-        except:
-            logger.error('Failed to load config file %s',shutters_config_file)
-            raise
+        self._shutters = self._load_shutters()
 
         # Load groups config
-        groups_config_file = os.path.join( config_path
-                                         , 'groups.json')
-        try:
-            groups_config = json.load(open(groups_config_file))
-            self._groups = groups_config['groups']
-        except:
-            logger.error('Failed to load config file %s',groups_config_file)
-            raise
+        self._groups = self._load_groups()
 
         # Debug
         self._debug = False
         if 'debug' in self._config:
             self._debug = self._config['debug']
 
-        # Initialize remote object
-        self._remote = Remote(self._config,self._shutters)
+        # Clock and GPIO backend, simulated backends allow running without
+        # the remote
+        self._clock = Clock()
+        self._events = EventBus(self._clock)
+
+        # Remotes are given by the remotes entry of the main config, or by its
+        # gpio entry for a single remote
+        self._remote_configs = self._get_remote_configs()
+        shutters_by_remote = self._split_shutters(self._shutters)
 
         # Read plugin list from config file
         try:
@@ -82,52 +80,327 @@ class Chronosoft8Puppeteer:
             logger.error('Missing active plugins in configuration file %s',config_file)
             raise
 
-        # Load plugins
+        # Load plugins, their state is tracked as they start along with the
+        # remotes boot
         self._plugins = dict()
+        self._plugin_states = dict()
         for plugin_name in plugin_names:
             cmd = 'from plugins import {} as plugin_handle'.format(plugin_name)
             _locals = locals()
             exec(cmd,globals(),_locals)
             self._plugins[plugin_name] = _locals['plugin_handle']
-
-        # Initialize command queue
-        self._cmd_queue = queue.PriorityQueue()
+            self._plugin_states[plugin_name] = { 'state': 'loaded' }
+
+        # Initialize remotes, each one with its own command dispatcher
+        self._remotes = RemotePool()
+        for remote_config in self._remote_configs:
+            name = remote_config['name']
+            remote = self._make_remote(remote_config,shutters_by_remote[name])
+            dispatcher = Dispatcher(remote,self._get_next_command_date,self._clock,self._events,self._is_active)
+            self._remotes.add(name,remote,dispatcher,shutters_by_remote[name])
+
+        # Workers of remotes which are gone or no longer use one are stopped
+        worker_names = [ remote_config['name'] for remote_config in self._remote_configs if 'worker' in remote_config['gpio'] ]
+        for name in list(Chronosoft8Puppeteer.workers):
+            if name not in worker_names:
+                Chronosoft8Puppeteer.workers.pop(name).stop()
+
+        # Config files are reloaded when they change unless disabled
+        self._watcher = None
+        if self._config.get('watch_config',True):
+            self._watcher = ConfigWatcher()
+
+        # Keep awake configuration
+        if 'keep_awake' in self._config:
+            self.set_config( { 'remote_keep_awake_' + parameter : value
+                               for (parameter,value) in self._config['keep_awake'].items() } )
+
+    def _get_remote_configs(self):
+        if 'remotes' not in self._config:
+            return [ { 'name'         : self.DEFAULT_REMOTE
+                     , 'gpio'         : self._config['gpio']
+                     , 'remote_state' : self._config.get('remote_state') } ]
+
+        remote_configs = list()
+        pins = set()
+        for remote_config in self._config['remotes']:
+            remote_config = dict(remote_config)
+            if remote_config['name'] in [ other['name'] for other in remote_configs ]:
+                raise ValueError('Duplicate remote {}'.format(remote_config['name']))
+
+            # Remotes are powered and driven on their own
+            remote_pins = set( int(pin) for pin in remote_config['gpio']['pins'].values() )
+            if len(pins & remote_pins):
+                raise ValueError('Remote {} shares GPIO pins {} with another remote'.format(remote_config['name'],sorted(pins & remote_pins)))
+            pins = pins | remote_pins
+
+            # Remotes state files are named after them by default
+            if 'remote_state' not in remote_config and 'remote_state' in self._config:
+                remote_state = dict(self._config['remote_state'])
+                (base,extension) = os.path.splitext(remote_state['file'])
+                remote_state['file'] = '{}-{}{}'.format(base,remote_config['name'],extension)
+                remote_config['remote_state'] = remote_state
+            remote_configs.append(remote_config)
+        if len(remote_configs) == 0:
+            raise ValueError('No remote configured')
+        return remote_configs
+
+    def _split_shutters(self,shutters):
+        # Returns shutters by remote, shutters are on the first remote unless
+        # they give theirs
+        names = [ remote_config['name'] for remote_config in self._remote_configs ]
+        shutters_by_remote = { name: list() for name in names }
+        for shutter in shutters:
+            name = shutter.get('remote',names[0])
+            if name not in shutters_by_remote:
+                raise ValueError('Unknown remote {} for shutter {}'.format(name,shutter['name']))
+            shutters_by_remote[name].append(shutter)
+        shutter_names = [ shutter['name'] for shutter in shutters ]
+        if len(set(shutter_names)) != len(shutter_names):
+            raise ValueError('Duplicate shutter names')
+        for remote_shutters in shutters_by_remote.values():
+            Remote.parse_shutters(remote_shutters)
+        return shutters_by_remote
+
+    def _make_remote(self,remote_config,shutters):
+        # GPIO backend, simulated backends allow running without the remote.
+        # A GPIO worker process drives the backend and times presses when
+        # configured
+        backend = None
+        timer = None
+        backend_name = remote_config['gpio'].get('backend','rpi')
+        if 'worker' in remote_config['gpio']:
+            backend = timer = self._get_worker(remote_config['name'],backend_name,remote_config['gpio']['worker'])
+        elif backend_name == 'recording':
+            backend = RecordingBackend(self._clock)
+        elif backend_name == 'simulator':
+            backend = Chronosoft8Simulator(self._clock)
+        elif backend_name != 'rpi':
+            raise ValueError('Unknown GPIO backend {}'.format(backend_name))
+
+        # Remote state configuration
+        state_file = None
+        state_validation = Remote.STATE_VALIDATION_PROCESS
+        if remote_config.get('remote_state'):
+            state_file = os.path.join( config_path, remote_config['remote_state']['file'] )
+            if 'validation' in remote_config['remote_state']:
+                state_validation = remote_config['remote_state']['validation']
+
+        config = { 'gpio'  : remote_config['gpio']
+                 , 'debug' : self._debug }
+        return Remote( config, shutters, state_file, state_validation
+                     , clock=self._clock, backend=backend, events=self._events, name=remote_config['name'], timer=timer )
+
+    def _get_worker(self,name,backend_name,worker_config):
+        # Worker of a previous run is reused unless its options changed
+        options = { 'backend'           : backend_name
+                  , 'cpus'              : worker_config.get('cpus')
+                  , 'priority'          : worker_config.get('priority')
+                  , 'heartbeat_period'  : float(worker_config.get('heartbeat_period',0.5))
+                  , 'heartbeat_timeout' : float(worker_config.get('heartbeat_timeout',5.0)) }
+        worker = Chronosoft8Puppeteer.workers.get(name)
+        if worker is not None and worker.get_options() != options:
+            Chronosoft8Puppeteer.workers.pop(name).stop()
+            worker = None
+        if worker is None:
+            logger.info('Starting GPIO worker of remote %s',name)
+            worker = GPIOWorker(**options)
+            Chronosoft8Puppeteer.workers[name] = worker
+        return worker
 
     # -------------------------------------------------------------------------
+    def get_clock(self):
+        return self._clock
+
+    def add_event_listener(self,listener):
+        self._events.add_listener(listener)
+
+    def remove_event_listener(self,listener):
+        self._events.remove_listener(listener)
+
+    def emit_event(self,event,data=None):
+        self._events.emit(event,data)
+
     def get_shutters(self):
         return self._shutters
 
     def get_groups(self):
         return self._groups
 
+    def reload_shutters(self):
+        # Apply shutters config changes without restarting, returns the
+        # reconfiguration commands or None if nothing changed. Commands for
+        # the new shutters are accepted at once, they wait for their remote
+        # to be reconfigured
+        shutters = self._load_shutters()
+        self._split_shutters(shutters)
+        if shutters == self._shutters:
+            logger.info('Shutters configuration unchanged')
+            return None
+        self._shutters = shutters
+        changes = self._remotes.reconfigure(shutters)
+        self._events.emit('shutters_changed')
+        return changes
+
+    def _load_shutters(self):
+        shutters_config_file = os.path.join( config_path
+                                           , 'shutters.json')
+        try:
+            shutters_config = json.load(open(shutters_config_file))
+            return shutters_config['shutters']
+        except:
+            logger.error('Failed to load config file %s',shutters_config_file)
+            raise
+
+    def reload_groups(self):
+        groups = self._load_groups()
+        if groups == self._groups:
+            logger.info('Groups configuration unchanged')
+            return
+        shutter_names = set( shutter['name'] for shutter in self._shutters )
+        for group in groups:
+            for shutter in group['shutters']:
+                if shutter not in shutter_names:
+                    logger.warning('Unknown shutter %s in group %s',shutter,group['name'])
+        logger.info('Groups configuration updated')
+        self._groups = groups
+        self._events.emit('groups_changed')
+
+    def _load_groups(self):
+        groups_config_file = os.path.join( config_path
+                                         , 'groups.json')
+        try:
+            groups_config = json.load(open(groups_config_file))
+            groups = groups_config['groups']
+            for group in groups:
+                if not isinstance(group['name'],str) or not isinstance(group['shutters'],list):
+                    raise ValueError('Invalid group {}'.format(group))
+            return groups
+        except:
+            logger.error('Failed to load config file %s',groups_config_file)
+            raise
+
     # -------------------------------------------------------------------------
     def drive_shutter(self,shutter,command):
-        priority = 2
+        return self._remotes.put( [ self._make_command(shutter,command), ] )[0]
 
-        # Stop commands are executed first
-        if command == self.CMD_STOP:
-            priority = 1
+    def drive_shutters(self,commands):
+        # Commands given as (shutter,command) are queued at once
+        return self._remotes.put( [ self._make_command(shutter,command) for (shutter,command) in commands ] )
 
-        self._cmd_queue.put( ( priority, datetime.datetime.now()
-                             , shutter, command ) )
+    def drive_shutter_to(self,shutter,position):
+        # Position is given in percent open
+        return self.drive_shutter(shutter,Remote.get_position_command(position))
+
+    def get_positions(self):
+        return self._remotes.get_positions()
+
+    def get_command_steps(self):
+        return self._remotes.get_command_steps()
 
     def drive_group(self,group,command):
         for group_data in self._groups:
             if group_data['name'] == group:
-                for shutter in group_data['shutters']:
-                    self.drive_shutter( shutter,command )
-                break
+                # Queue all commands at once so they are ordered together
+                return self._remotes.put( [ self._make_command(shutter,command)
+                                               for shutter in group_data['shutters'] ] )
+        return list()
+
+    def _make_command(self,shutter,command):
+        priority = Dispatcher.PRIORITY_DEFAULT
+
+        # Stop commands are executed first
+        if command == self.CMD_STOP:
+            priority = Dispatcher.PRIORITY_STOP
+
+        return Command(priority,shutter,command)
+
+    def get_plan_reports(self):
+        return self._remotes.get_plan_reports()
+
+    def get_eta(self,handle):
+        # Seconds before the order of the queued command is sent, None when
+        # unknown (e.g. while the remote is booting)
+        eta = self._remotes.get_eta(handle)
+        if eta is None:
+            return None
+        return max( 0, eta[0] - self._clock.time() )
+
+    def get_etas(self):
+        now = self._clock.time()
+        etas = list()
+        for (handle,eta) in self._remotes.get_etas().items():
+            if eta is None:
+                etas.append( { 'shutter' : handle.shutter
+                             , 'command' : handle.command
+                             , 'order'   : None
+                             , 'end'     : None } )
+                continue
+            etas.append( { 'shutter' : handle.shutter
+                         , 'command' : handle.command
+                         , 'order'   : max( 0, eta[0] - now )
+                         , 'end'     : max( 0, eta[1] - now ) } )
+        # Unknown ETAs come last
+        etas.sort( key=lambda eta: ( eta['order'] is None, eta['order'] or 0 ) )
+        return etas
+
+    def get_metrics(self):
+        return { 'remotes': self._remotes.get_metrics() }
+
+    # -------------------------------------------------------------------------
+    def notify_activity(self):
+        # Called by plugins when the date of the next expected command or
+        # their activity changes
+        self._remotes.notify()
+
+    def _get_next_command_date(self):
+        dates = list()
+        for (plugin_name,plugin) in self._plugins.items():
+            if self._plugin_states[plugin_name]['state'] != 'started':
+                continue
+            get_next_command_date = getattr(plugin,'get_next_command_date',None)
+            if get_next_command_date:
+                date = get_next_command_date()
+                if date is not None:
+                    dates.append(date)
+        if len(dates) == 0:
+            return None
+        return min(dates)
+
+    def _is_active(self):
+        # Whether a plugin may send commands at any time
+        for (plugin_name,plugin) in self._plugins.items():
+            if self._plugin_states[plugin_name]['state'] != 'started':
+                continue
+            is_active = getattr(plugin,'is_active',None)
+            if is_active and is_active():
+                return True
+        return False
 
     # -------------------------------------------------------------------------
     def get_programs(self):
         return self._plugins['scheduling'].get_programs()
 
     def set_programs(self,programs):
-        return self._plugins['scheduling'].set_programs(programs)
+        result = self._plugins['scheduling'].set_programs(programs)
+        self._events.emit('programs_changed')
+        return result
+
+    def get_scheduled_programs(self):
+        return self._plugins['scheduling'].get_scheduled_programs()
+
+    def get_upcoming_triggers(self,start,end):
+        return self._plugins['scheduling'].get_upcoming_triggers(start,end)
+
+    def get_program_history(self):
+        return self._plugins['scheduling'].get_program_history()
 
     # -------------------------------------------------------------------------
     def get_config(self):
-        return { 'remote_cmd_button_press_duration' : Parameters.remote_cmd_button_press_duration }
+        return { 'remote_cmd_button_press_duration' : Parameters.remote_cmd_button_press_duration
+               , 'remote_cmd_button_cut_press'      : Parameters.remote_cmd_button_cut_press
+               , 'remote_keep_awake_mode'           : Parameters.remote_keep_awake_mode
+               , 'remote_keep_awake_horizon'        : Parameters.remote_keep_awake_horizon }
 
     def set_config(self,config):
         for parameter in config:
@@ -135,49 +408,114 @@ class Chronosoft8Puppeteer:
                 value = float(config[parameter])
                 logger.info('Setting command button press duration to %.2f s', value)
                 Parameters.remote_cmd_button_press_duration = value
+            elif parameter == 'remote_cmd_button_cut_press':
+                value = bool(config[parameter])
+                logger.info('%s cutting command button presses for stops', 'Enabling' if value else 'Disabling')
+                Parameters.remote_cmd_button_cut_press = value
+            elif parameter == 'remote_keep_awake_mode':
+                value = config[parameter]
+                if value not in ( Dispatcher.KEEP_AWAKE_OFF, Dispatcher.KEEP_AWAKE_PREDICTIVE, Dispatcher.KEEP_AWAKE_ON ):
+                    raise ValueError('Invalid keep awake mode {}'.format(value))
+                logger.info('Setting keep awake mode to %s', value)
+                Parameters.remote_keep_awake_mode = value
+            elif parameter == 'remote_keep_awake_horizon':
+                value = float(config[parameter])
+                logger.info('Setting keep awake horizon to %.2f s', value)
+                Parameters.remote_keep_awake_horizon = value
             else:
                 logger.error('Can\'t set unknown parameter %s', parameter)
+        self._remotes.notify()
+        self._events.emit('config_changed',self.get_config())
 
     # -------------------------------------------------------------------------
-    def start(self):
-        # Initialize remote
-        logger.info('Initializing remote')
-        self._remote.start()
+    def get_status(self):
+        # Commands are accepted while starting, they are queued until their
+        # remote is ready
+        plugins_ready = all( state['state'] in ( 'started', 'failed' ) for state in self._plugin_states.values() )
+        return { 'state'   : 'ready' if self._remotes.is_ready() and plugins_ready else 'starting'
+               , 'remotes' : self._remotes.get_states()
+               , 'plugins' : { name: dict(state) for (name,state) in self._plugin_states.items() } }
+
+    def _on_event(self,event,data):
+        if event == 'remote_ready':
+            self._events.emit('status_changed',self.get_status())
 
-        # Initialize and start plugins
-        for (plugin_name,plugin) in self._plugins.items():
-            # Initialize plugin
-            plugin.init_plugin(self)
-
-            # Start plugin
-            plugin.start_plugin()
-
-        # Process command queue
-        while True:
-            cmd = self._cmd_queue.get()
-            shutter = cmd[2]
-            command = cmd[3]
+    # -------------------------------------------------------------------------
+    def start(self):
+        # Plugins are started while remotes boot
+        logger.info('Initializing remotes')
+        self._events.add_listener(self._on_event)
+        plugins_thread = threading.Thread(target=self._start_plugins,name='plugins')
+        plugins_thread.start()
 
-            if command == self.CMD_SHUTDOWN:
-                logger.info('Received shutdown command')
-                break
+        # Process command queues of all remotes once booted
+        try:
+            self._remotes.run()
+        finally:
+            plugins_thread.join()
 
-            logger.debug('Processing order for shutter %s: %s',shutter,command)
-            self._remote.drive_shutter( shutter, command )
+    def _start_plugins(self):
+        for (plugin_name,plugin) in self._plugins.items():
+            state = self._plugin_states[plugin_name]
+            try:
+                # Initialize plugin
+                state['state'] = 'initializing'
+                start_date = self._clock.monotonic()
+                plugin.init_plugin(self)
+                state['init_duration'] = self._clock.monotonic() - start_date
+
+                # Start plugin
+                state['state'] = 'starting'
+                start_date = self._clock.monotonic()
+                plugin.start_plugin()
+                state['start_duration'] = self._clock.monotonic() - start_date
+                state['state'] = 'started'
+                logger.info('Plugin %s initialized in %.3f s and started in %.3f s'
+                           ,plugin_name,state['init_duration'],state['start_duration'])
+            except:
+                logger.exception('Failed to start plugin %s',plugin_name)
+                state['state'] = 'failed'
+            self._events.emit('status_changed',self.get_status())
+
+        # Plugins may expect commands from now on
+        self._remotes.notify()
+
+        # Watch config files, plugins may give their own files along with the
+        # function reloading them
+        if self._watcher:
+            self._watcher.add(os.path.join(config_path,'shutters.json'),self.reload_shutters)
+            self._watcher.add(os.path.join(config_path,'groups.json'),self.reload_groups)
+            for (plugin_name,plugin) in self._plugins.items():
+                get_config_files = getattr(plugin,'get_config_files',None)
+                if get_config_files:
+                    for (file,reload_config) in get_config_files():
+                        self._watcher.add(file,reload_config)
+            self._watcher.start()
 
     def stop(self, restart = False):
         self._restart = restart
-        priority = 3
-        self._cmd_queue.put( ( priority, datetime.datetime.now()
-                             , '', self.CMD_SHUTDOWN ) )
+        self._remotes.shutdown()
 
     # -------------------------------------------------------------------------
     def do_stop(self):
-        # Stop all plugins
-        for (plugin_name,plugin) in self._plugins.items():
-            plugin.stop_plugin()
+        if self._watcher:
+            self._watcher.stop()
 
-        self._remote.stop()
+        # Stop plugins which were started, even partially
+        for (plugin_name,plugin) in self._plugins.items():
+            if self._plugin_states[plugin_name]['state'] == 'loaded':
+                continue
+            try:
+                plugin.stop_plugin()
+            except:
+                logger.exception('Failed to stop plugin %s',plugin_name)
+
+        # Keep remote powered on restart so its state can be restored
+        self._remotes.stop( power_off=not self._restart )
+        if not self._restart:
+            for worker in Chronosoft8Puppeteer.workers.values():
+                worker.stop()
+            Chronosoft8Puppeteer.workers.clear()
 
     def shall_restart(self):
         return self._restart
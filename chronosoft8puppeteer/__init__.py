@@ -1,3 +1,16 @@
-from .gpio       import GPIO
+from .clock      import Clock,VirtualClock
+from .events     import EventBus
+from .gpio       import GPIO,GPIOBackend,RecordingBackend,RPiGPIOBackend
 from .parameters import Parameters
+from .simulator  import Chronosoft8Simulator
+from .steps      import PressStep,WaitStep,compile_shutter,compile_steps,make_press,make_wait
+from .position   import PositionTracker
+from .timing     import Histogram,PressTimer
+from .worker     import GPIOWorker
 from .remote     import Remote
+from .command    import Command
+from .scheduler  import RemoteState,Scheduler
+from .planner    import GroupPlanner,Plan
+from .dispatcher import Dispatcher
+from .pool       import RemotePool
+from .watcher    import ConfigWatcher
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# System imports
+import argparse
+import bisect
+import datetime
+import json
+import logging
+import os
+import random
+import time
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import Chronosoft8Simulator,Command,Dispatcher,Parameters,Remote,VirtualClock
+
+# =============================================================================
+# Logger setup
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Functions
+def get_percentile(values,percent):
+    # Linear interpolation between closest ranks
+    values = sorted(values)
+    position = ( len(values) - 1 ) * percent / 100
+    index = int(position)
+    if index + 1 >= len(values):
+        return values[-1]
+    return values[index] + ( values[index+1] - values[index] ) * ( position - index )
+
+def get_statistics(values):
+    if len(values) == 0:
+        return None
+    return { 'count' : len(values)
+           , 'mean'  : sum(values) / len(values)
+           , 'p50'   : get_percentile(values,50)
+           , 'p95'   : get_percentile(values,95)
+           , 'p99'   : get_percentile(values,99)
+           , 'max'   : max(values) }
+
+# =============================================================================
+# Classes
+class Benchmark:
+    # Replays workloads against the dispatcher driving a simulated remote on
+    # a virtual clock
+    WORKLOADS = ( 'whole_house', 'ui_spam', 'sunset_storm', 'mixed_stop' )
+
+    # Virtual date at which each workload starts
+    START_DATE = 1600000000.0
+
+    # Time left to the dispatcher after the last submitted command
+    DRAIN_TIMEOUT = 600.0
+
+    def __init__(self,config,shutters,groups,seed=0):
+        self._config = dict(config)
+        self._config['debug'] = False
+        self._shutters = shutters
+        self._groups = groups
+        self._seed = seed
+
+        # Shutters which can be driven individually
+        self._shutter_names = [ shutter['name'] for shutter in shutters
+                                if int(shutter['channel']) != Dispatcher.GENERAL_CHANNEL ]
+
+    # -------------------------------------------------------------------------
+    def run(self,workloads=None):
+        results = { 'date'       : datetime.datetime.now().isoformat()
+                  , 'seed'       : self._seed
+                  , 'parameters' : { name: value for (name,value) in vars(Parameters).items()
+                                     if not name.startswith('_') }
+                  , 'workloads'  : dict() }
+
+        boot_durations = list()
+        boot_wall_times = list()
+        for name in workloads or self.WORKLOADS:
+            logger.info('Running workload %s',name)
+            rng = random.Random('{}-{}'.format(self._seed,name))
+            (events,scheduled) = getattr(self,'_get_'+name+'_events')(rng)
+            result = self._run_events(events,scheduled)
+            boot_durations.append(result.pop('boot_duration'))
+            boot_wall_times.append(result.pop('boot_wall_time'))
+            results['workloads'][name] = result
+
+        results['boot'] = { 'duration'  : get_statistics(boot_durations)
+                          , 'wall_time' : get_statistics(boot_wall_times) }
+        return results
+
+    # -------------------------------------------------------------------------
+    def _run_events(self,events,scheduled):
+        # Events are (offset,batch,commands) tuples, commands of an event are
+        # put at once
+        clock = VirtualClock(self.START_DATE)
+        simulator = Chronosoft8Simulator(clock)
+        remote = Remote(self._config,self._shutters,clock=clock,backend=simulator)
+
+        wall_start = time.perf_counter()
+        remote.start()
+        boot_wall_time = time.perf_counter() - wall_start
+        boot_duration = clock.time() - self.START_DATE
+
+        # Scheduled workloads let the dispatcher know when commands are expected
+        start_date = clock.time()
+        event_dates = sorted( start_date + offset for (offset,batch,commands) in events )
+        def get_next_command_date():
+            index = bisect.bisect_left(event_dates,clock.time())
+            return event_dates[index] if index < len(event_dates) else None
+        dispatcher = Dispatcher(remote,get_next_command_date if scheduled else None,clock)
+
+        handles = list()
+        def put(batch,commands):
+            for handle in dispatcher.put( [ self._make_command(shutter,command) for (shutter,command) in commands ] ):
+                handles.append( (batch,handle) )
+        for (offset,batch,commands) in events:
+            clock.call_later(offset,put,(batch,commands))
+
+        wall_start = time.perf_counter()
+        dispatcher.run( until=event_dates[-1] + self.DRAIN_TIMEOUT )
+        wall_time = time.perf_counter() - wall_start
+        remote.stop()
+
+        result = self._get_result(handles,simulator)
+        result.update( { 'boot_duration'  : boot_duration
+                       , 'boot_wall_time' : boot_wall_time
+                       , 'wall_time'      : wall_time
+                       , 'plans'          : len(dispatcher.get_plan_reports())
+                       , 'remote'         : dispatcher.get_metrics() } )
+        return result
+
+    def _get_result(self,handles,simulator):
+        # Orders sent on each channel, commands are matched with the first order
+        # sent on their channel once the remote started driving them
+        orders = dict()
+        for (date,channel,order) in simulator.orders:
+            orders.setdefault(channel,list()).append(date)
+
+        latencies = list()
+        stop_latencies = list()
+        statuses = dict()
+        batches = dict()
+        unfinished = 0
+        for (batch,handle) in handles:
+            statuses[handle.get_status()] = statuses.get(handle.get_status(),0) + 1
+            batches.setdefault(batch,list()).append(handle)
+            if not handle.is_done():
+                unfinished = unfinished + 1
+                continue
+
+            command = handle
+            while command is not None and command.start_date is None:
+                command = command.leader
+            if command is None:
+                continue
+            channel_orders = orders.get(command.channel,list())
+            index = bisect.bisect_left(channel_orders,command.start_date)
+            if index == len(channel_orders):
+                continue
+            latency = channel_orders[index] - handle.date
+            latencies.append(latency)
+            if handle.command == Remote.CMD_STOP:
+                stop_latencies.append(latency)
+
+        drain_times = list()
+        for batch_handles in batches.values():
+            if all( handle.is_done() for handle in batch_handles ):
+                drain_times.append( max( handle.end_date for handle in batch_handles )
+                                  - min( handle.date for handle in batch_handles ) )
+
+        return { 'commands'     : len(handles)
+               , 'statuses'     : statuses
+               , 'unfinished'   : unfinished
+               , 'latency'      : get_statistics(latencies)
+               , 'stop_latency' : get_statistics(stop_latencies)
+               , 'drain_time'   : get_statistics(drain_times)
+               , 'orders'       : len(simulator.orders)
+               , 'errors'       : [ description for (date,description) in simulator.errors ] }
+
+    def _make_command(self,shutter,command):
+        # Same priorities as commands received from plugins
+        priority = Dispatcher.PRIORITY_DEFAULT
+        if command == Remote.CMD_STOP:
+            priority = Dispatcher.PRIORITY_STOP
+        return Command(priority,shutter,command)
+
+    # -------------------------------------------------------------------------
+    def _get_whole_house_events(self,rng):
+        # Group commands on all shutters, some of them with a few shutters
+        # going the other way
+        shutters = self._get_group('Général') or self._shutter_names
+        events = list()
+        for index in range(12):
+            command = Remote.CMD_DOWN if index % 2 == 0 else Remote.CMD_UP
+            commands = [ (shutter,command) for shutter in shutters ]
+            if index % 4 == 3:
+                for position in rng.sample(range(len(commands)),2):
+                    commands[position] = (shutters[position],Remote.CMD_INT)
+            events.append( (index * 300.0, index, commands) )
+        return (events,False)
+
+    def _get_ui_spam_events(self,rng):
+        # Bursts of commands from a user tapping the UI
+        commands = ( Remote.CMD_UP, Remote.CMD_DOWN, Remote.CMD_STOP, Remote.CMD_INT )
+        events = list()
+        for burst in range(15):
+            offset = burst * 120.0
+            for index in range(rng.randint(5,15)):
+                offset = offset + rng.uniform(0.1,1.5)
+                events.append( (offset, burst, [ (rng.choice(self._shutter_names),rng.choice(commands)), ]) )
+        return (events,False)
+
+    def _get_sunset_storm_events(self,rng):
+        # Scheduled programs triggered at the same time, each shutter of a
+        # program is driven on its own as the scheduling plugin does
+        commands = ( Remote.CMD_DOWN, Remote.CMD_DOWN, Remote.CMD_INT )
+        events = list()
+        for evening in range(5):
+            offset = 60.0 + evening * 3600.0
+            for group in rng.sample(self._groups,min(4,len(self._groups))):
+                command = rng.choice(commands)
+                for shutter in group['shutters']:
+                    events.append( (offset, evening, [ (shutter,command), ]) )
+        return (events,True)
+
+    def _get_mixed_stop_events(self,rng):
+        # Moves interrupted by stop commands
+        events = list()
+        for index in range(20):
+            offset = index * 120.0
+            shutters = rng.sample(self._shutter_names,rng.randint(2,min(5,len(self._shutter_names))))
+            for shutter in shutters:
+                offset = offset + rng.uniform(0.0,2.0)
+                events.append( (offset, index, [ (shutter,rng.choice((Remote.CMD_UP,Remote.CMD_DOWN))), ]) )
+            for shutter in rng.sample(shutters,rng.randint(1,len(shutters))):
+                offset = offset + rng.uniform(0.5,10.0)
+                events.append( (offset, index, [ (shutter,Remote.CMD_STOP), ]) )
+        return (events,False)
+
+    def _get_group(self,name):
+        for group in self._groups:
+            if group['name'] == name:
+                return group['shutters']
+        return None
+
+# =============================================================================
+# Main
+if __name__ == '__main__':
+    # -------------------------------------------------------------------------
+    # Arg parse
+    config_path = os.path.join( os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+                              , 'config' )
+    parser = argparse.ArgumentParser(description='Benchmark command latencies on a simulated remote')
+    parser.add_argument('-c','--config', help='configuration directory', default=config_path)
+    parser.add_argument('-o','--output', help='JSON results file', default='benchmark.json')
+    parser.add_argument('-w','--workload', help='workload to run (all by default)', action='append', choices=Benchmark.WORKLOADS)
+    parser.add_argument('-s','--set', help='override a parameter (name=value)', action='append', default=list())
+    parser.add_argument('-l','--label', help='label stored with the results')
+    parser.add_argument('--seed', help='random seed', type=int, default=0)
+    parser.add_argument('-v','--verbose', help='enable logging', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+
+    for parameter in args.set:
+        (name,value) = parameter.split('=',1)
+        if not hasattr(Parameters,name):
+            parser.error('unknown parameter {}'.format(name))
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        setattr(Parameters,name,value)
+
+    # -------------------------------------------------------------------------
+    config   = json.load(open(os.path.join(args.config,'chronosoft8-puppeteer.json')))
+    shutters = json.load(open(os.path.join(args.config,'shutters.json')))['shutters']
+    groups   = json.load(open(os.path.join(args.config,'groups.json')))['groups']
+
+    results = Benchmark(config,shutters,groups,args.seed).run(args.workload)
+    results['label'] = args.label
+
+    for (name,result) in results['workloads'].items():
+        print('{:<14} commands={:<4} wall={:.3f}s'.format(name,result['commands'],result['wall_time']))
+        for metric in ( 'latency', 'stop_latency', 'drain_time' ):
+            if result[metric]:
+                print('    {:<13} p50={:7.2f}s p95={:7.2f}s p99={:7.2f}s'
+                      .format(metric,result[metric]['p50'],result[metric]['p95'],result[metric]['p99']))
+    print('{:<14} {:.2f}s (wall {:.3f}s)'.format('boot',results['boot']['duration']['p50'],results['boot']['wall_time']['p50']))
+
+    with open(args.output,'w') as f:
+        json.dump(results,f,indent=4)
@@ -0,0 +1,184 @@
+# =============================================================================
+# System imports
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+# =============================================================================
+# Logger setup
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Classes
+class Timer:
+    def __init__(self,date,function,args):
+        self.date = date
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        # Cancelled timers are dropped when reaching the top of the queue
+        self.cancelled = True
+
+class Clock:
+    # Wall clock, timers are kept in heaps (by wall clock or monotonic date)
+    # and run by a single thread
+    # Last moments before a deadline are spent polling, sleeps may overshoot
+    # by a scheduler tick
+    SPIN_DURATION = 0.002
+
+    def __init__(self):
+        self._timers = list()
+        self._monotonic_timers = list()
+        self._sequence = itertools.count()
+        self._timers_condition = threading.Condition()
+        self._timers_thread = None
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        # Unaffected by wall clock changes, time() - monotonic() changes when
+        # the wall clock jumps
+        return time.monotonic()
+
+    def now(self,tz=None):
+        return datetime.datetime.fromtimestamp(self.time(),tz)
+
+    def sleep(self,seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def sleep_until(self,deadline):
+        # Deadline on the monotonic clock
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if remaining > self.SPIN_DURATION:
+                time.sleep(remaining - self.SPIN_DURATION)
+            else:
+                time.sleep(0)
+
+    def wait(self,condition,timeout=None):
+        return condition.wait(timeout)
+
+    def call_later(self,delay,function,args=(),monotonic=False):
+        # Monotonic timers run once delay elapsed whatever the wall clock
+        # changes, others at their wall clock date
+        if monotonic:
+            (timers,timer) = ( self._monotonic_timers, Timer(self.monotonic() + max(0,delay),function,args) )
+        else:
+            (timers,timer) = ( self._timers, Timer(self.time() + max(0,delay),function,args) )
+        with self._timers_condition:
+            heapq.heappush( timers, ( timer.date, next(self._sequence), timer ) )
+            self._start_timers()
+            self._timers_condition.notify()
+        return timer
+
+    def get_next_timer_date(self):
+        # Wall clock date of the next timer
+        with self._timers_condition:
+            next_timers = self._get_next_timers()
+            if next_timers is None:
+                return None
+            return next_timers[0]
+
+    def get_timer_count(self):
+        with self._timers_condition:
+            return len( [ timer for (_,_,timer) in self._timers + self._monotonic_timers if not timer.cancelled ] )
+
+    # -------------------------------------------------------------------------
+    def _start_timers(self):
+        if self._timers_thread is None:
+            self._timers_thread = threading.Thread(target=self._run_timers,name='clock-timers',daemon=True)
+            self._timers_thread.start()
+
+    def _get_next_timers(self):
+        # Returns the wall clock date of the next timer and its heap, None if
+        # there's none. Monotonic dates are converted with the current offset
+        # between clocks
+        next_timers = None
+        for (timers,offset) in ( ( self._timers, 0.0 ), ( self._monotonic_timers, self.time() - self.monotonic() ) ):
+            while len(timers) and timers[0][2].cancelled:
+                heapq.heappop(timers)
+            if len(timers) and ( next_timers is None or timers[0][0] + offset < next_timers[0] ):
+                next_timers = ( timers[0][0] + offset, timers )
+        return next_timers
+
+    def _pop_timer(self,date):
+        # Returns the next timer due at date, if any
+        with self._timers_condition:
+            next_timers = self._get_next_timers()
+            if next_timers is None or next_timers[0] > date:
+                return None
+            return heapq.heappop(next_timers[1])[2]
+
+    def _run_timers(self):
+        while True:
+            with self._timers_condition:
+                timer = self._pop_timer(self.time())
+                if timer is None:
+                    timer_date = self.get_next_timer_date()
+                    self._timers_condition.wait( None if timer_date is None else timer_date - self.time() )
+                    continue
+            try:
+                timer.function(*timer.args)
+            except:
+                logger.exception('Exception in timer {}'.format(timer.function))
+
+class VirtualClock(Clock):
+    # Time only moves forward when sleeping or waiting, timers are run by the
+    # thread moving time forward
+    def __init__(self,date=0.0):
+        super().__init__()
+        self._date = date
+        self._jumps = 0.0
+
+    def time(self):
+        return self._date
+
+    def monotonic(self):
+        return self._date - self._jumps
+
+    def jump(self,seconds):
+        # Changes the wall clock as NTP would, timers keep their date
+        self._jumps = self._jumps + seconds
+        self._date = self._date + seconds
+
+    def sleep(self,seconds):
+        if seconds > 0:
+            self.advance_to(self._date + seconds)
+
+    def sleep_until(self,deadline):
+        self.sleep(deadline - self.monotonic())
+
+    def wait(self,condition,timeout=None):
+        # Returns as soon as a timer ran, as it may have notified condition
+        timer_date = self.get_next_timer_date()
+        if timeout is None and timer_date is None:
+            raise RuntimeError('Waiting forever on virtual clock')
+
+        date = self._date + timeout if timeout is not None else timer_date
+        if timer_date is not None and timer_date <= date:
+            self.advance_to(timer_date)
+            return True
+        self.advance_to(date)
+        return False
+
+    def advance_to(self,date):
+        while True:
+            timer_date = self.get_next_timer_date()
+            timer = self._pop_timer(date)
+            if timer is None:
+                break
+            self._date = max(self._date,timer_date)
+            timer.function(*timer.args)
+        self._date = max(self._date,date)
+
+    def _start_timers(self):
+        pass
@@ -0,0 +1,85 @@
+# =============================================================================
+# System imports
+import itertools
+import threading
+import time
+
+# =============================================================================
+# Classes
+class Command:
+    STATUS_PENDING    = 'pending'
+    STATUS_MERGED     = 'merged'
+    STATUS_SUPERSEDED = 'superseded'
+    STATUS_CANCELLED  = 'cancelled'
+    STATUS_EXECUTED   = 'executed'
+    STATUS_SKIPPED    = 'skipped'
+    STATUS_REJECTED   = 'rejected'
+
+    _sequence = itertools.count()
+
+    def __init__(self,priority,shutter,command,channel=None):
+        self.priority = priority
+        self.shutter  = shutter
+        self.command  = command
+        self.channel  = channel
+        self.date     = time.time()
+        self.sequence = next(Command._sequence)
+        self.plan     = None
+        self.leader   = None
+        self.steps    = None
+        self.deadline = None
+        self.data     = None
+        self.status   = self.STATUS_PENDING
+
+        # Dates at which the remote started driving and finished the command
+        self.start_date = None
+        self.end_date   = None
+
+        self._done = threading.Event()
+        self._followers = list()
+
+    def __repr__(self):
+        return 'Command({},{},{})'.format(self.priority,self.shutter,self.command)
+
+    # -------------------------------------------------------------------------
+    def get_status(self):
+        return self.status
+
+    def is_done(self):
+        return self._done.is_set()
+
+    def wait(self,timeout=None):
+        return self._done.wait(timeout)
+
+    def get_followers(self):
+        # This command and all commands completing along with it
+        followers = [ self, ]
+        for follower in self._followers:
+            followers.extend(follower.get_followers())
+        return followers
+
+    def get_start_date(self):
+        # Start date of the command which drove the remote for this one
+        command = self
+        while command is not None and command.start_date is None:
+            command = command.leader
+        return command.start_date if command else None
+
+    # -------------------------------------------------------------------------
+    def follow(self,command,status=None):
+        # This command completes along with the given command
+        if status:
+            self.status = status
+        self.leader = command
+        command._followers.append(self)
+
+    def finish(self,status,date=None):
+        # Merged commands stay merged once the command they were merged in is
+        # executed
+        if self.status == self.STATUS_PENDING or status != self.STATUS_EXECUTED:
+            self.status = status
+        self.end_date = date
+        self._done.set()
+
+        for follower in self._followers:
+            follower.finish(status,date)
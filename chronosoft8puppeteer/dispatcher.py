@@ -0,0 +1,591 @@
+# =============================================================================
+# System imports
+import logging
+import threading
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import Clock,Command,EventBus,GroupPlanner,Histogram,Parameters,Scheduler
+
+# =============================================================================
+# Logger setup
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Classes
+class Dispatcher:
+    PRIORITY_STOP     = 1
+    PRIORITY_DEFAULT  = 2
+    PRIORITY_SHUTDOWN = 3
+
+    CMD_SHUTDOWN   = 'shutdown'
+    CMD_WAKE       = 'wake'
+    CMD_KEEP_AWAKE = 'keep_awake'
+    CMD_RECONFIGURE = 'reconfigure'
+
+    KEEP_AWAKE_OFF        = 'off'
+    KEEP_AWAKE_PREDICTIVE = 'predictive'
+    KEEP_AWAKE_ON         = 'on'
+
+    # Channel 1 drives all shutters at once
+    GENERAL_CHANNEL = 1
+
+    # Returned while looking for a command when plugins must be asked again
+    # for the commands they expect
+    _RETRY = object()
+
+    # Delays (seconds) between stop commands and their order
+    STOP_LATENCY_BOUNDS = ( 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0 )
+
+    def __init__(self,remote,get_next_command_date=None,clock=None,events=None,is_active=None):
+        self._clock = clock or Clock()
+        self._events = events or EventBus(self._clock)
+        self._remote = remote
+        self._get_next_command_date = get_next_command_date
+        self._is_active = is_active
+        self._scheduler = Scheduler(remote)
+        self._planner = GroupPlanner(remote,self._scheduler)
+        self._pending = list()
+        self._condition = threading.Condition()
+        self._notification_count = 0
+
+        # Expected remote state once the running command is done
+        self._running_state = None
+        self._running_command = None
+
+        # (command,shutters,plans) of queued reconfigurations, commands queued
+        # meanwhile are checked against the last one
+        self._configs = list()
+
+        # Metrics
+        self._stop_latency = Histogram(self.STOP_LATENCY_BOUNDS)
+
+    # -------------------------------------------------------------------------
+    def put(self,commands):
+        with self._condition:
+            for command in commands:
+                command.date = self._clock.time()
+                if command.channel is None:
+                    command.channel = self._get_shutter_channel(command.shutter)
+
+                # Invalid commands must not affect pending ones
+                if command.shutter != '' and not self._is_valid(command):
+                    logger.warning('Rejecting %s, unknown shutter or command',command)
+                    command.finish(Command.STATUS_REJECTED,command.date)
+                    continue
+
+                if self._coalesce(command):
+                    self._pending.append(command)
+                if command.command == self._remote.CMD_STOP:
+                    self._preempt(command)
+                if command.shutter != '':
+                    self._events.emit( 'command_queued', { 'shutter' : command.shutter
+                                                         , 'command' : command.command
+                                                         , 'status'  : command.get_status() } )
+            self._condition.notify()
+        return commands
+
+    def get(self,until=None):
+        # Returns None when reaching until date without command to execute.
+        # Plugins are asked for the commands they expect without holding the
+        # lock, they may queue commands meanwhile
+        while True:
+            with self._condition:
+                notification_count = self._notification_count
+            expectation = self._get_expectation()
+
+            with self._condition:
+                command = self._get_command(until,expectation,notification_count)
+                if command is None:
+                    return None
+                if command is self._RETRY:
+                    continue
+
+                state = self._scheduler.get_remote_state(self._clock.time())
+                if command.command == self.CMD_WAKE:
+                    self._scheduler.wake(state)
+                elif command.command == self.CMD_KEEP_AWAKE:
+                    self._scheduler.keep_awake(state)
+                else:
+                    self._scheduler.estimate_command(command.shutter,command.command,state,command.steps,command.deadline)
+                self._running_state = state
+                self._running_command = command
+                self._remote.clear_preemption()
+                return command
+
+    def _get_command(self,until,expectation,notification_count):
+        # Returns the next command, None when reaching until date or _RETRY
+        # once expected commands may have changed
+        while True:
+            state = self._scheduler.get_remote_state(self._clock.time())
+            timeout = None
+            if len(self._pending):
+                self._plan(state)
+                command = self._select(self._pending,state)
+                if command and self._is_noop(command,state):
+                    logger.info('Skipping %s, shutter already in position',command)
+                    self._discard(command,Command.STATUS_SKIPPED)
+                    continue
+                if command:
+                    self._pending.remove(command)
+                    return command
+                # Only commands waiting for their deadline are left
+                timeout = self._get_next_due_date(self._pending,state) - state.date
+
+            # Keep remote awake while waiting for commands
+            idle_action = self._get_idle_action(state,expectation)
+            if idle_action:
+                (date,command) = idle_action
+                if date <= state.date:
+                    return command
+                timeout = date - state.date if timeout is None else min(timeout,date - state.date)
+
+            if until is not None:
+                if state.date >= until:
+                    return None
+                timeout = until - state.date if timeout is None else min(timeout,until - state.date)
+            if notification_count != self._notification_count:
+                return self._RETRY
+            self._clock.wait(self._condition,timeout)
+            return self._RETRY
+
+    def notify(self):
+        # Expected commands changed
+        with self._condition:
+            self._notification_count = self._notification_count + 1
+            self._condition.notify()
+
+    def shutdown(self):
+        self.put( [ Command(self.PRIORITY_SHUTDOWN,'',self.CMD_SHUTDOWN), ] )
+
+    def reconfigure(self,shutters):
+        # Commands queued from now on are checked against the new
+        # configuration and wait for the reconfiguration
+        (shutters_by_name,_,plans) = self._remote.parse_shutters(shutters)
+        command = Command(self.PRIORITY_DEFAULT,'',self.CMD_RECONFIGURE)
+        command.data = shutters
+        with self._condition:
+            self._configs.append( (command,shutters_by_name,plans) )
+            return self.put( [ command, ] )[0]
+
+    # -------------------------------------------------------------------------
+    def run(self,until=None):
+        while True:
+            command = self.get(until)
+
+            if command is None:
+                break
+            elif command.command == self.CMD_SHUTDOWN:
+                logger.info('Received shutdown command')
+                break
+
+            continuation = None
+            if command.command == self.CMD_WAKE:
+                logger.debug('Waking remote ahead of expected command')
+                self._remote.wake()
+            elif command.command == self.CMD_KEEP_AWAKE:
+                self._remote.keep_awake()
+            elif command.command == self.CMD_RECONFIGURE:
+                # Queued commands are checked against the new configuration
+                # before any other command is selected
+                try:
+                    self._remote.reconfigure(command.data,self._condition)
+                except:
+                    logger.exception('Failed to reconfigure remote')
+                with self._condition:
+                    self._configs = [ config for config in self._configs if config[0] is not command ]
+                    self._update_pending()
+            else:
+                logger.debug('Processing order for shutter %s: %s',command.shutter,command.command)
+                command.start_date = self._clock.time()
+                if command.plan:
+                    command.plan.command_started(command.start_date)
+                self._events.emit( 'command_started', { 'shutter' : command.shutter
+                                                      , 'command' : command.command
+                                                      , 'channel' : command.channel } )
+                continuation = self._remote.drive_shutter( command.shutter, command.command
+                                                         , command.steps, command.deadline )
+                if command.command == self._remote.CMD_STOP and command.deadline is None:
+                    self._record_stop_latency(command)
+            self._remote.checkpoint()
+
+            with self._condition:
+                self._running_state = None
+                self._running_command = None
+                if continuation and self._is_stopped(command):
+                    logger.info('Cancelling the rest of %s on stop',command)
+                    self._finish(command,Command.STATUS_CANCELLED)
+                elif continuation:
+                    # Serve other channels until the next steps are due
+                    self._pending.append( self._make_continuation(command,continuation) )
+                else:
+                    self._finish(command,Command.STATUS_EXECUTED)
+
+    def get_plan_reports(self):
+        return self._planner.get_reports()
+
+    def get_metrics(self):
+        metrics = self._remote.get_metrics()
+        metrics['stop_latency'] = self._stop_latency.get()
+        return metrics
+
+    # -------------------------------------------------------------------------
+    def get_etas(self):
+        # Simulate the dispatch of pending commands, returns the (order date,
+        # end date) of each of them, or None while the remote is booting as
+        # its initialization can't be estimated
+        etas = dict()
+        with self._condition:
+            if not self._remote.is_ready():
+                return { command: None for command in self._pending if command.command != self.CMD_SHUTDOWN }
+
+            now = self._clock.time()
+            if self._running_state:
+                state = self._running_state.copy()
+                state.date = max(state.date,now)
+            else:
+                state = self._scheduler.get_remote_state(now)
+
+            # Commands waiting for a reconfiguration can't be estimated with
+            # the current configuration
+            held = [ command for command in self._pending if self._is_held(command) ]
+            pending = [ command for command in self._pending if command not in held ]
+            origins = dict()
+            while len(pending):
+                candidates = self._get_plan_candidates(pending)
+                plan = self._planner.plan(candidates,state) if len(candidates) else None
+                if plan:
+                    for command in plan.replaced:
+                        pending.remove(command)
+                        etas[command] = plan.leaders[command]
+                    pending.extend(plan.commands)
+
+                command = self._select(pending,state)
+                if command is None:
+                    state.date = self._get_next_due_date(pending,state)
+                    continue
+                pending.remove(command)
+                if command.command == self.CMD_SHUTDOWN:
+                    continue
+                if self._is_noop(command,state):
+                    etas[command] = (state.date,state.date)
+                    continue
+
+                (order_date,end_date,continuation) = self._scheduler.estimate_command( command.shutter, command.command, state
+                                                                                     , command.steps, command.deadline )
+                origin = origins.pop(command,command)
+                if origin in etas:
+                    order_date = etas[origin][0]
+                etas[origin] = (order_date,end_date)
+                if continuation:
+                    continuation = self._make_continuation(command,continuation,False)
+                    origins[continuation] = origin
+                    pending.append(continuation)
+
+            for (command,eta) in etas.items():
+                if isinstance(eta,Command):
+                    etas[command] = etas[eta]
+            for command in held:
+                etas[command] = None
+        return etas
+
+    def get_eta(self,command):
+        etas = self.get_etas()
+        while command is not None and command not in etas:
+            command = command.leader
+        return etas.get(command)
+
+    # -------------------------------------------------------------------------
+    def _coalesce(self,command):
+        if command.command in ( self.CMD_SHUTDOWN, self.CMD_RECONFIGURE ):
+            return True
+
+        # Returns whether the command still has to be queued
+        pending = [ pending_command for pending_command in self._pending
+                    if pending_command.shutter == command.shutter ]
+        stop = command.command == self._remote.CMD_STOP
+
+        for pending_command in pending:
+            if pending_command.command == command.command:
+                # Identical commands are executed once
+                logger.info('Merging %s with pending command',command)
+                command.follow(pending_command,Command.STATUS_MERGED)
+                return False
+
+        # Stops on the general channel stop moves of every shutter
+        if stop and command.channel == self.GENERAL_CHANNEL:
+            pending.extend( pending_command for pending_command in self._pending
+                            if pending_command.deadline is not None and pending_command.shutter != command.shutter )
+
+        for pending_command in pending:
+            if stop:
+                # Stop cancels pending moves
+                logger.info('Cancelling %s on stop',pending_command)
+                self._discard(pending_command,Command.STATUS_CANCELLED)
+            elif pending_command.command != self._remote.CMD_STOP:
+                # Newer moves supersede older ones
+                logger.info('%s superseded by %s',pending_command,command)
+                self._discard(pending_command,Command.STATUS_SUPERSEDED)
+        return True
+
+    def _is_valid(self,command):
+        if command.channel is None:
+            return False
+        if len(self._configs):
+            (_,shutters,plans) = self._configs[-1]
+            return self._remote.is_valid_shutter_command(shutters,plans,command.shutter,command.command)
+        return self._remote.is_valid_command(command.shutter,command.command)
+
+    def _get_shutter_channel(self,shutter):
+        if len(self._configs):
+            (_,shutters,_) = self._configs[-1]
+            try:
+                return int(shutters[shutter]['channel'])
+            except KeyError:
+                return None
+        return self._remote.get_shutter_channel(shutter)
+
+    def _is_held(self,command):
+        # Commands queued after a reconfiguration wait for it, continuations
+        # and commands planned before it are not held
+        return len(self._configs) > 0 and command.deadline is None and command.plan is None \
+           and command.sequence > self._configs[0][0].sequence
+
+    def _preempt(self,stop):
+        # Move being driven returns its remaining steps so the stop is sent
+        # next. Its press may be cut short unless on the stopped channel
+        running = self._running_command
+        if running is None or running.shutter == '' or running.command == self._remote.CMD_STOP \
+           or self._is_held(stop):
+            return
+        logger.info('Preempting %s for %s',running,stop)
+        self._remote.preempt( cut_press=Parameters.remote_cmd_button_cut_press and running.channel != stop.channel )
+
+    def _is_stopped(self,command):
+        # Whether a stop was queued for the shutter of a running command
+        return any( pending_command.command == self._remote.CMD_STOP and pending_command.deadline is None
+                    and ( pending_command.shutter == command.shutter or pending_command.channel == self.GENERAL_CHANNEL )
+                    for pending_command in self._pending )
+
+    def _record_stop_latency(self,command):
+        # Delay between stop commands and the press sending their order
+        order_date = self._remote.get_last_order_date()
+        if order_date < command.start_date:
+            return
+        for follower in command.get_followers():
+            if follower.command == self._remote.CMD_STOP and follower.plan is None:
+                self._stop_latency.add( order_date - follower.date )
+
+    def _discard(self,command,status):
+        self._pending.remove(command)
+        self._finish(command,status)
+
+    def _finish(self,command,status):
+        date = self._clock.time()
+        command.finish(status,date)
+        if command.plan and command.plan.command_finished(date):
+            if command.plan.start_date is not None:
+                self._planner.report(command.plan)
+
+        # Commands created by the dispatcher (plans and continuations) finish
+        # along with queued commands
+        for finished in command.get_followers():
+            if finished.shutter != '' and finished.plan is None and finished.deadline is None:
+                self._events.emit( 'command_finished', { 'shutter' : finished.shutter
+                                                       , 'command' : finished.command
+                                                       , 'status'  : finished.get_status() } )
+
+    def _is_noop(self,command,state):
+        # Continuations are always sent, their shutter is moving
+        if command.shutter == '' or command.deadline is not None:
+            return False
+        return self._remote.is_noop(command.shutter,command.command,state.date)
+
+    def _update_pending(self):
+        # Shutters channels may have changed
+        for command in list(self._pending):
+            if command.shutter == '':
+                continue
+            channel = self._remote.get_shutter_channel(command.shutter)
+            if channel is None:
+                logger.warning('Cancelling %s for removed shutter',command)
+                self._discard(command,Command.STATUS_CANCELLED)
+            elif command.steps is None and not self._remote.is_valid_command(command.shutter,command.command):
+                logger.warning('Cancelling %s not supported anymore by its shutter',command)
+                self._discard(command,Command.STATUS_CANCELLED)
+            else:
+                command.channel = channel
+
+    def _make_continuation(self,command,continuation,follow=True):
+        (deadline,steps) = continuation
+        next_command = Command(command.priority,command.shutter,command.command,command.channel)
+        next_command.steps = steps
+        next_command.deadline = deadline
+        if follow:
+            command.follow(next_command)
+        return next_command
+
+    def _get_plan_candidates(self,pending):
+        # Look for pending commands that could be sent at once on the general
+        # channel
+        pending = [ command for command in pending if command.deadline is None and not self._is_held(command) ]
+        if len(pending) == 0:
+            return list()
+        priority = min( command.priority for command in pending )
+        return [ command for command in pending
+                 if command.priority == priority and command.plan is None ]
+
+    def _plan(self,state):
+        candidates = self._get_plan_candidates(self._pending)
+        if len(candidates) == 0:
+            return
+
+        plan = self._planner.plan(candidates,state)
+        if plan:
+            logger.info('Replacing {} commands by {} using general channel (estimated {:.2f} s instead of {:.2f} s)'
+                        .format(len(plan.replaced),len(plan.commands),plan.estimated_duration,plan.unplanned_duration))
+            plan.link()
+            for command in plan.replaced:
+                self._pending.remove(command)
+            self._pending.extend(plan.commands)
+
+    def _get_due_date(self,command,state):
+        # Date at which a continuation must be started to be on its channel
+        # by its deadline
+        return command.deadline - self._scheduler.estimate_channel_change(command.channel,state)
+
+    def _get_next_due_date(self,pending,state):
+        return min( self._get_due_date(command,state) for command in pending
+                    if command.deadline is not None )
+
+    def _get_expectation(self):
+        # Returns the (date,active) of the next command expected from plugins,
+        # active plugins (e.g. with clients connected) may send some at any
+        # time. Called without holding the lock
+        if Parameters.remote_keep_awake_mode == self.KEEP_AWAKE_OFF:
+            return (None,False)
+        date = self._get_next_command_date() if self._get_next_command_date else None
+        active = self._is_active is not None and self._is_active()
+        return (date,active)
+
+    def _get_idle_action(self,state,expectation):
+        # Returns the (date,command) of the press keeping the remote awake
+        mode = Parameters.remote_keep_awake_mode
+        if mode == self.KEEP_AWAKE_OFF:
+            return None
+
+        # Commands are expected for continuations and from plugins
+        dates = [ command.deadline for command in self._pending if command.deadline is not None ]
+        (date,active) = expectation
+        if date is not None:
+            dates.append(date)
+        if len(dates) == 0 and not active:
+            return None
+        expected_date = min(dates) if len(dates) else None
+
+        sleep_date = self._scheduler.get_sleep_date(state)
+        continuations = [ command for command in self._pending if command.deadline is not None ]
+        action_state = state.copy()
+        if mode == self.KEEP_AWAKE_ON and ( active or expected_date - state.date <= Parameters.remote_keep_awake_horizon ):
+            # Press a harmless button before the remote sleeps
+            date = sleep_date - Parameters.remote_keep_awake_advance
+            command = Command(self.PRIORITY_DEFAULT,'',self.CMD_KEEP_AWAKE)
+            action_state.date = max(date,state.date)
+            self._scheduler.keep_awake(action_state)
+        elif expected_date is not None and expected_date > state.date:
+            # Wake remote just before the expected command
+            date = expected_date - Parameters.remote_keep_awake_advance \
+                                 - Parameters.remote_wake_button_press_duration \
+                                 - Parameters.remote_wake_button_release_duration
+            if expected_date <= sleep_date:
+                return None
+            date = max(date,sleep_date + Parameters.remote_sleep_timer_margin)
+            command = Command(self.PRIORITY_DEFAULT,'',self.CMD_WAKE)
+            action_state.date = max(date,state.date)
+            self._scheduler.wake(action_state)
+        else:
+            return None
+
+        if not self._fits_state(action_state,continuations):
+            return None
+        return (date,command)
+
+    def _fits(self,command,continuations,state):
+        # Whether the command can be executed before continuations are due
+        if len(continuations) == 0:
+            return True
+        state = state.copy()
+        self._scheduler.estimate_command(command.shutter,command.command,state,command.steps,command.deadline)
+        return self._fits_state(state,continuations)
+
+    def _fits_state(self,state,continuations):
+        for continuation in continuations:
+            continuation_state = state.copy()
+            self._scheduler.change_channel(continuation.channel,continuation_state)
+            if continuation_state.date > continuation.deadline:
+                return False
+        return True
+
+    def _select(self,pending,state):
+        pending = [ command for command in pending if not self._is_held(command) ]
+
+        # Stops are executed first, moves left time for them by being
+        # preempted so they don't wait for continuations
+        stops = [ command for command in pending if command.deadline is None and command.priority == self.PRIORITY_STOP ]
+        if len(stops):
+            stops.sort( key=lambda command: command.sequence )
+            eligibles = [ command for (index,command) in enumerate(stops)
+                          if not any( self._conflicts(older,command) for older in stops[:index] ) ]
+            return min( eligibles
+                      , key=lambda command: ( self._scheduler.estimate_channel_change(command.channel,state)
+                                            , command.sequence ) )
+
+        # Continuations are executed next once due
+        continuations = [ command for command in pending if command.deadline is not None ]
+        due = [ command for command in continuations if self._get_due_date(command,state) <= state.date ]
+        if len(due):
+            return min( due, key=lambda command: command.deadline )
+
+        # Only commands of the most urgent priority are candidates, so stop
+        # commands are still executed first
+        commands = [ command for command in pending if command.deadline is None ]
+        if len(commands) == 0:
+            return None
+        priority = min( command.priority for command in commands )
+        candidates = [ command for command in commands if command.priority == priority ]
+        candidates.sort( key=lambda command: command.sequence )
+
+        # A command can't overtake an older command (or a continuation) on the
+        # same channel (or on the general channel which drives all of them)
+        # and must leave time for continuations
+        eligibles = list()
+        for (index,command) in enumerate(candidates):
+            # Let continuations complete before acting on the whole remote
+            if command.command in ( self.CMD_SHUTDOWN, self.CMD_RECONFIGURE ) and len(continuations):
+                continue
+            if not any( self._conflicts(older,command) for older in continuations + candidates[:index] ) \
+               and self._fits(command,continuations,state):
+                eligibles.append(command)
+
+        # Bound the delay a command can suffer from being reordered
+        oldest = candidates[0]
+        if oldest in eligibles and state.date - oldest.date >= Parameters.dispatcher_command_max_delay:
+            return oldest
+
+        if len(eligibles) == 0:
+            return None
+
+        # Sweep the channel ring, picking the quickest channel to reach first
+        return min( eligibles
+                  , key=lambda command: ( self._scheduler.estimate_channel_change(command.channel,state)
+                                        , command.sequence ) )
+
+    def _conflicts(self,command1,command2):
+        # Commands aren't reordered around a reconfiguration
+        if self.CMD_RECONFIGURE in ( command1.command, command2.command ):
+            return True
+        if command1.channel is None or command2.channel is None:
+            return command1.shutter == command2.shutter
+        return command1.channel == command2.channel \
+            or command1.channel == self.GENERAL_CHANNEL \
+            or command2.channel == self.GENERAL_CHANNEL
@@ -0,0 +1,36 @@
+# =============================================================================
+# System imports
+import logging
+import threading
+
+# =============================================================================
+# Logger setup
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Classes
+class EventBus:
+    # Listeners are called as listener(event,data) from the thread emitting
+    # the event, data only holds JSON serializable values
+    def __init__(self,clock=None):
+        self._clock = clock
+        self._listeners = list()
+        self._lock = threading.Lock()
+
+    def add_listener(self,listener):
+        with self._lock:
+            self._listeners = self._listeners + [ listener, ]
+
+    def remove_listener(self,listener):
+        with self._lock:
+            self._listeners = [ other for other in self._listeners if other != listener ]
+
+    def emit(self,event,data=None):
+        data = dict(data or dict())
+        if self._clock:
+            data['date'] = self._clock.time()
+        for listener in self._listeners:
+            try:
+                listener(event,data)
+            except:
+                logger.exception('Failed to notify event {}'.format(event))
@@ -1,7 +1,7 @@
 # =============================================================================
 # System imports
 import logging
-import RPi.GPIO as RPiGPIO
+import time
 
 # =============================================================================
 # Logger setup
@@ -9,13 +9,79 @@ logger = logging.getLogger(__name__)
 
 # =============================================================================
 # Classes
+class GPIOBackend:
+    LOW  = 0
+    HIGH = 1
+
+    def __init__(self):
+        # Number of GPIO objects using each channel, a channel already set up
+        # by another object keeps its current state
+        self.users = dict()
+
+    def setup(self,gpio,initial_state):
+        pass
+
+    def output(self,gpio,physical_value):
+        pass
+
+    def cleanup(self,gpio):
+        pass
+
+class RPiGPIOBackend(GPIOBackend):
+    def __init__(self):
+        super().__init__()
+
+        import RPi.GPIO
+        logger.debug('Initializing RpiGPIO module')
+        self._rpigpio = RPi.GPIO
+        self._rpigpio.setmode(self._rpigpio.BOARD)
+
+    def setup(self,gpio,initial_state):
+        if gpio.get_inout() == GPIO.IN:
+            self._rpigpio.setup( gpio.get_channel()
+                               , self._rpigpio.IN )
+        else:
+            self._rpigpio.setup( gpio.get_channel()
+                               , self._rpigpio.OUT
+                               , initial=self._rpigpio.HIGH if initial_state == self.HIGH else self._rpigpio.LOW )
+
+    def output(self,gpio,physical_value):
+        self._rpigpio.output( gpio.get_channel(), physical_value )
+
+    def cleanup(self,gpio):
+        self._rpigpio.cleanup( gpio.get_channel() )
+
+class RecordingBackend(GPIOBackend):
+    # Records (date, name, logical value) of every output change
+    def __init__(self,clock=None):
+        super().__init__()
+        self._clock = clock
+        self.events = list()
+
+    def setup(self,gpio,initial_state):
+        if gpio.get_inout() == GPIO.OUT:
+            self._record( gpio, initial_state )
+
+    def output(self,gpio,physical_value):
+        self._record( gpio, physical_value )
+
+    def _record(self,gpio,physical_value):
+        date = self._clock.time() if self._clock else time.time()
+        value = bool(physical_value) == gpio.is_active_high()
+        self.events.append( ( date, gpio.get_name(), 1 if value else 0 ) )
+        self.on_output( date, gpio.get_name(), value )
+
+    def on_output(self,date,name,value):
+        pass
+
 class GPIO:
     IN  = 0
     OUT = 1
 
-    _initialized = False
+    # Backend used when none is given, RPi.GPIO by default
+    default_backend = None
 
-    def __init__(self,name,channel,inout,default_value=0,active_high=True,debug=False):
+    def __init__(self,name,channel,inout,default_value=0,active_high=True,debug=False,backend=None):
         self._name    = name
         self._channel = channel
         self._inout   = inout
@@ -31,31 +97,50 @@ class GPIO:
                    , self._debug ))
 
         if self._debug == False:
-            if GPIO._initialized == False:
-                self._initialize()
+            self._backend = backend or GPIO.get_default_backend()
+
+            self._backend.users[self._channel] = self._backend.users.get(self._channel,0) + 1
+            if self._backend.users[self._channel] > 1:
+                logger.debug('GPIO {} channel {} already set up'.format(self._name,self._channel))
+                return
 
-            rpigpio_inout = RPiGPIO.IN if inout == GPIO.IN else RPiGPIO.OUT
             initial_state = None
-            if inout == GPIO.IN:
-                RPiGPIO.setup( self._channel
-                            , rpigpio_inout )
-            else:
-                initial_state = RPiGPIO.LOW
+            if inout == GPIO.OUT:
+                initial_state = GPIOBackend.LOW
                 if (self._active_high == True  and default_value == 1) or \
                 (self._active_high == False and default_value == 0):
-                    initial_state = RPiGPIO.HIGH
-                RPiGPIO.setup( self._channel
-                            , rpigpio_inout
-                            , initial=initial_state)
+                    initial_state = GPIOBackend.HIGH
+            self._backend.setup( self, initial_state )
 
     def __del__(self):
         if self._debug == False:
-            RPiGPIO.cleanup( self._channel )
+            self._backend.users[self._channel] = self._backend.users[self._channel] - 1
+            if self._backend.users[self._channel] == 0:
+                del self._backend.users[self._channel]
+                self._backend.cleanup( self )
 
-    def _initialize(self):
-        logger.debug('Initializing RpiGPIO module')
-        RPiGPIO.setmode(RPiGPIO.BOARD)
-        GPIO._initialized = True
+    @staticmethod
+    def get_default_backend():
+        if GPIO.default_backend is None:
+            GPIO.default_backend = RPiGPIOBackend()
+        return GPIO.default_backend
+
+    @staticmethod
+    def is_set_up(channel,backend=None):
+        backend = backend or GPIO.get_default_backend()
+        return channel in backend.users
+
+    def get_name(self):
+        return self._name
+
+    def get_channel(self):
+        return self._channel
+
+    def get_inout(self):
+        return self._inout
+
+    def is_active_high(self):
+        return self._active_high
 
     def set(self,value):
         if self._inout == GPIO.IN:
@@ -64,4 +149,4 @@ class GPIO:
             physical_value = value if self._active_high == True else not value
             logger.debug('Setting GPIO {:<10} to {} (logical value)'.format(self._name,1 if value else 0))
             if self._debug == False:
-                RPiGPIO.output( self._channel, physical_value )
+                self._backend.output( self, physical_value )
@@ -18,8 +18,24 @@ class Parameters:
     remote_cmd_button_press_duration   = 1.5
     remote_cmd_button_release_duration = 0.2
 
+    # Command presses on other channels can be cut short to send a stop once
+    # held that long, disabled as the remote may drop orders of short presses
+    remote_cmd_button_cut_press = False
+    remote_cmd_button_min_press_duration = 0.5
+
     remote_sleep_timer_margin   = 1.0
     remote_sleep_timer_duration = 15.0
 
     remote_wake_button_press_duration   = 0.1
-    remote_wake_button_release_duration = 0.5
\ No newline at end of file
+    remote_wake_button_release_duration = 0.5
+
+    remote_keep_awake_mode    = 'off'
+    remote_keep_awake_horizon = 60.0
+    remote_keep_awake_advance = 1.0
+
+    dispatcher_command_max_delay = 30.0
+
+    position_tolerance = 2.0
+
+    timing_drift_tolerance    = 0.05
+    timing_min_duration_ratio = 0.8
@@ -0,0 +1,138 @@
+# =============================================================================
+# System imports
+import collections
+import logging
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import Command
+
+# =============================================================================
+# Logger setup
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Classes
+class Plan:
+    def __init__(self,replaced,commands,leaders,estimated_duration,unplanned_duration):
+        self.replaced = replaced
+        self.commands = commands
+        self.leaders  = leaders
+        self.estimated_duration = estimated_duration
+        self.unplanned_duration = unplanned_duration
+        self.start_date = None
+        self.end_date = None
+        self._remaining = len(commands)
+
+        for command in commands:
+            command.plan = self
+
+    def link(self):
+        # Replaced commands complete along with their new command
+        for command in self.replaced:
+            command.follow(self.leaders[command])
+
+    def command_started(self,date):
+        if self.start_date is None:
+            self.start_date = date
+
+    def command_finished(self,date):
+        self._remaining = self._remaining - 1
+        if self._remaining == 0:
+            self.end_date = date
+        return self._remaining == 0
+
+    def get_actual_duration(self):
+        if self.start_date is None or self.end_date is None:
+            return None
+        return self.end_date - self.start_date
+
+class GroupPlanner:
+    # Channel 1 drives all shutters at once
+    GENERAL_CHANNEL = 1
+
+    def __init__(self,remote,scheduler):
+        self._remote = remote
+        self._scheduler = scheduler
+        self._reports = collections.deque(maxlen=20)
+
+    # -------------------------------------------------------------------------
+    def plan(self,commands,state):
+        channel_list = self._remote.get_channel_list()
+        general_shutter = self._remote.get_channel_shutter(self.GENERAL_CHANNEL)
+        channels = [ channel for channel in channel_list if channel != self.GENERAL_CHANNEL ]
+        if general_shutter is None or len(channels) == 0:
+            return None
+
+        # Commands must cover every channel but the general one exactly once
+        commands_by_channel = dict()
+        for command in commands:
+            if command.channel not in channels or command.channel in commands_by_channel:
+                return None
+            # Overridden commands and moves to a position are not sent the same
+            # way on the general channel
+            if self._remote.has_override(command.shutter,command.command) \
+               or self._remote.is_position_command(command.command):
+                return None
+            commands_by_channel[command.channel] = command
+        if len(commands_by_channel) != len(channels):
+            return None
+
+        # Send the most common command on the general channel and correct the
+        # other channels afterwards
+        counts = collections.Counter( command.command for command in commands )
+        general_command = counts.most_common(1)[0][0]
+        if self._remote.has_override(general_shutter,general_command):
+            return None
+        corrections = [ command for command in commands if command.command != general_command ]
+
+        # Corrections are swept from the general channel
+        corrections = self._sweep(corrections,channel_list.index(self.GENERAL_CHANNEL))
+        unplanned_duration = self._scheduler.estimate_duration( [ ( command.shutter, command.command )
+                                                                  for command in self._sweep(commands,state.channel_index) ]
+                                                              , state )
+        estimated_duration = self._scheduler.estimate_duration( [ ( general_shutter, general_command ) ]
+                                                              + [ ( command.shutter, command.command )
+                                                                  for command in corrections ]
+                                                              , state )
+        if estimated_duration >= unplanned_duration:
+            return None
+
+        # Build the new commands, they can't be considered older than the
+        # commands they replace
+        priority = commands[0].priority
+        date = min( command.date for command in commands )
+        general = Command(priority,general_shutter,general_command,self.GENERAL_CHANNEL)
+        planned = [ general, ]
+        leaders = dict()
+        for command in commands:
+            leaders[command] = general
+        for command in sorted(corrections,key=lambda command: command.sequence):
+            correction = Command(priority,command.shutter,command.command,command.channel)
+            leaders[command] = correction
+            planned.append(correction)
+        for command in planned:
+            command.date = date
+
+        return Plan(commands,planned,leaders,estimated_duration,unplanned_duration)
+
+    def report(self,plan):
+        actual_duration = plan.get_actual_duration()
+        logger.info('Group plan executed in {:.2f} s (estimated {:.2f} s, {:.2f} s without planning)'
+                    .format(actual_duration,plan.estimated_duration,plan.unplanned_duration))
+        self._reports.append( { 'commands'           : len(plan.replaced)
+                              , 'planned_commands'   : len(plan.commands)
+                              , 'estimated_duration' : plan.estimated_duration
+                              , 'unplanned_duration' : plan.unplanned_duration
+                              , 'actual_duration'    : actual_duration } )
+
+    def get_reports(self):
+        return list(self._reports)
+
+    # -------------------------------------------------------------------------
+    def _sweep(self,commands,channel_index):
+        # Order in which commands are sent in a single pass over the channel ring
+        channel_list = self._remote.get_channel_list()
+        return sorted( commands
+                     , key=lambda command: ( ( channel_list.index(command.channel) - channel_index ) % len(channel_list)
+                                           , command.sequence ) )
@@ -0,0 +1,153 @@
+# =============================================================================
+# System imports
+import logging
+import threading
+
+# =============================================================================
+# Logger setup
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Classes
+class RemotePool:
+    # Remotes driven in parallel, each one with its own dispatcher (command
+    # queue) run by its own thread. Commands are routed to the remote of
+    # their shutter
+    def __init__(self):
+        self._remotes = dict()
+        self._dispatchers = dict()
+        self._shutters = dict()
+        self._routes = dict()
+        self._default = None
+        self._lock = threading.Lock()
+
+    def add(self,name,remote,dispatcher,shutters):
+        # The first remote gets commands of unknown shutters, they are
+        # rejected when driven
+        self._remotes[name] = remote
+        self._dispatchers[name] = dispatcher
+        self._shutters[name] = shutters
+        if self._default is None:
+            self._default = name
+        with self._lock:
+            for shutter in shutters:
+                self._routes[shutter['name']] = name
+
+    def get_names(self):
+        return list(self._remotes)
+
+    def get_remote(self,name):
+        return self._remotes[name]
+
+    def get_states(self):
+        return { name: 'ready' if remote.is_ready() else 'booting' for (name,remote) in self._remotes.items() }
+
+    def is_ready(self):
+        return all( remote.is_ready() for remote in self._remotes.values() )
+
+    # -------------------------------------------------------------------------
+    def run(self,until=None):
+        # Boots remotes in parallel, commands queued meanwhile are processed
+        # once their remote is ready. Returns once every dispatcher stopped,
+        # all of them are stopped when one fails
+        self._run_all( [ lambda name=name: self._run_remote(name,until) for name in self._remotes ]
+                     , self.shutdown )
+
+    def _run_remote(self,name,until):
+        self._remotes[name].start()
+        self._dispatchers[name].run(until)
+
+    def stop(self,power_off=True):
+        for remote in self._remotes.values():
+            remote.stop( power_off=power_off )
+
+    def shutdown(self):
+        for dispatcher in self._dispatchers.values():
+            dispatcher.shutdown()
+
+    def notify(self):
+        for dispatcher in self._dispatchers.values():
+            dispatcher.notify()
+
+    # -------------------------------------------------------------------------
+    def put(self,commands):
+        # Commands of each remote are queued at once
+        by_remote = dict()
+        for command in commands:
+            by_remote.setdefault(self.get_route(command.shutter),list()).append(command)
+        for (name,remote_commands) in by_remote.items():
+            self._dispatchers[name].put(remote_commands)
+        return commands
+
+    def reconfigure(self,shutters):
+        # Returns the reconfiguration commands of remotes whose shutters
+        # changed, shutters moved to another remote have their queued
+        # commands cancelled on their previous remote
+        by_remote = { name: list() for name in self._remotes }
+        for shutter in shutters:
+            by_remote[shutter.get('remote',self._default)].append(shutter)
+
+        commands = list()
+        for (name,remote_shutters) in by_remote.items():
+            if remote_shutters != self._shutters[name]:
+                self._shutters[name] = remote_shutters
+                commands.append( self._dispatchers[name].reconfigure(remote_shutters) )
+        with self._lock:
+            self._routes = { shutter['name']: shutter.get('remote',self._default) for shutter in shutters }
+        return commands
+
+    def get_route(self,shutter):
+        with self._lock:
+            return self._routes.get(shutter,self._default)
+
+    # -------------------------------------------------------------------------
+    def get_etas(self):
+        etas = dict()
+        for dispatcher in self._dispatchers.values():
+            etas.update(dispatcher.get_etas())
+        return etas
+
+    def get_eta(self,command):
+        return self._dispatchers[self.get_route(command.shutter)].get_eta(command)
+
+    def get_plan_reports(self):
+        return [ report for dispatcher in self._dispatchers.values()
+                        for report in dispatcher.get_plan_reports() ]
+
+    def get_metrics(self):
+        return { name: dispatcher.get_metrics() for (name,dispatcher) in self._dispatchers.items() }
+
+    def get_positions(self):
+        positions = dict()
+        for remote in self._remotes.values():
+            positions.update(remote.get_positions())
+        return positions
+
+    def get_command_steps(self):
+        steps = dict()
+        for remote in self._remotes.values():
+            steps.update(remote.get_command_steps())
+        return steps
+
+    # -------------------------------------------------------------------------
+    def _run_all(self,functions,on_error=None):
+        # The last function runs on the calling thread, the first exception is
+        # raised once all functions returned
+        errors = list()
+        def run(function):
+            try:
+                function()
+            except BaseException as e:
+                logger.exception('Remote failed')
+                errors.append(e)
+                if on_error:
+                    on_error()
+
+        threads = [ threading.Thread(target=run,args=(function,),daemon=True) for function in functions[:-1] ]
+        for thread in threads:
+            thread.start()
+        run(functions[-1])
+        for thread in threads:
+            thread.join()
+        if len(errors):
+            raise errors[0]
@@ -0,0 +1,158 @@
+# =============================================================================
+# System imports
+import logging
+import math
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import Parameters,make_press,make_wait
+
+# =============================================================================
+# Logger setup
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Classes
+class PositionTracker:
+    # Estimates shutters positions (percent open, 0 when closed) from the
+    # orders sent to them and their configured full travel durations
+    CMD_UP   = 'up'
+    CMD_DOWN = 'down'
+    CMD_STOP = 'stop'
+    CMD_INT  = 'int'
+
+    OPEN   = 100.0
+    CLOSED = 0.0
+
+    # Channel 1 drives all shutters at once
+    GENERAL_CHANNEL = 1
+
+    def __init__(self,shutters):
+        # (position at date or None when unknown, direction, date) by shutter
+        self._states = dict()
+        self._channels = dict()
+        self._travels = dict()
+        self.reconfigure(shutters)
+
+    # -------------------------------------------------------------------------
+    def reconfigure(self,shutters):
+        # Estimates of shutters whose travel durations didn't change are kept
+        channels = dict()
+        travels = dict()
+        for (name,shutter) in shutters.items():
+            channels[name] = int(shutter['channel'])
+            if 'travel' in shutter:
+                travels[name] = ( float(shutter['travel']['up']), float(shutter['travel']['down']) )
+        for name in list(self._states):
+            if travels.get(name) != self._travels.get(name):
+                del self._states[name]
+        self._channels = channels
+        self._travels = travels
+
+    def is_tracked(self,shutter):
+        return shutter in self._travels
+
+    # -------------------------------------------------------------------------
+    def get_position(self,shutter,date):
+        # Returns the estimated position at date, None if unknown
+        state = self._states.get(shutter)
+        if state is None:
+            return None
+        (position,direction,start_date) = state
+        if direction == 0:
+            return position
+
+        (up_travel,down_travel) = self._travels[shutter]
+        elapsed = date - start_date
+        if direction > 0:
+            if position is None:
+                # A full travel reaches the end whatever the start position
+                return self.OPEN if elapsed >= up_travel else None
+            return min( self.OPEN, position + ( self.OPEN - self.CLOSED ) * elapsed / up_travel )
+        else:
+            if position is None:
+                return self.CLOSED if elapsed >= down_travel else None
+            return max( self.CLOSED, position - ( self.OPEN - self.CLOSED ) * elapsed / down_travel )
+
+    def get_positions(self,date):
+        return { shutter: self.get_position(shutter,date) for shutter in self._travels }
+
+    def order(self,shutter,command,date):
+        # Order sent on the channel of shutter at date
+        if self._channels.get(shutter) == self.GENERAL_CHANNEL:
+            shutters = list(self._travels)
+        elif shutter in self._travels:
+            shutters = [ shutter, ]
+        else:
+            return
+
+        for name in shutters:
+            position = self.get_position(name,date)
+            if command == self.CMD_UP:
+                self._states[name] = (position,1,date)
+            elif command == self.CMD_DOWN:
+                self._states[name] = (position,-1,date)
+            elif command == self.CMD_STOP:
+                self._states[name] = (position,0,date)
+            elif command == self.CMD_INT:
+                # Intermediate position is stored in the motor
+                self._states[name] = (None,0,date)
+
+    # -------------------------------------------------------------------------
+    def is_noop(self,shutter,command,date):
+        # Whether an up or down order would leave shutter where it already is,
+        # a general channel order must be useless for every shutter
+        if command == self.CMD_UP:
+            target = self.OPEN
+        elif command == self.CMD_DOWN:
+            target = self.CLOSED
+        else:
+            return False
+
+        if self._channels.get(shutter) == self.GENERAL_CHANNEL:
+            shutters = [ name for (name,channel) in self._channels.items() if channel != self.GENERAL_CHANNEL ]
+        else:
+            shutters = [ shutter, ]
+        return all( self.get_position(name,date) == target for name in shutters )
+
+    def get_steps(self,shutter,target,date):
+        # Steps moving shutter to target position, the stop order is sent once
+        # the move lasted long enough, presses included
+        if shutter not in self._travels:
+            logger.error('Can\'t drive shutter %s to a position without travel durations',shutter)
+            return tuple()
+
+        target = min( self.OPEN, max( self.CLOSED, float(target) ) )
+        position = self.get_position(shutter,date)
+        if target in ( self.OPEN, self.CLOSED ):
+            if position == target:
+                return tuple()
+            return ( make_press(self.CMD_UP if target == self.OPEN else self.CMD_DOWN), )
+
+        (up_travel,down_travel) = self._travels[shutter]
+        press_duration = Parameters.remote_cmd_button_press_duration \
+                       + Parameters.remote_cmd_button_release_duration
+        steps = tuple()
+        if position is None:
+            # Unknown positions are calibrated by a full opening
+            steps = ( make_press(self.CMD_UP), make_wait(up_travel - press_duration) )
+            position = self.OPEN
+
+        delta = target - position
+        if abs(delta) < Parameters.position_tolerance:
+            return steps
+        (command,travel) = ( self.CMD_UP, up_travel ) if delta > 0 else ( self.CMD_DOWN, down_travel )
+        duration = travel * abs(delta) / ( self.OPEN - self.CLOSED )
+
+        # Moves last at least until the stop is pressed, targets closer than
+        # that are rounded to the nearest reachable position, which orders
+        # dates then record
+        if duration < press_duration:
+            reachable = position + math.copysign( ( self.OPEN - self.CLOSED ) * press_duration / travel, delta )
+            if duration < press_duration / 2:
+                logger.warning('Shutter %s can\'t reach %.1f%%, keeping it at %.1f%% (nearest position reachable is %.1f%%)'
+                              ,shutter,target,position,reachable)
+                return steps
+            logger.warning('Shutter %s can\'t reach %.1f%%, moving it to %.1f%% instead',shutter,target,reachable)
+            duration = press_duration
+        return steps + ( make_press(command), make_wait(duration - press_duration), make_press(self.CMD_STOP) )
@@ -2,12 +2,16 @@
 
 # =============================================================================
 # System imports
+import contextlib
+import json
 import logging
-import time
+import math
+import os
+import threading
 
 # =============================================================================
 # Local imports
-from chronosoft8puppeteer import GPIO,Parameters
+from chronosoft8puppeteer import Clock,EventBus,GPIO,Parameters,PositionTracker,PressTimer,WaitStep,compile_shutter
 
 # =============================================================================
 # Logger setup
@@ -27,7 +31,22 @@ class Remote:
     CMD_STOP = 'stop'
     CMD_INT  = 'int'
 
-    def __init__( self, config, shutters ):
+    # Moves to a position are given as 'position <percent open>'
+    CMD_POSITION = 'position'
+
+    STATE_VALIDATION_PROCESS = 'process'
+    STATE_VALIDATION_BOOT    = 'boot'
+    STATE_VALIDATION_NEVER   = 'never'
+
+    def __init__( self, config, shutters, state_file=None, state_validation=STATE_VALIDATION_PROCESS
+                , clock=None, backend=None, events=None, name=None, timer=None ):
+        self._name = name
+        self._ready = False
+        self._clock = clock or Clock()
+        self._backend = backend
+        self._events = events or EventBus(self._clock)
+        self._sleep_timer = None
+
         # Process main configuration
         try:
             # GPIO configuration
@@ -58,55 +77,67 @@ class Remote:
             self._debug = config['debug']
 
         # Process shutters configuration
-        try:
-            # Shutter/channel configuration
-            self._shutters = dict()
-            self._channel_list = list()
-            for shutter in shutters:
-                channel = int(shutter['channel'])
-                if channel < 1 or channel > 8:
-                    raise ValueError('Channel must be between 1 and 8')
-                if channel in self._channel_list:
-                    raise ValueError('Duplicate channel {}'.format(channel))
-                self._channel_list.append(channel)
-                self._shutters[shutter['name']] = shutter
-
-            self._channel_list.sort()
-            if len(self._channel_list) == 0:
-                raise ValueError('No channel configured')
+        (self._shutters,self._channel_list,self._plans) = self.parse_shutters(shutters)
+        self._positions = PositionTracker(self._shutters)
 
-            if 1 not in self._channel_list:
-                raise ValueError('Channel 1 must be configured')
-        except KeyError:
-            logger.error('Missing parameter(s) in shutters configuration file')
-            raise
-        except ValueError:
-            logger.error('Invalid parameter value in shutters configuration file')
-            raise
+        # Check if remote state from a previous run can be trusted, power must
+        # not have been cut in between
+        self._state_file = state_file
+        self._saved_state = None
+        self._state = self._load_state( state_validation, power_gpio_channel )
+        power_default = 0 if self._state is None else 1
 
         # Setup GPIOs
         self._buttons = dict()
-        self._buttons['return']   = GPIO( "Return"  , return_gpio_channel  , GPIO.OUT, 0, active_high=active_high, debug=self._debug)
-        self._buttons['validate'] = GPIO( "Validate", validate_gpio_channel, GPIO.OUT, 0, active_high=active_high, debug=self._debug)
-        self._buttons['up']       = GPIO( "Up"      , up_gpio_channel      , GPIO.OUT, 0, active_high=active_high, debug=self._debug)
-        self._buttons['stop']     = GPIO( "Stop"    , stop_gpio_channel    , GPIO.OUT, 0, active_high=active_high, debug=self._debug)
-        self._buttons['down']     = GPIO( "Down"    , down_gpio_channel    , GPIO.OUT, 0, active_high=active_high, debug=self._debug)
-        self._relay_power         = GPIO( "Power"   , power_gpio_channel   , GPIO.OUT, 0, active_high=active_high, debug=self._debug)
+        self._buttons['return']   = GPIO( "Return"  , return_gpio_channel  , GPIO.OUT, 0, active_high=active_high, debug=self._debug, backend=self._backend)
+        self._buttons['validate'] = GPIO( "Validate", validate_gpio_channel, GPIO.OUT, 0, active_high=active_high, debug=self._debug, backend=self._backend)
+        self._buttons['up']       = GPIO( "Up"      , up_gpio_channel      , GPIO.OUT, 0, active_high=active_high, debug=self._debug, backend=self._backend)
+        self._buttons['stop']     = GPIO( "Stop"    , stop_gpio_channel    , GPIO.OUT, 0, active_high=active_high, debug=self._debug, backend=self._backend)
+        self._buttons['down']     = GPIO( "Down"    , down_gpio_channel    , GPIO.OUT, 0, active_high=active_high, debug=self._debug, backend=self._backend)
+        self._relay_power         = GPIO( "Power"   , power_gpio_channel   , GPIO.OUT, power_default, active_high=active_high, debug=self._debug, backend=self._backend)
 
+        # Presses are timed here unless given to a GPIO worker
+        self._timer = timer or PressTimer(self._clock)
         self._last_btn_press_date = 0
+        self._last_order_date = 0
+        self._current_channel_index = 0
+
+        # Preemption of the running drive, requested from other threads
+        self._preemption = threading.Condition()
+        self._preempted = False
+
+        # Metrics
+        self._wake_count = 0
+        self._wake_duration = 0.0
+        self._predictive_wake_count = 0
+        self._keep_awake_press_count = 0
+        self._preempted_drive_count = 0
 
     def start( self ):
         if self._debug == True:
             logger.warn('Debug enabled, not powering up remote')
+            self._current_channel_index = 0
+        elif self._state is not None:
+            logger.info('Remote state restored, skipping initialization')
+            self._current_channel_index = self._state['current_channel_index']
+            self._last_btn_press_date = self._state['last_press_date']
+            if not self._state.get('stopped',True):
+                # Presses on the current channel since the last checkpoint are
+                # unknown, the remote may be awake until its sleep timer ends
+                logger.info('Remote state saved before being stopped, waiting for remote to sleep')
+                self._clock.sleep( Parameters.remote_sleep_timer_duration )
         else:
+            # State can't be trusted until initialization is done
+            self._save_state( powered=False )
+
             logger.debug('Waiting in case remote was powered on startup')
             self._relay_power.set(0)
-            time.sleep(1)
+            self._clock.sleep(1)
 
             logger.info('Powering up remote')
             self._relay_power.set(1)
-            self._last_btn_press_date = time.time()
-            time.sleep(Parameters.remote_boot_duration)
+            self._last_btn_press_date = self._clock.time()
+            self._clock.sleep(Parameters.remote_boot_duration)
             self._press_button( self.BTN_VALIDATE )
             self._press_button( self.BTN_VALIDATE )
 
@@ -115,7 +146,7 @@ class Remote:
             # main screen in all situation
             self._press_button( self.BTN_RETURN )
             self._press_button( self.BTN_RETURN )
-            time.sleep(Parameters.remote_boot_duration)
+            self._clock.sleep(Parameters.remote_boot_duration)
 
             logger.info('Configuring {} channels'.format(len(self._channel_list)))
             # Disable all channels (the first can't be disabled, but will be reinitialised)
@@ -132,15 +163,290 @@ class Remote:
                 else:
                     self._press_button( self.BTN_DOWN )
                 self._press_button( self.BTN_VALIDATE )
+            self._current_channel_index = 0
 
-        self._current_channel_index = 0
         logger.info('Current channel is {}'.format(self._channel_list[self._current_channel_index]))
+        self._save_state()
+        self._emit_channel()
+        self._ready = True
+        self._events.emit('remote_ready', { 'remote': self._name })
+
+    def is_ready( self ):
+        return self._ready
+
+    def reconfigure( self, shutters, lock=None ):
+        # New configuration is swapped while holding lock, once channels are
+        # reconfigured
+        (shutters,channel_list,plans) = self.parse_shutters(shutters)
+
+        if channel_list == self._channel_list:
+            logger.info('Channel list unchanged, updating shutters configuration')
+            with lock or contextlib.nullcontext():
+                self._shutters = shutters
+                self._plans = plans
+                self._positions.reconfigure(shutters)
+            return
+
+        # Only toggle channels whose state changed
+        enabled  = [ channel for channel in channel_list if channel not in self._channel_list ]
+        disabled = [ channel for channel in self._channel_list if channel not in channel_list ]
+        logger.info('Reconfiguring channels, enabling {} and disabling {}'.format(enabled,disabled))
+        self._save_state( powered=False )
+
+        if self._debug == False:
+            self._press_button( self.BTN_VALIDATE, press_duration=3 )
+            for channel in range( 1, 9 ):
+                if channel in enabled:
+                    self._press_button( self.BTN_UP )
+                elif channel in disabled:
+                    self._press_button( self.BTN_DOWN )
+                self._press_button( self.BTN_VALIDATE )
+
+        with lock or contextlib.nullcontext():
+            self._shutters = shutters
+            self._channel_list = channel_list
+            self._plans = plans
+            self._positions.reconfigure(shutters)
+            self._current_channel_index = 0
+        logger.info('Current channel is {}'.format(self._channel_list[self._current_channel_index]))
+        self._save_state()
+        self._emit_channel()
+
+    def stop( self, power_off=True ):
+        if power_off:
+            logger.info('Powering down remote')
+            self._relay_power.set(0)
+        self._save_state( powered=not power_off, stopped=True )
+
+    @staticmethod
+    def parse_shutters( shutters ):
+        # Returns shutters by name, sorted channel list and steps by (shutter,
+        # command), overrides are compiled so bad ones are rejected here
+        try:
+            # Shutter/channel configuration
+            shutters_by_name = dict()
+            channel_list = list()
+            plans = dict()
+            for shutter in shutters:
+                channel = int(shutter['channel'])
+                if channel < 1 or channel > 8:
+                    raise ValueError('Channel must be between 1 and 8')
+                if channel in channel_list:
+                    raise ValueError('Duplicate channel {}'.format(channel))
+                channel_list.append(channel)
+                shutters_by_name[shutter['name']] = shutter
+                for (command,steps) in compile_shutter(shutter).items():
+                    plans[(shutter['name'],command)] = steps
+
+            channel_list.sort()
+            if len(channel_list) == 0:
+                raise ValueError('No channel configured')
+
+            if 1 not in channel_list:
+                raise ValueError('Channel 1 must be configured')
+        except KeyError:
+            logger.error('Missing parameter(s) in shutters configuration file')
+            raise
+        except ValueError:
+            logger.error('Invalid parameter value in shutters configuration file')
+            raise
+
+        return (shutters_by_name,channel_list,plans)
+
+    @classmethod
+    def get_position_command( cls, percent ):
+        return '{} {:g}'.format(cls.CMD_POSITION,float(percent))
+
+    @classmethod
+    def is_position_command( cls, command ):
+        return command.startswith(cls.CMD_POSITION + ' ')
+
+    @classmethod
+    def get_position_target( cls, command ):
+        # Returns the percent of a position command, raises ValueError if it
+        # isn't a number between 0 and 100
+        percent = float(command[len(cls.CMD_POSITION)+1:])
+        if not math.isfinite(percent) or not PositionTracker.CLOSED <= percent <= PositionTracker.OPEN:
+            raise ValueError('Position {} out of range'.format(percent))
+        return percent
+
+    def checkpoint( self ):
+        # Save remote state so that it can be restored on restart, presses on
+        # the current channel only change the last press date which isn't
+        # saved for them
+        if self._saved_state is not None and self._saved_state['powered'] \
+           and self._saved_state['channel_list'] == self._channel_list \
+           and self._saved_state['current_channel_index'] == self._current_channel_index:
+            return
+        self._save_state()
 
-    def stop( self ):
-        logger.info('Powering down remote')
-        self._relay_power.set(0)
+    # -------------------------------------------------------------------------
+    def _load_state( self, validation, power_gpio_channel ):
+        if self._state_file is None or validation == self.STATE_VALIDATION_NEVER:
+            return None
 
-    def drive_shutter( self, shutter, command ):
+        try:
+            state = json.load(open(self._state_file))
+        except FileNotFoundError:
+            return None
+        except:
+            logger.exception('Failed to load remote state file %s',self._state_file)
+            return None
+
+        try:
+            if not state['powered']:
+                logger.info('Remote was powered down, state not restored')
+                return None
+            if state['channel_list'] != self._channel_list:
+                logger.info('Channel list changed, state not restored')
+                return None
+
+            if validation == self.STATE_VALIDATION_PROCESS:
+                # Only trust state written by this process, power GPIO must have
+                # been held since
+                if state['pid'] != os.getpid() or self._debug or not GPIO.is_set_up(power_gpio_channel,self._backend):
+                    logger.info('Remote state written by another process, state not restored')
+                    return None
+            elif validation == self.STATE_VALIDATION_BOOT:
+                if state['boot_id'] != self._get_boot_id():
+                    logger.info('Remote state written before last boot, state not restored')
+                    return None
+            else:
+                logger.error('Unknown remote state validation %s',validation)
+                return None
+
+            if state['current_channel_index'] not in range(len(self._channel_list)):
+                raise ValueError('Invalid channel index')
+        except (KeyError,TypeError,ValueError):
+            logger.exception('Invalid remote state file %s',self._state_file)
+            return None
+
+        return state
+
+    def _save_state( self, powered=True, stopped=False ):
+        if self._state_file is None:
+            return
+
+        state = { 'pid'                   : os.getpid()
+                , 'boot_id'               : self._get_boot_id()
+                , 'powered'               : powered
+                , 'stopped'               : stopped
+                , 'channel_list'          : list(self._channel_list)
+                , 'current_channel_index' : self._current_channel_index
+                , 'last_press_date'       : self._last_btn_press_date }
+        try:
+            tmp_file = self._state_file + '.tmp'
+            with open(tmp_file,'w') as f:
+                json.dump(state,f)
+            os.replace(tmp_file,self._state_file)
+        except:
+            logger.exception('Failed to save remote state file %s',self._state_file)
+            self._saved_state = None
+        else:
+            self._saved_state = state
+
+    def _invalidate_state( self ):
+        # State can't be trusted while the current channel changes, until the
+        # next checkpoint
+        if self._state_file is None or ( self._saved_state is not None and not self._saved_state['powered'] ):
+            return
+        self._save_state( powered=False )
+
+    def _get_boot_id( self ):
+        try:
+            with open('/proc/sys/kernel/random/boot_id') as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def get_name( self ):
+        return self._name
+
+    def get_channel_list( self ):
+        return self._channel_list
+
+    def get_current_channel_index( self ):
+        return self._current_channel_index
+
+    def get_channel_shutter( self, channel ):
+        for (name,shutter) in self._shutters.items():
+            if int(shutter['channel']) == channel:
+                return name
+        return None
+
+    def has_override( self, shutter, command ):
+        try:
+            return command in self._shutters[shutter]['override']
+        except KeyError:
+            return False
+
+    def get_last_press_date( self ):
+        return self._last_btn_press_date
+
+    def get_last_order_date( self ):
+        return self._last_order_date
+
+    def get_shutter_commands( self, shutter, command, date=None ):
+        # Steps of moves to a position depend on the position at date
+        if self.is_position_command(command):
+            if date is None:
+                date = self._clock.time()
+            try:
+                target = self.get_position_target(command)
+            except ValueError:
+                logger.error('Invalid position command {} for shutter {}'.format(command,shutter))
+                return tuple()
+            return self._positions.get_steps( shutter, target, date )
+
+        try:
+            return self._plans[(shutter,command)]
+        except KeyError:
+            logger.error('Unknown command {} for shutter {}'.format(command,shutter))
+            return tuple()
+
+    def get_command_steps( self ):
+        # Steps of each (shutter,command) as strings
+        return { '{}:{}'.format(shutter,command): [ str(step) for step in steps ]
+                 for ((shutter,command),steps) in self._plans.items() }
+
+    def is_valid_command( self, shutter, command ):
+        return self.is_valid_shutter_command( self._shutters, self._plans, shutter, command )
+
+    @classmethod
+    def is_valid_shutter_command( cls, shutters, plans, shutter, command ):
+        # Checks a command against shutters and plans given by parse_shutters,
+        # moves to a position need the travel durations of their shutter
+        if cls.is_position_command(command):
+            try:
+                cls.get_position_target(command)
+            except ValueError:
+                return False
+            return shutter in shutters and 'travel' in shutters[shutter]
+        return (shutter,command) in plans
+
+    def get_position( self, shutter ):
+        return self._positions.get_position( shutter, self._clock.time() )
+
+    def get_positions( self ):
+        return self._positions.get_positions( self._clock.time() )
+
+    def is_noop( self, shutter, command, date ):
+        # Whether the command would leave shutter where it is estimated to be
+        if self.is_position_command(command):
+            return len(self.get_shutter_commands(shutter,command,date)) == 0
+        if self.has_override(shutter,command):
+            return False
+        return self._positions.is_noop(shutter,command,date)
+
+    def get_shutter_channel( self, shutter ):
+        try:
+            return int(self._shutters[shutter]['channel'])
+        except KeyError:
+            return None
+
+    def drive_shutter( self, shutter, command, steps=None, deadline=None ):
+        # Returns the (deadline,steps) left to execute after a wait step, or
+        # once preempted
         if shutter not in self._shutters:
             logger.error('Can\'t drive unknown shutter {}'.format(shutter))
             return
@@ -149,57 +455,135 @@ class Remote:
         # Change channel to targeted
         if self._channel_list[self._current_channel_index] != channel:
             logger.info('Changing channel {} => {}'.format(self._channel_list[self._current_channel_index],channel))
+            self._invalidate_state()
             while self._channel_list[self._current_channel_index] != channel:
+                if self._preempted:
+                    break
                 self._press_button(self.BTN_RETURN)
-                self._current_channel_index = self._current_channel_index + 1
-                if self._current_channel_index >= len(self._channel_list):
-                    self._current_channel_index = 0
+                self._next_channel()
+            self._emit_channel()
 
-        # Check if override exists for current shutter
-        try:
-            commands = self._shutters[shutter]['override'][command]
-        except:
-            commands = [command,]
+        # Wait for continuation deadline once on channel, steps of commands
+        # preempted before their first step are computed when resumed
+        if deadline is not None and not self._sleep_until(deadline):
+            return self._get_preempted_continuation( channel, deadline, steps )
+        if self._preempted:
+            return self._get_preempted_continuation( channel, deadline or self._clock.time(), steps )
 
-        for command in commands:
-            if command == self.CMD_UP:
-                logger.info('Sending channel {} {} order'.format(channel,command))
-                self._press_button( self.BTN_UP
-                                  , press_duration  =Parameters.remote_cmd_button_press_duration
-                                  , release_duration=Parameters.remote_cmd_button_release_duration )
-            elif command == self.CMD_DOWN:
-                logger.info('Sending channel {} {} order'.format(channel,command))
-                self._press_button( self.BTN_DOWN
-                                  , press_duration  =Parameters.remote_cmd_button_press_duration
-                                  , release_duration=Parameters.remote_cmd_button_release_duration )
-            elif command == self.CMD_STOP:
-                logger.info('Sending channel {} {} order'.format(channel,command))
-                self._press_button( self.BTN_STOP
-                                  , press_duration  =Parameters.remote_cmd_button_press_duration
-                                  , release_duration=Parameters.remote_cmd_button_release_duration )
-            elif command == self.CMD_INT:
-                logger.info('Sending channel {} {} order'.format(channel,command))
-                self._press_button( self.BTN_STOP,self.BTN_DOWN
-                                  , press_duration  =Parameters.remote_cmd_button_press_duration
-                                  , release_duration=Parameters.remote_cmd_button_release_duration )
-            elif command.startswith('wait '):
-                seconds = float(command.split(' ')[1])
-                logger.info('Waiting {} seconds for channel {}'.format(seconds,channel))
-                time.sleep(seconds)
+        if steps is None:
+            steps = self.get_shutter_commands(shutter,command)
+
+        for (index,step) in enumerate(steps):
+            if index and self._preempted:
+                return self._get_preempted_continuation( channel, self._clock.time(), steps[index:] )
+            if isinstance(step,WaitStep):
+                if index + 1 < len(steps):
+                    logger.info('Waiting {} seconds for channel {}'.format(step.duration,channel))
+                    return ( self._clock.time() + step.duration, steps[index+1:] )
             else:
-                logger.error('Unknown command {}'.format(command))
+                logger.info('Sending channel {} {} order'.format(channel,step.command))
+                self._press_button( *step.buttons
+                                  , press_duration  =Parameters.remote_cmd_button_press_duration
+                                  , release_duration=Parameters.remote_cmd_button_release_duration
+                                  , preemptible=True )
+
+                # Shutters react when the order is sent, at the beginning of
+                # the press
+                self._positions.order( shutter, step.command, self._last_order_date )
+        return None
+
+    def preempt( self, cut_press=False ):
+        # Called from other threads, the running drive returns its remaining
+        # steps once its current step is done. A command press being sent is
+        # cut short too, shutters get their order at the beginning of presses
+        with self._preemption:
+            self._preempted = True
+            self._preemption.notify_all()
+        if cut_press:
+            self._timer.preempt()
+
+    def clear_preemption( self ):
+        with self._preemption:
+            self._preempted = False
+        self._timer.clear_preemption()
+
+    def is_sleeping( self, date ):
+        return date - self._last_btn_press_date > Parameters.remote_sleep_timer_duration - Parameters.remote_sleep_timer_margin
+
+    def wake( self ):
+        # Wake remote ahead of an expected command
+        if self.is_sleeping( self._clock.time() ):
+            self._last_btn_press_date = self._wake()
+            self._predictive_wake_count = self._predictive_wake_count + 1
+
+    def keep_awake( self ):
+        # Return button only moves to the next channel
+        logger.debug('Keeping remote awake')
+        self._invalidate_state()
+        self._press_button( self.BTN_RETURN )
+        self._next_channel()
+        self._keep_awake_press_count = self._keep_awake_press_count + 1
+        self._emit_channel()
+
+    def get_metrics( self ):
+        return { 'wake_count'             : self._wake_count
+               , 'wake_duration'          : self._wake_duration
+               , 'predictive_wake_count'  : self._predictive_wake_count
+               , 'keep_awake_press_count' : self._keep_awake_press_count
+               , 'preempted_drive_count'  : self._preempted_drive_count
+               , 'timing'                 : self._timer.get_metrics() }
+
+    def _sleep_until( self, date ):
+        # Returns False when preempted before date
+        with self._preemption:
+            while not self._preempted:
+                delay = date - self._clock.time()
+                if delay <= 0 or not self._clock.wait(self._preemption,delay):
+                    return True
+            return False
+
+    def _get_preempted_continuation( self, channel, deadline, steps ):
+        logger.info('Preempting channel {} order, its steps are postponed'.format(channel))
+        self._preempted_drive_count = self._preempted_drive_count + 1
+        return ( deadline, steps )
+
+    def _next_channel( self ):
+        self._current_channel_index = self._current_channel_index + 1
+        if self._current_channel_index >= len(self._channel_list):
+            self._current_channel_index = 0
+
+    def _wake( self ):
+        # Returns wake button press date
+        start_date = self._clock.time()
+        if start_date - self._last_btn_press_date < Parameters.remote_sleep_timer_duration:
+            self._clock.sleep(Parameters.remote_sleep_timer_margin)
+        logger.debug('Waking remote from sleep')
+        (press_date,wake_date) = self._timer.press( [ self._buttons[self.BTN_VALIDATE], ]
+                                                  , Parameters.remote_wake_button_press_duration
+                                                  , Parameters.remote_wake_button_release_duration )
+
+        self._wake_count = self._wake_count + 1
+        self._wake_duration = self._wake_duration + self._clock.time() - start_date
+        self._events.emit('remote_awake', { 'remote': self._name })
+        self._schedule_sleep_event(wake_date)
+        return wake_date
+
+    def _schedule_sleep_event( self, press_date ):
+        # Remote falls asleep silently, the event is emitted once its sleep
+        # timer elapsed
+        if self._sleep_timer:
+            self._sleep_timer.cancel()
+        self._sleep_timer = self._clock.call_later( press_date + Parameters.remote_sleep_timer_duration - self._clock.time()
+                                                  , self._events.emit, ('remote_asleep',{ 'remote': self._name }) )
+
+    def _emit_channel( self ):
+        self._events.emit('channel_changed', { 'remote'  : self._name
+                                             , 'channel' : self._channel_list[self._current_channel_index] })
 
     def _press_button( self, *args, **kwargs ):
         # Check if remote is sleeping
-        now = time.time()
-        if now - self._last_btn_press_date > Parameters.remote_sleep_timer_duration - Parameters.remote_sleep_timer_margin:
-            if now - self._last_btn_press_date < Parameters.remote_sleep_timer_duration:
-                time.sleep(Parameters.remote_sleep_timer_margin)
-            logger.debug('Waking remote from sleep')
-            self._buttons[self.BTN_VALIDATE].set(1)
-            time.sleep(Parameters.remote_wake_button_press_duration)
-            self._buttons[self.BTN_VALIDATE].set(0)
-            time.sleep(Parameters.remote_wake_button_release_duration)
+        if self.is_sleeping( self._clock.time() ):
+            self._wake()
 
         press_duration   = Parameters.remote_menu_button_press_duration
         release_duration = Parameters.remote_menu_button_release_duration
@@ -209,11 +593,8 @@ class Remote:
         if 'release_duration' in kwargs:
             release_duration = kwargs['release_duration']
 
-        # Drive buttons
-        for btn in args:
-            self._buttons[btn].set(1)
-        time.sleep(press_duration)
-        for btn in args:
-            self._buttons[btn].set(0)
-        self._last_btn_press_date = time.time()
-        time.sleep(release_duration)
+        # Drive buttons, edges are timed against deadlines
+        (self._last_order_date,self._last_btn_press_date) = self._timer.press( [ self._buttons[btn] for btn in args ]
+                                                                              , press_duration, release_duration
+                                                                              , preemptible=kwargs.get('preemptible',False) )
+        self._schedule_sleep_event(self._last_btn_press_date)
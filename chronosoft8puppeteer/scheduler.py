@@ -1,11 +1,10 @@
 # =============================================================================
 # System imports
-import datetime
 import logging
 
 # =============================================================================
 # Local imports
-from chronosoft8puppeteer import Parameters
+from chronosoft8puppeteer import Parameters,WaitStep
 
 # =============================================================================
 # Logger setup
@@ -13,47 +12,127 @@ logger = logging.getLogger(__name__)
 
 # =============================================================================
 # Classes
+class RemoteState:
+    def __init__(self,date,channel_index,last_press_date):
+        self.date = date
+        self.channel_index = channel_index
+        self.last_press_date = last_press_date
+
+    def copy(self):
+        return RemoteState(self.date,self.channel_index,self.last_press_date)
+
 class Scheduler:
-    def __init__(self,channel_nb):
-        self._command_duration = Parameters.remote_cmd_button_press_duration + Parameters.remote_cmd_button_release_duration
-        self._wake_duration = Parameters.remote_wake_button_press_duration + Parameters.remote_wake_button_release_duration
-        self._change_channel_max_duration = channel_nb * (Parameters.remote_menu_button_press_duration + Parameters.remote_menu_button_release_duration)
-        self._command_max_duration = self._wake_duration + self._change_channel_max_duration + self._command_duration
-
-        self._commands_schedule = list()
-
-    def drive_shutter(self, shutter, commands ):
-        if len(self._scheduled_commands):
-            if can_run_command_before_date( self._scheduled_commands )
-        command['']='aspa'
-        for command in commands:
-            pass
-
-    def schedule_commands(self,commands):
-        now = datetime.datetime.now()
-
-        # Compute commands min date
-        for command in commands:
-            try:
-                delay = command['delay']
-            except:
-                delay = 0
-            command['min_date'] = now + delay
-
-        commands_schedulable = False
-        while commands_schedulable == False:
-            commands_schedulable = True
-            for command in commands:
-                if not self.is_schedulable( command ):
-                    commands_schedulable = False
-                    break
-            
-            if commands_schedulable == False:
-                # Shift min_date
-                for command in commands:
-                    command['min_date'] = command['min_date'] + 1.0
-                    logger.warning('Improve with actual next feasible date')
-
-        # Add commands to schedules commands
-        for command in commands:
-            self._commands_schedule.append()
+    # Predicts when remote presses happen, mirroring Remote timings
+    def __init__(self,remote):
+        self._remote = remote
+
+    # -------------------------------------------------------------------------
+    def get_remote_state(self,date):
+        state = RemoteState( date
+                           , self._remote.get_current_channel_index()
+                           , self._remote.get_last_press_date() )
+        return state
+
+    def estimate(self,commands,state):
+        # Returns (order date, end date) for each (shutter,command) executed
+        # one after the other, state is updated to the remote state after the
+        # last command
+        etas = list()
+        for (shutter,command) in commands:
+            (order_date,end_date,continuation) = self.estimate_command(shutter,command,state)
+            while continuation:
+                (deadline,steps) = continuation
+                (_,end_date,continuation) = self.estimate_command(shutter,command,state,steps,deadline)
+            etas.append( (order_date,end_date) )
+        return etas
+
+    def estimate_duration(self,commands,state):
+        start_date = state.date
+        state = state.copy()
+        self.estimate(commands,state)
+        return state.date - start_date
+
+    def estimate_command(self,shutter,command,state,steps=None,deadline=None):
+        # Estimates a single Remote.drive_shutter call, returns (order date,
+        # end date, continuation) where continuation is the (deadline,steps)
+        # left after a wait step
+        channel = self._remote.get_shutter_channel(shutter)
+        if channel is None:
+            return (state.date,state.date,None)
+
+        self.change_channel(channel,state)
+        if deadline is not None:
+            state.date = max(state.date,deadline)
+
+        if steps is None:
+            steps = self._remote.get_shutter_commands(shutter,command,state.date)
+
+        order_date = None
+        for (index,step) in enumerate(steps):
+            if isinstance(step,WaitStep):
+                if index + 1 < len(steps):
+                    deadline = state.date + step.duration
+                    return (order_date or state.date,state.date,(deadline,steps[index+1:]))
+            else:
+                if order_date is None:
+                    order_date = self._press_date(state)
+                self.press( state
+                          , Parameters.remote_cmd_button_press_duration
+                          , Parameters.remote_cmd_button_release_duration )
+        return (order_date or state.date,state.date,None)
+
+    def estimate_channel_change(self,channel,state):
+        start_date = state.date
+        state = state.copy()
+        self.change_channel(channel,state)
+        return state.date - start_date
+
+    # -------------------------------------------------------------------------
+    def change_channel(self,channel,state):
+        channel_list = self._remote.get_channel_list()
+        if channel not in channel_list:
+            return
+        distance = ( channel_list.index(channel) - state.channel_index ) % len(channel_list)
+        for press in range(distance):
+            self.press(state)
+        state.channel_index = channel_list.index(channel)
+
+    def wake(self,state):
+        # Mirrors Remote.wake
+        if self.is_sleeping(state):
+            state.date = self._press_date(state)
+            state.last_press_date = state.date - Parameters.remote_wake_button_release_duration
+
+    def keep_awake(self,state):
+        # Mirrors Remote.keep_awake
+        self.press(state)
+        state.channel_index = ( state.channel_index + 1 ) % len(self._remote.get_channel_list())
+
+    def is_sleeping(self,state):
+        return state.date - state.last_press_date > Parameters.remote_sleep_timer_duration - Parameters.remote_sleep_timer_margin
+
+    def get_sleep_date(self,state):
+        # Date from which the remote has to be woken up before a press
+        return state.last_press_date + Parameters.remote_sleep_timer_duration - Parameters.remote_sleep_timer_margin
+
+    def press(self,state,press_duration=None,release_duration=None):
+        if press_duration is None:
+            press_duration = Parameters.remote_menu_button_press_duration
+        if release_duration is None:
+            release_duration = Parameters.remote_menu_button_release_duration
+
+        state.date = self._press_date(state)
+        state.date = state.date + press_duration
+        state.last_press_date = state.date
+        state.date = state.date + release_duration
+
+    def _press_date(self,state):
+        # Date at which a button pressed from state is actually driven, after
+        # waking the remote if needed
+        date = state.date
+        if self.is_sleeping(state):
+            if date - state.last_press_date < Parameters.remote_sleep_timer_duration:
+                date = date + Parameters.remote_sleep_timer_margin
+            date = date + Parameters.remote_wake_button_press_duration \
+                        + Parameters.remote_wake_button_release_duration
+        return date
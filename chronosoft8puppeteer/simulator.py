@@ -0,0 +1,129 @@
+# =============================================================================
+# System imports
+import logging
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import Parameters,RecordingBackend
+
+# =============================================================================
+# Logger setup
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Classes
+class Chronosoft8Simulator(RecordingBackend):
+    # Model of the Chronosoft 8 remote driven through its button GPIOs
+    SCREEN_OFF      = 'off'
+    SCREEN_CLOCK    = 'clock'
+    SCREEN_MAIN     = 'main'
+    SCREEN_CHANNELS = 'channels'
+
+    # Validate press duration entering channels configuration
+    LONG_PRESS_DURATION = 2.0
+
+    def __init__(self,clock=None,enabled_channels=(1,)):
+        super().__init__(clock)
+
+        self.screen = self.SCREEN_OFF
+        self.enabled_channels = sorted(enabled_channels)
+        self.current_channel = self.enabled_channels[0]
+        self.last_press_date = None
+
+        # (press date, channel, order) of orders sent to shutters
+        self.orders = list()
+        # (date, description) of presses not doing what the remote expects
+        self.errors = list()
+
+        self._held = dict()
+        self._chord = set()
+        self._chord_date = None
+        self._menu_channel = None
+        self._menu_channels = None
+
+    # -------------------------------------------------------------------------
+    def is_sleeping(self,date):
+        return self.last_press_date is None \
+            or date - self.last_press_date > Parameters.remote_sleep_timer_duration
+
+    def get_state(self):
+        return { 'screen'           : self.screen
+               , 'enabled_channels' : list(self.enabled_channels)
+               , 'current_channel'  : self.current_channel
+               , 'last_press_date'  : self.last_press_date }
+
+    # -------------------------------------------------------------------------
+    def on_output(self,date,name,value):
+        name = name.lower()
+        if name == 'power':
+            self._on_power(date,value)
+        elif value:
+            self._held[name] = date
+            if len(self._chord) == 0:
+                self._chord_date = date
+            self._chord.add(name)
+        elif name in self._held:
+            del self._held[name]
+            # Buttons pressed together are handled once all are released
+            if len(self._held) == 0:
+                self._on_press(date,frozenset(self._chord),date - self._chord_date)
+                self._chord = set()
+
+    def _on_power(self,date,value):
+        if value and self.screen == self.SCREEN_OFF:
+            logger.debug('Simulated remote powered up')
+            self.screen = self.SCREEN_CLOCK
+            self.last_press_date = date
+        elif not value:
+            self.screen = self.SCREEN_OFF
+
+    def _on_press(self,date,buttons,duration):
+        if self.screen == self.SCREEN_OFF:
+            return
+
+        # First press only wakes the remote up
+        sleeping = self.is_sleeping(date - duration)
+        self.last_press_date = date
+        if sleeping:
+            if buttons != { 'validate' }:
+                self.errors.append( ( date, 'press {} while sleeping'.format('+'.join(sorted(buttons))) ) )
+            return
+
+        if self.screen == self.SCREEN_CLOCK:
+            if buttons == { 'return' }:
+                self.screen = self.SCREEN_MAIN
+        elif self.screen == self.SCREEN_MAIN:
+            self._on_main_press(date,buttons,duration)
+        elif self.screen == self.SCREEN_CHANNELS:
+            self._on_channels_press(date,buttons)
+
+    def _on_main_press(self,date,buttons,duration):
+        if buttons == { 'return' }:
+            index = self.enabled_channels.index(self.current_channel) + 1
+            self.current_channel = self.enabled_channels[index % len(self.enabled_channels)]
+        elif buttons == { 'validate' } and duration >= self.LONG_PRESS_DURATION:
+            self.screen = self.SCREEN_CHANNELS
+            self._menu_channel = 1
+            self._menu_channels = set(self.enabled_channels)
+        elif buttons == { 'stop', 'down' }:
+            self.orders.append( ( date - duration, self.current_channel, 'int' ) )
+        elif len(buttons) == 1 and next(iter(buttons)) in ( 'up', 'stop', 'down' ):
+            self.orders.append( ( date - duration, self.current_channel, next(iter(buttons)) ) )
+        else:
+            self.errors.append( ( date, 'unexpected {} press on main screen'.format('+'.join(sorted(buttons))) ) )
+
+    def _on_channels_press(self,date,buttons):
+        if buttons == { 'up' }:
+            self._menu_channels.add(self._menu_channel)
+        elif buttons == { 'down' }:
+            # First channel can't be disabled
+            if self._menu_channel != 1:
+                self._menu_channels.discard(self._menu_channel)
+        elif buttons == { 'validate' }:
+            self._menu_channel = self._menu_channel + 1
+            if self._menu_channel > 8:
+                self.enabled_channels = sorted(self._menu_channels)
+                self.current_channel = self.enabled_channels[0]
+                self.screen = self.SCREEN_MAIN
+        else:
+            self.errors.append( ( date, 'unexpected {} press in channels menu'.format('+'.join(sorted(buttons))) ) )
@@ -0,0 +1,75 @@
+# =============================================================================
+# System imports
+import collections
+import logging
+
+# =============================================================================
+# Logger setup
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Globals
+# Buttons pressed together to send each order
+command_buttons = { 'up'   : ( 'up', )
+                  , 'down' : ( 'down', )
+                  , 'stop' : ( 'stop', )
+                  , 'int'  : ( 'stop', 'down' ) }
+
+# =============================================================================
+# Functions
+def make_press(command):
+    return PressStep(command,command_buttons[command])
+
+def make_wait(duration):
+    return WaitStep(max(0.0,float(duration)))
+
+def compile_steps(steps):
+    # Returns the steps of an override, given as strings, as a tuple of press
+    # and wait steps, raises ValueError if they can't be executed
+    if not isinstance(steps,list) or len(steps) == 0:
+        raise ValueError('Override must be a non empty list of steps')
+
+    compiled = list()
+    for step in steps:
+        if not isinstance(step,str):
+            raise ValueError('Invalid step {!r}'.format(step))
+        if step in command_buttons:
+            compiled.append(make_press(step))
+        elif step.startswith('wait '):
+            try:
+                duration = float(step.split(' ',1)[1])
+            except ValueError:
+                raise ValueError('Invalid wait duration in step "{}"'.format(step))
+            if not duration >= 0:
+                raise ValueError('Invalid wait duration in step "{}"'.format(step))
+            compiled.append(make_wait(duration))
+        else:
+            raise ValueError('Unknown step "{}"'.format(step))
+
+    if isinstance(compiled[-1],WaitStep):
+        raise ValueError('Override can\'t end with a wait step')
+    return tuple(compiled)
+
+def compile_shutter(shutter):
+    # Returns the steps of each command of a shutter configuration
+    plans = { command: ( make_press(command), ) for command in command_buttons }
+    for (command,steps) in shutter.get('override',dict()).items():
+        if command not in command_buttons:
+            raise ValueError('Override of unknown command "{}" for shutter {}'.format(command,shutter['name']))
+        try:
+            plans[command] = compile_steps(steps)
+        except ValueError as e:
+            raise ValueError('Invalid {} override of shutter {}: {}'.format(command,shutter['name'],e))
+    return plans
+
+# =============================================================================
+# Classes
+class PressStep(collections.namedtuple('PressStep',('command','buttons'))):
+    # Order sent by pressing buttons together
+    def __str__(self):
+        return self.command
+
+class WaitStep(collections.namedtuple('WaitStep',('duration',))):
+    # Delay before the next steps, other channels are served meanwhile
+    def __str__(self):
+        return 'wait {:g}'.format(self.duration)
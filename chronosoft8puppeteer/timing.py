@@ -0,0 +1,133 @@
+# =============================================================================
+# System imports
+import bisect
+import logging
+import threading
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import Clock,Parameters
+
+# =============================================================================
+# Logger setup
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Classes
+class Histogram:
+    # Counts of values (seconds) below each bound, the last count is for
+    # values above all bounds
+    BOUNDS = ( 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1 )
+
+    def __init__(self,bounds=None):
+        self._bounds = tuple(bounds or self.BOUNDS)
+        self._counts = [ 0 ] * ( len(self._bounds) + 1 )
+        self._count = 0
+        self._total = 0.0
+        self._max = None
+
+    def add(self,value):
+        self._counts[ bisect.bisect_left(self._bounds,value) ] += 1
+        self._count = self._count + 1
+        self._total = self._total + value
+        self._max = value if self._max is None else max(self._max,value)
+
+    def get(self):
+        return { 'bounds' : list(self._bounds)
+               , 'counts' : list(self._counts)
+               , 'count'  : self._count
+               , 'mean'   : self._total / self._count if self._count else None
+               , 'max'    : self._max }
+
+class PressTimer:
+    # Drives button edges at absolute monotonic deadlines. Presses following
+    # each other are chained on their planned deadlines, so time lost between
+    # presses is caught up instead of accumulating, and the delay of every
+    # edge after its deadline is recorded. Preemptible presses are released
+    # early when preempted, once held for the minimum duration
+    def __init__(self,clock=None):
+        self._clock = clock or Clock()
+        self._next_deadline = None
+        self._press_jitter = Histogram()
+        self._release_jitter = Histogram()
+        self._preemption = threading.Condition()
+        self._preempted = False
+        self._preempted_count = 0
+
+        # (press,release) edges delay of the last press, release is None when
+        # it was preempted
+        self.last_jitter = None
+
+    # -------------------------------------------------------------------------
+    def press(self,buttons,press_duration,release_duration,on_press=None,preemptible=False):
+        # Returns the wall clock (press,release) dates of buttons edges once
+        # the release duration elapsed, on_press is called with the press date
+        # right after the press edge
+        now = self._clock.monotonic()
+        deadline = now
+        if self._next_deadline is not None and 0 <= now - self._next_deadline <= Parameters.timing_drift_tolerance:
+            deadline = self._next_deadline
+
+        for button in buttons:
+            button.set(1)
+        pressed = self._clock.monotonic()
+        press_date = self._clock.time()
+        press_jitter = pressed - deadline
+        self._press_jitter.add(press_jitter)
+        if on_press:
+            on_press(press_date)
+
+        # Catching up never shortens a press or a release too much
+        deadline = max( deadline + press_duration, pressed + press_duration * Parameters.timing_min_duration_ratio )
+        if preemptible:
+            preempted = self._sleep_preemptible( deadline, pressed + Parameters.remote_cmd_button_min_press_duration )
+        else:
+            preempted = False
+            self._clock.sleep_until(deadline)
+        for button in buttons:
+            button.set(0)
+        released = self._clock.monotonic()
+        release_date = self._clock.time()
+        if preempted:
+            self._preempted_count = self._preempted_count + 1
+            self.last_jitter = ( press_jitter, None )
+            deadline = released
+        else:
+            self._release_jitter.add( released - deadline )
+            self.last_jitter = ( press_jitter, released - deadline )
+
+        self._next_deadline = max( deadline + release_duration, released + release_duration * Parameters.timing_min_duration_ratio )
+        self._clock.sleep_until(self._next_deadline)
+        return (press_date,release_date)
+
+    def preempt(self):
+        # Called from other threads, preemptible presses are released early
+        # until preemption is cleared
+        with self._preemption:
+            self._preempted = True
+            self._preemption.notify_all()
+
+    def clear_preemption(self):
+        with self._preemption:
+            self._preempted = False
+
+    def get_metrics(self):
+        return { 'press_jitter'    : self._press_jitter.get()
+               , 'release_jitter'  : self._release_jitter.get()
+               , 'preempted_count' : self._preempted_count }
+
+    # -------------------------------------------------------------------------
+    def _sleep_preemptible(self,deadline,min_deadline):
+        # Returns whether preempted before deadline, preemption is only
+        # checked from min deadline. Last moments are spent polling as
+        # waiting on a condition may overshoot
+        self._clock.sleep_until( min(deadline,min_deadline) )
+        with self._preemption:
+            while not self._preempted:
+                remaining = deadline - self._clock.monotonic() - self._clock.SPIN_DURATION
+                if remaining <= 0 or not self._clock.wait(self._preemption,remaining):
+                    break
+            if self._preempted:
+                return True
+        self._clock.sleep_until(deadline)
+        return False
@@ -0,0 +1,156 @@
+# =============================================================================
+# System imports
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+# =============================================================================
+# Logger setup
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Classes
+class ConfigWatcher:
+    # Calls back when watched files change, using inotify when available and
+    # polling files otherwise. Callbacks are called from the watcher thread
+    # once files stopped changing for the debounce delay
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self,poll_period=2.0,debounce=0.5):
+        self._poll_period = poll_period
+        self._debounce = debounce
+        self._callbacks = dict()
+        self._signatures = dict()
+        self._thread = None
+        self._stop_pipe = None
+
+    # -------------------------------------------------------------------------
+    def add(self,file,callback):
+        file = os.path.realpath(file)
+        self._callbacks[file] = callback
+        self._signatures[file] = self._get_signature(file)
+
+    def start(self):
+        if len(self._callbacks) == 0:
+            return
+        self._stop_pipe = os.pipe()
+        inotify = self._init_inotify()
+        if inotify is not None:
+            logger.info('Watching %d config files with inotify',len(self._callbacks))
+            target = lambda: self._run_inotify(*inotify)
+        else:
+            logger.info('Polling %d config files every %.1f s',len(self._callbacks),self._poll_period)
+            target = self._run_polling
+        self._thread = threading.Thread(target=target,name='config-watcher',daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        os.write(self._stop_pipe[1],b'\0')
+        self._thread.join()
+        self._thread = None
+        for fd in self._stop_pipe:
+            os.close(fd)
+
+    # -------------------------------------------------------------------------
+    def _init_inotify(self):
+        # Returns (inotify fd, directories by watch descriptor), None if
+        # inotify isn't available. Directories are watched as files are
+        # usually replaced when saved
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError,AttributeError):
+            return None
+        if fd < 0:
+            logger.warning('Failed to initialize inotify: %s',os.strerror(ctypes.get_errno()))
+            return None
+
+        directories = dict()
+        for directory in set( os.path.dirname(file) for file in self._callbacks ):
+            wd = libc.inotify_add_watch( fd, os.fsencode(directory)
+                                       , self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE )
+            if wd < 0:
+                logger.warning('Failed to watch %s: %s',directory,os.strerror(ctypes.get_errno()))
+                os.close(fd)
+                return None
+            directories[wd] = directory
+        return (fd,directories)
+
+    def _run_inotify(self,fd,directories):
+        # Changed files by date of their last event
+        changes = dict()
+        try:
+            while True:
+                timeout = None
+                if len(changes):
+                    timeout = max( 0, min(changes.values()) + self._debounce - time.monotonic() )
+                (readable,_,_) = select.select( [ fd, self._stop_pipe[0] ], [], [], timeout )
+                if self._stop_pipe[0] in readable:
+                    break
+                if fd in readable:
+                    for file in self._read_events(fd,directories):
+                        if file in self._callbacks:
+                            changes[file] = time.monotonic()
+
+                now = time.monotonic()
+                for (file,date) in list(changes.items()):
+                    if now - date >= self._debounce:
+                        del changes[file]
+                        self._check(file)
+        finally:
+            os.close(fd)
+
+    def _read_events(self,fd,directories):
+        try:
+            data = os.read(fd,65536)
+        except BlockingIOError:
+            return list()
+        files = list()
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            (wd,mask,cookie,length) = self.EVENT_HEADER.unpack_from(data,offset)
+            offset = offset + self.EVENT_HEADER.size
+            name = data[offset:offset+length].rstrip(b'\0')
+            offset = offset + length
+            if wd in directories and name:
+                files.append( os.path.join(directories[wd],os.fsdecode(name)) )
+        return files
+
+    def _run_polling(self):
+        while True:
+            (readable,_,_) = select.select( [ self._stop_pipe[0] ], [], [], self._poll_period )
+            if readable:
+                break
+            for file in list(self._callbacks):
+                self._check(file)
+
+    # -------------------------------------------------------------------------
+    def _check(self,file):
+        # Files are only reloaded when their content may have changed
+        signature = self._get_signature(file)
+        if signature is None or signature == self._signatures.get(file):
+            return
+        self._signatures[file] = signature
+        logger.info('Config file %s changed, reloading',file)
+        try:
+            self._callbacks[file]()
+        except:
+            logger.exception('Failed to reload config file %s',file)
+
+    def _get_signature(self,file):
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None
+        return (stat.st_ino,stat.st_mtime_ns,stat.st_size)
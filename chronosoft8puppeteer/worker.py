@@ -0,0 +1,323 @@
+# =============================================================================
+# System imports
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import Clock,GPIO,GPIOBackend,Histogram,PressTimer,RecordingBackend,RPiGPIOBackend
+
+# =============================================================================
+# Logger setup
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Functions
+def run_worker(connection,backend_name,cpus,priority,heartbeat_period):
+    # Worker process main loop, messages are tuples whose first item is their
+    # kind. Workers send heartbeats, presses included, and exit with their
+    # parent
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+    parent_pid = os.getppid()
+    send_lock = threading.Lock()
+    def send(*message):
+        with send_lock:
+            connection.send(message)
+
+    for (level,message) in _set_realtime(cpus,priority):
+        send('log',level,message)
+
+    backend = RPiGPIOBackend() if backend_name == 'rpi' else RecordingBackend()
+    timer = PressTimer(Clock())
+    gpios = dict()
+    messages = queue.Queue()
+    threading.Thread(target=_receive,args=(connection,timer,messages),daemon=True).start()
+    send('started',os.getpid())
+    threading.Thread(target=_send_heartbeats,args=(send,messages,parent_pid,heartbeat_period),daemon=True).start()
+    while True:
+        message = messages.get()
+        kind = message[0]
+        if kind == 'setup':
+            (_,name,channel,inout,active_high,physical_value) = message
+            default_value = 1 if ( physical_value == GPIOBackend.HIGH ) == active_high else 0
+            gpios[channel] = GPIO(name,channel,inout,default_value,active_high,backend=backend)
+        elif kind == 'output':
+            (_,channel,physical_value) = message
+            backend.output(gpios[channel],physical_value)
+        elif kind == 'cleanup':
+            del gpios[message[1]]
+        elif kind == 'press':
+            # Press is acknowledged on its edge, parent knows whether it was
+            # sent if the worker dies before releasing
+            (_,request,channels,press_duration,release_duration,preemptible) = message
+            (press_date,release_date) = timer.press( [ gpios[channel] for channel in channels ]
+                                                   , press_duration, release_duration
+                                                   , on_press=lambda date: send('pressed',request,date)
+                                                   , preemptible=preemptible )
+            send('done',request,press_date,release_date,timer.last_jitter)
+        elif kind == 'stop':
+            break
+
+def _receive(connection,timer,messages):
+    # Preemptions are applied as they are received as presses block the main
+    # loop, other messages are queued for it
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError,OSError):
+            messages.put( ('stop',) )
+            break
+        if message[0] == 'preempt':
+            timer.preempt()
+        elif message[0] == 'clear_preemption':
+            timer.clear_preemption()
+        else:
+            messages.put(message)
+
+def _send_heartbeats(send,messages,parent_pid,heartbeat_period):
+    # Heartbeats have their own thread as presses block the main loop, it
+    # stops the worker once its parent is gone
+    while os.getppid() == parent_pid:
+        try:
+            send('heartbeat')
+        except OSError:
+            break
+        time.sleep(heartbeat_period)
+    messages.put( ('stop',) )
+
+def _set_realtime(cpus,priority):
+    # Returns (level,message) of settings which couldn't be applied, they
+    # usually require privileges
+    messages = list()
+    if cpus is not None:
+        try:
+            os.sched_setaffinity(0,cpus)
+        except (AttributeError,OSError) as e:
+            messages.append( ( logging.WARNING, 'Failed to set GPIO worker CPU affinity to {}: {}'.format(cpus,e) ) )
+    if priority is not None:
+        try:
+            os.sched_setscheduler(0,os.SCHED_FIFO,os.sched_param(priority))
+        except (AttributeError,OSError) as e:
+            messages.append( ( logging.WARNING, 'Failed to set GPIO worker SCHED_FIFO priority {}: {}'.format(priority,e) ) )
+    return messages
+
+# =============================================================================
+# Classes
+class GPIOWorker(GPIOBackend):
+    # GPIO backend and press timer driving GPIOs from a child process, so
+    # presses are timed away from the parent threads and optionally with a
+    # dedicated CPU and real time priority. Setups and outputs are forwarded
+    # over a pipe, presses are sent whole and acknowledged on their edges,
+    # preemptions are forwarded while they are sent.
+    # Workers missing heartbeats are respawned with the last GPIO states
+    def __init__(self,backend='rpi',cpus=None,priority=None,heartbeat_period=0.5,heartbeat_timeout=5.0):
+        super().__init__()
+        if backend not in ('rpi','recording'):
+            raise ValueError('GPIO backend {} can\'t run in a worker'.format(backend))
+        self._options = { 'backend'           : backend
+                        , 'cpus'              : None if cpus is None else list(cpus)
+                        , 'priority'          : priority
+                        , 'heartbeat_period'  : heartbeat_period
+                        , 'heartbeat_timeout' : heartbeat_timeout }
+        self._context = multiprocessing.get_context('spawn')
+
+        # Setup and last physical value by channel, replayed on respawn
+        self._setups = dict()
+        self._outputs = dict()
+
+        self._process = None
+        self._connection = None
+        self._send_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._replies = dict()
+        self._requests = itertools.count()
+        self._generation = 0
+        self._last_message = None
+        self._started = threading.Event()
+        self._stopping = False
+
+        # Metrics
+        self._pid = None
+        self._respawn_count = 0
+        self._retry_count = 0
+        self._preempted_count = 0
+        self._press_jitter = Histogram()
+        self._release_jitter = Histogram()
+
+        self._spawn()
+        self._thread = threading.Thread(target=self._run,name='gpio-worker',daemon=True)
+        self._thread.start()
+
+        # Worker failing to start is a configuration error, it isn't respawned
+        # until it started once
+        if not self._started.wait(heartbeat_timeout):
+            self.stop()
+            raise RuntimeError('GPIO worker failed to start')
+
+    def get_options(self):
+        return self._options
+
+    def stop(self):
+        with self._send_lock:
+            self._stopping = True
+            self._send_unlocked('stop')
+        self._thread.join()
+        self._process.join(self._options['heartbeat_timeout'])
+        if self._process.is_alive():
+            self._process.kill()
+        self._connection.close()
+        with self._condition:
+            self._condition.notify_all()
+
+    # -------------------------------------------------------------------------
+    def setup(self,gpio,initial_state):
+        with self._send_lock:
+            self._setups[gpio.get_channel()] = ( gpio.get_name(), gpio.get_channel(), gpio.get_inout(), gpio.is_active_high() )
+            self._outputs[gpio.get_channel()] = initial_state
+            self._send_unlocked( 'setup', *self._setups[gpio.get_channel()], initial_state )
+
+    def output(self,gpio,physical_value):
+        with self._send_lock:
+            self._outputs[gpio.get_channel()] = physical_value
+            self._send_unlocked( 'output', gpio.get_channel(), physical_value )
+
+    def cleanup(self,gpio):
+        with self._send_lock:
+            del self._setups[gpio.get_channel()]
+            del self._outputs[gpio.get_channel()]
+            self._send_unlocked( 'cleanup', gpio.get_channel() )
+
+    # -------------------------------------------------------------------------
+    def press(self,buttons,press_duration,release_duration,preemptible=False):
+        # Same as PressTimer.press, the press is sent again when the worker
+        # died before its edge. Buttons are released by the respawned worker
+        # otherwise
+        channels = [ button.get_channel() for button in buttons ]
+        with self._condition:
+            while True:
+                if self._stopping:
+                    raise RuntimeError('GPIO worker stopped')
+                request = next(self._requests)
+                with self._send_lock:
+                    generation = self._generation
+                    self._send_unlocked( 'press', request, channels, press_duration, release_duration, preemptible )
+                while self._generation == generation and self._replies.get(request,('',))[0] != 'done':
+                    self._condition.wait()
+
+                reply = self._replies.pop(request,None)
+                if reply is None:
+                    logger.warning('GPIO worker died before pressing, pressing again')
+                    self._retry_count = self._retry_count + 1
+                    continue
+                if reply[0] == 'pressed':
+                    logger.warning('GPIO worker died while pressing')
+                    return (reply[2],time.time())
+
+                (_,_,press_date,release_date,(press_jitter,release_jitter)) = reply
+                self._press_jitter.add(press_jitter)
+                if release_jitter is None:
+                    self._preempted_count = self._preempted_count + 1
+                else:
+                    self._release_jitter.add(release_jitter)
+                return (press_date,release_date)
+
+    def preempt(self):
+        self._send('preempt')
+
+    def clear_preemption(self):
+        self._send('clear_preemption')
+
+    def get_metrics(self):
+        return { 'press_jitter'    : self._press_jitter.get()
+               , 'release_jitter'  : self._release_jitter.get()
+               , 'preempted_count' : self._preempted_count
+               , 'worker'          : { 'pid'           : self._pid
+                                    , 'respawn_count' : self._respawn_count
+                                    , 'retry_count'   : self._retry_count } }
+
+    # -------------------------------------------------------------------------
+    def _spawn(self):
+        # Called holding the send lock, except on creation
+        (self._connection,child_connection) = self._context.Pipe()
+        self._process = self._context.Process( target=run_worker
+                                             , args=( child_connection
+                                                    , self._options['backend']
+                                                    , self._options['cpus']
+                                                    , self._options['priority']
+                                                    , self._options['heartbeat_period'] )
+                                             , name='gpio-worker'
+                                             , daemon=True )
+        self._process.start()
+        child_connection.close()
+        self._last_message = time.monotonic()
+        for (channel,setup) in self._setups.items():
+            self._send_unlocked( 'setup', *setup, self._outputs[channel] )
+
+    def _respawn(self,reason):
+        with self._send_lock:
+            # Workers exit once stopping
+            if self._stopping:
+                return
+            logger.error('GPIO worker %s, respawning it',reason)
+            if self._process.is_alive():
+                self._process.kill()
+            self._process.join()
+            self._connection.close()
+            self._spawn()
+            self._generation = self._generation + 1
+        self._respawn_count = self._respawn_count + 1
+
+        # Presses in flight are resolved by their callers
+        with self._condition:
+            self._condition.notify_all()
+
+    def _run(self):
+        # Receives worker messages and checks its heartbeats
+        while not self._stopping:
+            try:
+                if self._connection.poll(self._options['heartbeat_period']):
+                    self._handle(self._connection.recv())
+                    self._last_message = time.monotonic()
+            except (EOFError,OSError):
+                if not self._stopping and self._started.is_set():
+                    self._respawn('exited')
+                else:
+                    time.sleep(self._options['heartbeat_period'])
+                continue
+
+            if self._stopping or not self._started.is_set():
+                continue
+            if not self._process.is_alive():
+                self._respawn('exited')
+            elif time.monotonic() - self._last_message > self._options['heartbeat_timeout']:
+                self._respawn('missed heartbeats')
+
+    def _handle(self,message):
+        kind = message[0]
+        if kind in ('pressed','done'):
+            with self._condition:
+                self._replies[message[1]] = message
+                self._condition.notify_all()
+        elif kind == 'started':
+            self._pid = message[1]
+            self._started.set()
+            logger.info('GPIO worker started with pid %d',self._pid)
+        elif kind == 'log':
+            logger.log(message[1],message[2])
+
+    def _send(self,*message):
+        with self._send_lock:
+            self._send_unlocked(*message)
+
+    def _send_unlocked(self,*message):
+        # Lost messages are replayed or resolved once the worker is respawned
+        try:
+            self._connection.send(message)
+        except OSError:
+            pass
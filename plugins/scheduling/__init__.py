@@ -1,13 +1,20 @@
 # =============================================================================
 # System imports
-import astral
-import astral.sun
+import collections
 import datetime
 import json
 import logging
 import os
+import random
+import shutil
+import tempfile
 import threading
 
+# =============================================================================
+# Local imports
+from .suntable import SunTable
+from .triggers import TriggerCalendar,set_sun_table,sun_tables
+
 # =============================================================================
 # Logger setup
 logger = logging.getLogger(__name__)
@@ -19,12 +26,42 @@ logger = logging.getLogger(__name__)
 run_dir = os.path.dirname(os.path.realpath(__file__))
 location_config_file = os.path.join(run_dir,'config','location.json')
 programs_config_file = os.path.join(run_dir,'config','programs.json')
-weekdays = ('mon','tue','wed','thu','fri','sat','sun')
+journal_file = os.path.join(run_dir,'config','journal.json')
+
+# Number of days for which program executions are scheduled ahead
+calendar_days = 7
+
+# Catch up policies of executions missed while stopped or on clock jumps,
+# programs may also give a delay in minutes within which they are still run
+CATCH_UP_SKIP   = 'skip'
+CATCH_UP_ALWAYS = 'always'
+catch_up_horizon = 86400
+
+# Programs due within this delay (seconds) are run together
+batch_window = 2.0
+
+# Wall clock jumps detection period and tolerance (seconds)
+clock_check_period = 60
+clock_jump_threshold = 30
 
 cs8p = None
-location_info = None
+calendar = None
 programs_config = None
-timers = list()
+
+# Pending executions as (date,timer,program) lists by program name, timers run
+# on the clock timer thread
+scheduled_programs = dict()
+day_timer = None
+schedule_lock = threading.RLock()
+
+# Date of the last execution by program name
+journal = dict()
+clock_timer = None
+clock_reference = None
+
+# Last executed programs
+history = collections.deque(maxlen=100)
+history_lock = threading.Lock()
 
 # =============================================================================
 # Functions
@@ -37,32 +74,111 @@ def init_plugin(cs8p_):
     load_config()
 
 def load_config():
-    global location_info,programs_config
+    global calendar,programs_config
+
+    location = load_location()
+    if location:
+        calendar = TriggerCalendar(location,calendar_days)
+        load_sun_tables()
+
+    load_journal()
 
-    # Load location configuration
+    programs_config = load_programs()
+
+def load_location():
+    # Returns (latitude,longitude) or None if the config file is invalid
     try:
         location_config = json.load(open(location_config_file))
     except:
         logger.exception('Failed to load location config file %s',location_config_file)
+        return None
+
+    # Check config file
+    if 'location' not in location_config:
+        logger.error('Missing location entry in config file %s',location_config)
+    elif 'latitude' not in location_config['location'] or 'longitude' not in location_config['location']:
+        logger.error('Missing latitude and/or longitude entry in config file %s',location_config)
     else:
-        # Check config file
-        if 'location' not in location_config:
-            logger.error('Missing location entry in config file %s',location_config)
-        elif 'latitude' not in location_config['location'] or 'longitude' not in location_config['location']:
-            logger.error('Missing latitude and/or longitude entry in config file %s',location_config)
-        else:
-            latitude  = float(location_config['location']['latitude'])
-            longitude = float(location_config['location']['longitude'])
-            location_info = astral.LocationInfo('Name','Region',"Time zone",latitude,longitude)
+        latitude  = float(location_config['location']['latitude'])
+        longitude = float(location_config['location']['longitude'])
+        return (latitude,longitude)
+    return None
 
-    # Load programs
+def load_programs():
     try:
-        programs_config = json.load(open(programs_config_file))
+        config = json.load(open(programs_config_file))
     except:
         logger.exception('Failed to load config file %s',programs_config_file)
+        return None
+    if 'programs' not in config:
+        logger.error('Missing programs entry in config file %s',programs_config_file)
+        return None
+    return config
+
+def get_config_files():
+    # Config files reloaded by the puppeteer when they change
+    return [ ( location_config_file, reload_location )
+           , ( programs_config_file, reload_programs ) ]
+
+def reload_location():
+    # Every execution depends on the location through sun events
+    global calendar
+
+    location = load_location()
+    if location is None or ( calendar and location == calendar.get_location() ):
+        return
+    logger.info('Location changed, rescheduling programs')
+    with schedule_lock:
+        calendar = TriggerCalendar(location,calendar_days)
+        sun_tables.clear()
+        load_sun_tables()
+    schedule()
+
+def reload_programs():
+    global programs_config
+
+    config = load_programs()
+    if config is None or config['programs'] == get_programs():
+        return
+    logger.info('Programs changed, rescheduling changed programs')
+    with schedule_lock:
+        first_load = programs_config is None
+        if first_load:
+            programs_config = config
+        else:
+            apply_programs(config['programs'])
+    if first_load:
+        schedule()
     else:
-        if 'programs' not in programs_config:
-            logger.error('Missing programs entry in config file %s',programs_config_file)
+        cs8p.notify_activity()
+    cs8p.emit_event('programs_changed')
+
+def load_sun_tables():
+    # Yearly sun events tables of the calendar days, saved next to the
+    # location config file, astral is used without numpy
+    if calendar is None or not SunTable.is_available():
+        return
+    today = cs8p.get_clock().now().date()
+    for year in ( today.year, ( today + datetime.timedelta(days=calendar_days) ).year ):
+        if year not in sun_tables:
+            set_sun_table( SunTable.get(os.path.dirname(location_config_file),year,calendar.get_location()) )
+
+def load_journal():
+    try:
+        journal.update( json.load(open(journal_file)) )
+    except FileNotFoundError:
+        pass
+    except:
+        logger.exception('Failed to load journal file %s',journal_file)
+
+def save_journal():
+    try:
+        tmp_file = journal_file + '.tmp'
+        with open(tmp_file,'w') as f:
+            json.dump(journal,f,indent=4)
+        os.replace(tmp_file,journal_file)
+    except:
+        logger.exception('Failed to save journal file %s',journal_file)
 
 def start_plugin():
     logger.info('Starting scheduling plugin')
@@ -70,13 +186,21 @@ def start_plugin():
     schedule()
 
 def stop_plugin():
-    global timers
-
     logger.info('Stopping scheduling plugin')
 
-    for timer in timers:
-        timer.cancel()
-    timers.clear()
+    with schedule_lock:
+        unschedule()
+
+    cs8p.notify_activity()
+
+def get_next_command_date():
+    now = cs8p.get_clock().time()
+    with schedule_lock:
+        dates = [ date for entries in scheduled_programs.values()
+                       for (date,timer,program) in entries if date >= now ]
+    if len(dates) == 0:
+        return None
+    return min(dates)
 
 def get_programs():
     if programs_config is None or 'programs' not in programs_config:
@@ -84,65 +208,329 @@ def get_programs():
     return programs_config['programs']
 
 def set_programs(programs):
+    with schedule_lock:
+        apply_programs(programs)
+
+        # Programs file is replaced at once as it is watched for changes,
+        # concurrent calls write it in the order they applied programs
+        (fd,tmp_file) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(programs_config_file)),suffix='.tmp')
+        try:
+            with os.fdopen(fd,'w') as f:
+                json.dump({'programs':programs},f,indent=4)
+            if os.path.exists(programs_config_file):
+                shutil.copymode(programs_config_file,tmp_file)
+            os.replace(tmp_file,programs_config_file)
+        except:
+            os.unlink(tmp_file)
+            raise
+    cs8p.notify_activity()
+
+def apply_programs(programs):
+    # Only programs which changed are rescheduled
+    previous_programs = { program['name']: program for program in programs_config['programs'] }
     programs_config['programs'] = programs
-    schedule()
-    json.dump({'programs':programs},open(programs_config_file,'w'),indent=4)
+    for program in programs:
+        if previous_programs.pop(program['name'],None) != program:
+            schedule_program(program)
+    for name in previous_programs:
+        unschedule_program(name)
+        journal.pop(name,None)
+        if calendar:
+            calendar.remove_program(name)
+
+def get_scheduled_programs():
+    # Pending program executions, soonest first
+    with schedule_lock:
+        scheduled = [ { 'name': name, 'date': date }
+                      for (name,entries) in scheduled_programs.items()
+                      for (date,timer,program) in entries ]
+    scheduled.sort( key=lambda entry: entry['date'] )
+    return scheduled
+
+def get_upcoming_triggers(start,end):
+    # Program executions between start and end timestamps, including days
+    # beyond the scheduled ones
+    if calendar is None:
+        return list()
+    start = datetime.datetime.fromtimestamp(start).astimezone()
+    end   = datetime.datetime.fromtimestamp(end).astimezone()
+    with schedule_lock:
+        triggers = calendar.get_triggers(start,end)
+    return [ { 'name': program['name'], 'date': date.timestamp(), 'action': program['action'] }
+             for (date,program) in triggers ]
 
 def schedule():
-    global timers
+    # Missed executions are run and the puppeteer notified once the lock is
+    # released, as the dispatcher takes it to get the next command date
+    with schedule_lock:
+        unschedule()
+
+        missed = list()
+        if calendar is None or programs_config is None:
+            logger.error('Error while loading config file, plugin won\'t start')
+        else:
+            calendar.set_window(cs8p.get_clock().now().date())
+            for program in programs_config['programs']:
+                schedule_program(program)
+            schedule_next_day()
+            missed = catch_up()
+            schedule_clock_check()
+
+    run_programs(missed)
+    cs8p.notify_activity()
+
+def unschedule():
+    global day_timer,clock_timer
+
+    for name in list(scheduled_programs):
+        unschedule_program(name)
+    for timer in ( day_timer, clock_timer ):
+        if timer:
+            timer.cancel()
+    day_timer = None
+    clock_timer = None
+
+def catch_up():
+    # Returns the last missed execution of each program as (program,date), if
+    # its catch up policy allows it and it didn't already run
+    now = cs8p.get_clock().now().astimezone()
+    missed = dict()
+    for (date,program) in calendar.get_triggers(now - datetime.timedelta(seconds=catch_up_horizon),now):
+        if is_program_late(program,date.timestamp(),now.timestamp()):
+            continue
+        if journal.get(program['name'],0) >= date.timestamp():
+            continue
+        missed[program['name']] = (date,program)
+
+    for (date,program) in missed.values():
+        logger.warning('Catching up program %s missed at %s',program['name'],date.astimezone())
+    return [ (program,date.timestamp()) for (date,program) in missed.values() ]
+
+def get_catch_up_delay(program):
+    # Returns how late (seconds) program can still be run, None if it can't
+    policy = program.get('catch_up',CATCH_UP_SKIP)
+    if policy == CATCH_UP_SKIP:
+        return None
+    elif policy == CATCH_UP_ALWAYS:
+        return catch_up_horizon
+    try:
+        return float(policy) * 60
+    except (TypeError,ValueError):
+        logger.error('Invalid catch up policy "%s" for program %s',policy,program['name'])
+        return None
+
+def is_program_late(program,date,now):
+    delay = now - date
+    if delay <= clock_jump_threshold:
+        return False
+    catch_up_delay = get_catch_up_delay(program)
+    return catch_up_delay is None or delay > catch_up_delay
+
+def schedule_clock_check():
+    global clock_timer,clock_reference
+
+    clock = cs8p.get_clock()
+    clock_reference = ( clock.time(), clock.monotonic() )
+    clock_timer = clock.call_later(clock_check_period,check_clock,monotonic=True)
+
+def check_clock():
+    # Executions are rescheduled when the wall clock jumped, timers would
+    # otherwise fire late (or not at all if the clock went backward). The
+    # check runs on a monotonic timer so it isn't delayed by the jump
+    clock = cs8p.get_clock()
+    with schedule_lock:
+        (date,monotonic) = clock_reference
+        jump = ( clock.time() - date ) - ( clock.monotonic() - monotonic )
+        if abs(jump) <= clock_jump_threshold:
+            schedule_clock_check()
+            return
+    logger.warning('Clock jumped by %.0f s, rescheduling programs',jump)
+    schedule()
 
-    for timer in timers:
+def schedule_next_day():
+    global day_timer
+
+    clock = cs8p.get_clock()
+    now = clock.now()
+    date = now.replace( hour=0, minute=0,second=0,microsecond=0 )
+    tomorrow = date + datetime.timedelta(days=1)
+    delta = tomorrow - now
+    delta_seconds = delta.total_seconds()
+
+    logger.debug('Scheduling calendar update')
+    day_timer = clock.call_later(delta_seconds,update_calendar)
+
+def update_calendar():
+    # Executions of the day entering the calendar are scheduled, others are
+    # already
+    with schedule_lock:
+        load_sun_tables()
+        for (date,program) in calendar.set_window(cs8p.get_clock().now().date()):
+            add_program_timer(program,date)
+        schedule_next_day()
+
+    cs8p.notify_activity()
+
+def schedule_program(program):
+    # Replaces the scheduled executions of program
+    unschedule_program(program['name'])
+    if calendar is None:
+        return
+
+    dates = calendar.set_program(program)
+    if len(dates) == 0:
+        logger.debug('Program %s not scheduled: disabled or no trigger in the next %d days',program['name'],calendar_days)
+    for date in dates:
+        add_program_timer(program,date)
+    cs8p.emit_event( 'program_scheduled', { 'name'  : program['name']
+                                          , 'dates' : [ date for (date,timer,entry) in scheduled_programs.get(program['name'],list()) ] } )
+
+def add_program_timer(program,program_date):
+    clock = cs8p.get_clock()
+    delta_seconds = program_date.timestamp() - clock.time()
+    if delta_seconds < 0:
+        logger.debug('Program %s not scheduled: in the past (date was %s)',program['name'],program_date.astimezone())
+        return
+
+    logger.info('Program %s scheduled at %s',program['name'],program_date.astimezone())
+    date = program_date.timestamp()
+    timer = clock.call_later( delta_seconds, run_program, [program,date] )
+    scheduled_programs.setdefault(program['name'],list()).append( (date,timer,program) )
+
+def unschedule_program(name):
+    for (date,timer,program) in scheduled_programs.pop(name,list()):
         timer.cancel()
-    timers.clear()
 
-    if location_info is None or programs_config is None:
-        logger.error('Error while loading config file, plugin won\'t start')
+def run_program(program, date):
+    # Programs due within the batch window are run along
+    with schedule_lock:
+        remove_program_entry(program['name'],date)
+        triggers = [ (program,date) ]
+        for (name,entries) in list(scheduled_programs.items()):
+            for (entry_date,timer,entry_program) in entries:
+                if entry_date <= date + batch_window:
+                    timer.cancel()
+                    remove_program_entry(name,entry_date)
+                    triggers.append( (entry_program,entry_date) )
+    run_programs(triggers)
+
+def remove_program_entry(name,date):
+    entries = [ entry for entry in scheduled_programs.get(name,list()) if entry[0] != date ]
+    if len(entries):
+        scheduled_programs[name] = entries
     else:
-        current_day = weekdays[datetime.date.today().weekday()]
-        logger.debug('Current days is %s',current_day)
-
-        for program in programs_config['programs']:
-            # Check if enable
-            if program['enable'] is False:
-                logger.debug('Program %s not scheduled: disabled',program['name'])
-                continue
-
-            # Check if program is for today
-            if current_day not in program['days']:
-                logger.debug('Program %s not scheduled: not for today',program['name'])
+        scheduled_programs.pop(name,None)
+
+def run_programs(triggers):
+    now = cs8p.get_clock().time()
+    with schedule_lock:
+        batch = list()
+        for (program,date) in triggers:
+            program_name = program['name']
+
+            # Timers fire late after a wall clock jump, only the last execution
+            # due is run if the catch up policy allows it
+            entries = scheduled_programs.get(program_name,list())
+            if is_program_late(program,date,now) or any( date < entry[0] <= now for entry in entries ):
+                logger.warning('Program %s not run: late (date was %s)',program_name,datetime.datetime.fromtimestamp(date))
                 continue
 
-            # Check if program is in the future
-            program_date = get_program_date(program['trigger'])
-            now = datetime.datetime.now(program_date.tzinfo)
-            delta = program_date - now
-            delta_seconds = delta.total_seconds()
-            if delta_seconds < 0:
-                logger.debug('Program %s not scheduled: in the past (date was %s)',program['name'],program_date.astimezone())
+            # Executions are journaled so that none is run twice
+            if journal.get(program_name,0) >= date:
+                logger.info('Program %s already run',program_name)
                 continue
-
-            # Schedule program
-            logger.info('Program %s scheduled at %s',program['name'],program_date.astimezone())
-            timer = threading.Timer(delta_seconds,execute_command, [program['name'],program['shutters'],get_program_command(program['action'])] )
-            timer.start()
-            timers.append( timer )
-
-        # Schedule next day scheduling
-        now = datetime.datetime.now()
-        date = now.replace( hour=0, minute=1,second=0,microsecond=0 )
-        tomorrow = date + datetime.timedelta(days=1)
-        delta = tomorrow - now
-        delta_seconds = delta.total_seconds()
-
-        logger.info('Scheduling next day scheduling')
-        timer = threading.Timer(delta_seconds,schedule)
-        timer.start()
-        timers.append( timer )
-
-def execute_command(program_name, shutters, command):
-    logger.info('Running %s for shutters %s with command %s',program_name,shutters,command)
-    for shutter in shutters:
-        cs8p.drive_shutter( shutter, command )
+            journal[program_name] = date
+            batch.append( (program,date) )
+
+        if len(batch) == 0:
+            return
+        save_journal()
+
+    execute_batch(batch)
+
+def execute_batch(triggers):
+    # Each shutter is driven once, by the program with the highest priority
+    # (the latest one on equal priorities)
+    triggers.sort( key=lambda trigger: ( trigger[0].get('priority',0), trigger[1] ) )
+    drivers = dict()
+    for (program,date) in triggers:
+        for shutter in program['shutters']:
+            drivers[shutter] = program
+
+    # Programs shutters may be spread over some time, in the order they are
+    # listed, and delayed by a random jitter
+    clock = cs8p.get_clock()
+    offsets = dict()
+    records = list()
+    for (program,date) in triggers:
+        command = get_program_command(program['action'])
+        shutters = [ shutter for shutter in program['shutters'] if drivers[shutter] is program ]
+        jitter = random.uniform(0,float(program.get('jitter',0)))
+        spread = float(program.get('spread',0))
+        record = { 'name'       : program['name']
+                 , 'date'       : date
+                 , 'batch_date' : clock.time()
+                 , 'commands'   : list() }
+        for shutter in program['shutters']:
+            entry = { 'shutter': shutter, 'command': command, 'driver': drivers[shutter]['name'], 'handle': None }
+            if shutter in shutters:
+                index = shutters.index(shutter)
+                offset = jitter + ( spread * index / ( len(shutters) - 1 ) if len(shutters) > 1 else 0 )
+                offsets.setdefault(offset,list()).append(entry)
+            record['commands'].append(entry)
+        records.append(record)
+        logger.info('Running %s for shutters %s with command %s',program['name'],shutters,command)
+        cs8p.emit_event( 'program_fired', { 'name'         : program['name']
+                                          , 'trigger_date' : date
+                                          , 'shutters'     : shutters
+                                          , 'command'      : command } )
+
+    with history_lock:
+        history.extend(records)
+
+    # Commands due at the same time are queued at once so they can be
+    # planned together
+    for (offset,entries) in offsets.items():
+        if offset > 0:
+            clock.call_later(offset,drive_shutters,[entries])
+        else:
+            drive_shutters(entries)
+
+def drive_shutters(entries):
+    handles = cs8p.drive_shutters( [ (entry['shutter'],entry['command']) for entry in entries ] )
+    with history_lock:
+        for (entry,handle) in zip(entries,handles):
+            entry['handle'] = handle
+
+def get_program_history():
+    # Executed programs, with status and skew (start of shutter command versus
+    # program date) of their commands
+    history_records = list()
+    with history_lock:
+        for record in history:
+            commands = list()
+            for entry in record['commands']:
+                handle = entry['handle']
+                if entry['driver'] != record['name']:
+                    status = 'overridden'
+                    skew = None
+                elif handle is None:
+                    status = 'waiting'
+                    skew = None
+                else:
+                    status = handle.get_status()
+                    start_date = handle.get_start_date()
+                    skew = start_date - record['date'] if start_date is not None else None
+                commands.append( { 'shutter' : entry['shutter']
+                                 , 'command' : entry['command']
+                                 , 'driver'  : entry['driver']
+                                 , 'status'  : status
+                                 , 'skew'    : skew } )
+            history_records.append( { 'name'       : record['name']
+                                    , 'date'       : record['date']
+                                    , 'batch_date' : record['batch_date']
+                                    , 'commands'   : commands } )
+    return history_records
 
 def get_program_command( event ):
     if event == 'open':
@@ -151,31 +539,3 @@ def get_program_command( event ):
         return cs8p.CMD_DOWN
     elif event.startswith('int'):
         return cs8p.CMD_INT
-
-def get_program_date( param ):
-    if param['source'] == 'time':
-        time = param['time']
-        today = datetime.date.today()
-        date = datetime.datetime.strptime(time,'%H:%M')
-        date = date.replace( year=today.year, month=today.month, day=today.day)
-        return date
-
-    elif param['source'] == 'sun':
-        event = param['event']
-        offset = 0
-        try:
-            offset = int(param['offset'])
-        except:
-            pass
-
-        if event in ('dawn','sunrise','noon','sunset','dusk'):
-            td = datetime.datetime.today()
-            return astral.sun.sun(location_info.observer,date=datetime.datetime.today())[event] + datetime.timedelta(minutes=offset)
-        else:
-            logger.error('Unsupported sun event "%s"',event)
-            return datetime.datetime.datetime(1900,1,1)
-
-    else:
-        logger.error('Unsupported trigger source "%s"',param['source'])
-        return datetime.datetime.datetime(1900,1,1)
-
@@ -0,0 +1,164 @@
+# =============================================================================
+# System imports
+import datetime
+import logging
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# =============================================================================
+# Logger setup
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Globals
+# Sun zenith angles (degrees) of events, sunrise and sunset include refraction
+events_zenith = ( ('dawn', 96.0), ('sunrise', 90.833), ('sunset', 90.833), ('dusk', 96.0) )
+
+epoch = datetime.datetime(1970,1,1,tzinfo=datetime.timezone.utc)
+
+# =============================================================================
+# Functions
+def get_sun_position(julian_date):
+    # NOAA solar equations, returns (equation of time in minutes, declination
+    # in radians) at Julian dates
+    t = ( julian_date - 2451545.0 ) / 36525.0
+
+    mean_longitude = numpy.radians( ( 280.46646 + t * ( 36000.76983 + t * 0.0003032 ) ) % 360 )
+    mean_anomaly   = numpy.radians( 357.52911 + t * ( 35999.05029 - 0.0001537 * t ) )
+    eccentricity   = 0.016708634 - t * ( 0.000042037 + 0.0000001267 * t )
+
+    center = numpy.sin(mean_anomaly)     * ( 1.914602 - t * ( 0.004817 + 0.000014 * t ) ) \
+           + numpy.sin(2 * mean_anomaly) * ( 0.019993 - 0.000101 * t ) \
+           + numpy.sin(3 * mean_anomaly) * 0.000289
+    omega = numpy.radians( 125.04 - 1934.136 * t )
+    apparent_longitude = numpy.radians( numpy.degrees(mean_longitude) + center - 0.00569 - 0.00478 * numpy.sin(omega) )
+
+    obliquity = 23 + ( 26 + ( 21.448 - t * ( 46.815 + t * ( 0.00059 - t * 0.001813 ) ) ) / 60 ) / 60
+    obliquity = numpy.radians( obliquity + 0.00256 * numpy.cos(omega) )
+    declination = numpy.arcsin( numpy.sin(obliquity) * numpy.sin(apparent_longitude) )
+
+    y = numpy.tan( obliquity / 2 ) ** 2
+    equation_of_time = y * numpy.sin(2 * mean_longitude) \
+                     - 2 * eccentricity * numpy.sin(mean_anomaly) \
+                     + 4 * eccentricity * y * numpy.sin(mean_anomaly) * numpy.cos(2 * mean_longitude) \
+                     - 0.5 * y * y * numpy.sin(4 * mean_longitude) \
+                     - 1.25 * eccentricity * eccentricity * numpy.sin(2 * mean_anomaly)
+    return ( 4 * numpy.degrees(equation_of_time), declination )
+
+# =============================================================================
+# Classes
+class SunTable:
+    # UTC timestamps of sun events for every day of a year, NaN when an event
+    # doesn't happen
+    EVENTS = ( 'dawn', 'sunrise', 'noon', 'sunset', 'dusk' )
+
+    def __init__(self,year,location,dates):
+        self.year = year
+        self.location = location
+        self._dates = dates
+
+    @staticmethod
+    def is_available():
+        return numpy is not None
+
+    @staticmethod
+    def get_file(directory,year):
+        return os.path.join(directory,'sun-events-{}.npz'.format(year))
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def build(cls,year,location):
+        (latitude,longitude) = location
+        first_day = datetime.date(year,1,1)
+        day_count = ( datetime.date(year+1,1,1) - first_day ).days + 2
+
+        # Julian dates and timestamps at 00:00 UTC of each day, including the
+        # days before and after the year
+        midnights = ( datetime.datetime.combine(first_day,datetime.time(),datetime.timezone.utc) - epoch ).total_seconds() \
+                  + numpy.arange(-1,day_count-1) * 86400.0
+        julian_midnights = midnights / 86400.0 + 2440587.5
+
+        def get_minutes(offset,zenith=None):
+            # Minutes after midnight UTC of noon (zenith None) or of the event
+            # at offset times its hour angle from noon, computed twice with
+            # the sun position at the first estimate
+            minutes = numpy.full(day_count,720.0 - 4 * longitude)
+            for iteration in range(2):
+                (equation_of_time,declination) = get_sun_position( julian_midnights + minutes / 1440.0 )
+                minutes = 720.0 - 4 * longitude - equation_of_time
+                if zenith is not None:
+                    latitude_radians = numpy.radians(latitude)
+                    with numpy.errstate(invalid='ignore'):
+                        hour_angle = numpy.degrees( numpy.arccos( numpy.cos(numpy.radians(zenith))
+                                                                  / ( numpy.cos(latitude_radians) * numpy.cos(declination) )
+                                                                - numpy.tan(latitude_radians) * numpy.tan(declination) ) )
+                    minutes = minutes + offset * 4 * hour_angle
+            return minutes
+
+        events = { 'noon': get_minutes(0) }
+        for (event,zenith) in events_zenith:
+            events[event] = get_minutes( -1 if event in ('dawn','sunrise') else 1, zenith )
+
+        # Far from the Greenwich meridian, events computed for a day may happen
+        # on the previous or next UTC day, keep the ones happening on each day
+        # as astral does
+        days = midnights[1:-1]
+        columns = list()
+        for event in cls.EVENTS:
+            dates = midnights + events[event] * 60
+            column = numpy.full(len(days),numpy.nan)
+            for offset in ( 2, 0, 1 ):
+                candidates = dates[offset:offset+len(days)]
+                column = numpy.where( ( candidates >= days ) & ( candidates < days + 86400 ), candidates, column )
+            columns.append(column)
+        return cls(year,location,numpy.stack(columns,axis=1))
+
+    @classmethod
+    def load(cls,file):
+        with numpy.load(file) as data:
+            return cls( int(data['year']), tuple( float(value) for value in data['location'] ), data['dates'] )
+
+    @classmethod
+    def get(cls,directory,year,location):
+        # Loads the table of year from directory, building and saving it if
+        # missing or for another location
+        file = cls.get_file(directory,year)
+        if os.path.exists(file):
+            try:
+                table = cls.load(file)
+            except:
+                logger.exception('Failed to load sun events file %s',file)
+            else:
+                if table.year == year and numpy.allclose(table.location,location):
+                    table.location = tuple(location)
+                    return table
+
+        logger.info('Computing sun events of %d',year)
+        table = cls.build(year,location)
+        try:
+            table.save(file)
+        except:
+            logger.exception('Failed to save sun events file %s',file)
+        return table
+
+    def save(self,file):
+        with open(file,'wb') as f:
+            numpy.savez_compressed( f
+                                  , year=self.year
+                                  , location=numpy.array(self.location)
+                                  , dates=self._dates )
+
+    # -------------------------------------------------------------------------
+    def covers(self,day,location):
+        return day.year == self.year and tuple(location) == tuple(self.location)
+
+    def get_events(self,day):
+        # Same events as astral.sun.sun for day in UTC
+        dates = self._dates[ day.timetuple().tm_yday - 1 ]
+        return { event: epoch + datetime.timedelta(seconds=float(date))
+                 for (event,date) in zip(self.EVENTS,dates)
+                 if not numpy.isnan(date) }
@@ -0,0 +1,159 @@
+# =============================================================================
+# System imports
+import astral
+import astral.sun
+import datetime
+import functools
+import logging
+
+# =============================================================================
+# Logger setup
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Globals
+weekdays = ('mon','tue','wed','thu','fri','sat','sun')
+sun_events = ('dawn','sunrise','noon','sunset','dusk')
+
+# Yearly sun events tables by year
+sun_tables = dict()
+
+# =============================================================================
+# Functions
+def set_sun_table(table):
+    sun_tables[table.year] = table
+    for year in list(sun_tables):
+        if year < table.year - 1:
+            del sun_tables[year]
+
+def get_sun_events(day,location):
+    # Looked up in yearly tables, astral is used for days they don't cover
+    table = sun_tables.get(day.year)
+    if table and table.covers(day,location):
+        return table.get_events(day)
+    return get_astral_sun_events(day,location)
+
+@functools.lru_cache(maxsize=64)
+def get_astral_sun_events(day,location):
+    (latitude,longitude) = location
+    try:
+        return astral.sun.sun(astral.Observer(latitude,longitude),date=day)
+    except ValueError:
+        # Some events don't happen at high latitudes
+        logger.warning('Failed to compute sun events on %s',day)
+        return dict()
+
+def get_program_date(trigger,day,location):
+    # Returns the aware date at which trigger fires on day, None if it doesn't
+    if trigger['source'] == 'time':
+        time = datetime.datetime.strptime(trigger['time'],'%H:%M').time()
+        return datetime.datetime.combine(day,time).astimezone()
+
+    elif trigger['source'] == 'sun':
+        event = trigger['event']
+        offset = 0
+        try:
+            offset = int(trigger['offset'])
+        except:
+            pass
+
+        if event in sun_events:
+            events = get_sun_events(day,location)
+            if event not in events:
+                return None
+            return events[event] + datetime.timedelta(minutes=offset)
+        else:
+            logger.error('Unsupported sun event "%s"',event)
+            return None
+
+    else:
+        logger.error('Unsupported trigger source "%s"',trigger['source'])
+        return None
+
+# =============================================================================
+# Classes
+class TriggerCalendar:
+    # Firing dates of programs over a rolling window of days
+    def __init__(self,location,days=7):
+        self._location = location
+        self._days = days
+        self._first_day = None
+        self._programs = dict()
+        # Firing date by day for each program name
+        self._triggers = dict()
+
+    # -------------------------------------------------------------------------
+    def get_location(self):
+        return self._location
+
+    # -------------------------------------------------------------------------
+    def set_window(self,first_day):
+        # Moves the window, returns the (date,program) triggers of days added
+        # to the window
+        previous_days = set(self._get_days())
+        self._first_day = first_day
+        days = self._get_days()
+
+        added = list()
+        for (name,program) in self._programs.items():
+            triggers = self._triggers[name]
+            for day in list(triggers):
+                if day not in days:
+                    del triggers[day]
+            for day in days:
+                if day not in previous_days:
+                    date = self._get_date(program,day)
+                    if date:
+                        triggers[day] = date
+                        added.append( (date,program) )
+        added.sort( key=lambda trigger: trigger[0] )
+        return added
+
+    def set_program(self,program):
+        # Returns firing dates of program in the window
+        self._programs[program['name']] = program
+        self._triggers[program['name']] = dict()
+        for day in self._get_days():
+            date = self._get_date(program,day)
+            if date:
+                self._triggers[program['name']][day] = date
+        return self.get_program_dates(program['name'])
+
+    def remove_program(self,name):
+        self._programs.pop(name,None)
+        self._triggers.pop(name,None)
+
+    def get_program_dates(self,name):
+        return sorted( self._triggers.get(name,dict()).values() )
+
+    def get_triggers(self,start,end):
+        # Returns the (date,program) triggers between start and end aware
+        # dates, days out of the window are computed on demand
+        window = set(self._get_days())
+        triggers = list()
+        day = start.astimezone().date() - datetime.timedelta(days=1)
+        last_day = end.astimezone().date() + datetime.timedelta(days=1)
+        while day <= last_day:
+            for (name,program) in self._programs.items():
+                if day in window:
+                    date = self._triggers[name].get(day)
+                else:
+                    date = self._get_date(program,day)
+                if date and start <= date < end:
+                    triggers.append( (date,program) )
+            day = day + datetime.timedelta(days=1)
+        triggers.sort( key=lambda trigger: trigger[0] )
+        return triggers
+
+    # -------------------------------------------------------------------------
+    def _get_days(self):
+        if self._first_day is None:
+            return list()
+        return [ self._first_day + datetime.timedelta(days=index) for index in range(self._days) ]
+
+    def _get_date(self,program,day):
+        if program['enable'] is False:
+            return None
+        if weekdays[day.weekday()] not in program['days']:
+            return None
+        return get_program_date(program['trigger'],day,self._location)
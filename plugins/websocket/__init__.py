@@ -1,6 +1,8 @@
 # =============================================================================
 # System imports
 import asyncio
+import collections
+import concurrent.futures
 import logging
 import os
 import json
@@ -22,31 +24,88 @@ port = None
 thread = None
 event_loop = None
 websockets_handle = None
+clients = set()
+
+# Requests are processed by worker threads so the event loop doesn't block, a
+# connection isn't read anymore while it has too many pending requests
+executor = None
+workers = 4
+max_pending_requests = 16
+
+# Commands with side effects are processed one at a time in the order they
+# were received on their connection, e.g. a stop sent after a move is queued
+# after it
+ordered_commands = ( 'drive_shutter', 'drive_shutter_to', 'drive_group'
+                   , 'set_config', 'set_programs', 'restart', 'reload_shutters'
+                   , 'subscribe', 'unsubscribe' )
+
+# Events are queued for each subscriber, the oldest ones are dropped when a
+# subscriber reads too slowly, state events only keep their last value (for
+# each remote)
+subscribers = set()
+max_queued_events = 64
+coalesced_events = ( 'channel_changed', 'config_changed', 'shutters_changed', 'groups_changed', 'programs_changed', 'status_changed' )
 
 # =============================================================================
 # Functions
 def init_plugin(cs8p_):
-    global cs8p,port
+    global cs8p
 
     logger.info('Initializing websocket plugin')
 
     cs8p = cs8p_
+    load_config()
+
+def load_config():
+    global port,workers,max_pending_requests,max_queued_events
 
     try:
         config = json.load(open(config_file))
         port = config['port']
+        workers = int(config.get('workers',workers))
+        max_pending_requests = int(config.get('max_pending_requests',max_pending_requests))
+        max_queued_events = int(config.get('max_queued_events',max_queued_events))
     except:
         logger.exception('Failed to load config file %s',config_file)
 
+def get_config_files():
+    return [ ( config_file, reload_config ), ]
+
+def reload_config():
+    # Connections are only closed when the port changes, new limits apply to
+    # new connections and new events
+    global executor
+
+    previous = ( port, workers )
+    load_config()
+    if workers != previous[1]:
+        logger.info('Using %d workers',workers)
+        previous_executor = executor
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,thread_name_prefix='websocket')
+        previous_executor.shutdown(wait=False)
+    if port != previous[0]:
+        logger.info('Moving websocket server to port %d',port)
+        asyncio.run_coroutine_threadsafe(restart_server(),event_loop).result()
+
+async def restart_server():
+    global websockets_handle
+
+    websockets_handle.close()
+    await websockets_handle.wait_closed()
+    websockets_handle = await websockets.serve(on_client_connected, port=port)
+
 def start_plugin():
-    global thread
+    global thread,executor
 
     logger.info('Starting websocket plugin on port %d',port)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,thread_name_prefix='websocket')
     thread = threading.Thread(target=main)
     thread.start()
+    cs8p.add_event_listener(on_event)
 
 def stop_plugin():
     logger.info('Stopping websocket plugin')
+    cs8p.remove_event_listener(on_event)
 
     if websockets_handle:
         websockets_handle.close()
@@ -59,6 +118,13 @@ def stop_plugin():
             logger.debug('Waiting for event loop to stop')
             time.sleep(1)
 
+    if executor:
+        executor.shutdown(wait=False)
+
+def is_active():
+    # Connected clients may send commands at any time
+    return len(clients) > 0
+
 def main():
     global event_loop,websockets_handle
 
@@ -69,27 +135,76 @@ def main():
     websockets_handle = event_loop.run_until_complete(start_server)
     event_loop.run_forever()
 
+def on_event(event,data):
+    # Called from any thread, events are serialized once for all subscribers
+    if event_loop is None:
+        return
+    # State events of each remote are coalesced separately
+    message = json.dumps( { 'cs8p' : { 'event': event, 'data': data } } )
+    remote = data.get('remote') if isinstance(data,dict) else None
+    event_loop.call_soon_threadsafe(broadcast,event,remote,message)
+
+def broadcast(event,remote,message):
+    for subscriber in subscribers:
+        subscriber.push(event,remote,message)
+
 async def on_client_connected(websocket,path):
     endpoint = '{}:{}'.format(websocket.remote_address[0], websocket.remote_address[1])
     logger.info('New connection from %s',endpoint)
+    clients.add(websocket)
+    cs8p.notify_activity()
 
+    subscriber = Subscriber(websocket,endpoint)
+    sender = asyncio.ensure_future(subscriber.send_events())
+
+    # Requests are processed concurrently but for ordered commands, replies
+    # are sent as soon as they are ready
+    pending = asyncio.Semaphore(max_pending_requests)
+    ordered = asyncio.Lock()
+    tasks = set()
     try:
         async for message in websocket:
-            try:
-                logger.debug('Data received from %s: %s',endpoint,message)
-                output = process_input(message,endpoint)
-                if output:
-                    output = { 'cs8p' : output }
-                    json_output = json.dumps( output )
-                    logger.debug('Sending data to %s: %s',endpoint,json_output)
-                    await websocket.send(json_output)
-            except:
-                logger.exception('Error while processing data from %s',endpoint)
-                raise
+            logger.debug('Data received from %s: %s',endpoint,message)
+            await pending.acquire()
+            lock = ordered if get_command(message) in ordered_commands else None
+            task = asyncio.ensure_future(process_message(websocket,message,endpoint,pending,subscriber,lock))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
     finally:
+        subscribers.discard(subscriber)
+        sender.cancel()
+        clients.discard(websocket)
+        cs8p.notify_activity()
         logger.info('{} disconnected'.format(endpoint))
 
-def process_input(json_input,endpoint):
+async def process_message(websocket,message,endpoint,pending,subscriber,lock=None):
+    # Tasks acquire lock in the order they were created
+    try:
+        if lock:
+            async with lock:
+                output = await asyncio.get_event_loop().run_in_executor(executor,process_input,message,endpoint,subscriber)
+        else:
+            output = await asyncio.get_event_loop().run_in_executor(executor,process_input,message,endpoint,subscriber)
+        if output:
+            output = { 'cs8p' : output }
+            json_output = json.dumps( output )
+            logger.debug('Sending data to %s: %s',endpoint,json_output)
+            await websocket.send(json_output)
+    except websockets.ConnectionClosed:
+        logger.debug('Reply to %s dropped, connection closed',endpoint)
+    except:
+        logger.exception('Error while processing data from %s',endpoint)
+    finally:
+        pending.release()
+
+def get_command(json_input):
+    # Returns the command of a request, None if it has none
+    try:
+        return json.loads(json_input)['cs8p']['command']
+    except:
+        return None
+
+def process_input(json_input,endpoint,subscriber):
     output = None
 
     try:
@@ -104,71 +219,214 @@ def process_input(json_input,endpoint):
             logger.debug('data: {}'.format(data))
 
             if 'command' in data:
-                command = data['command']
-
-                # -------------------------------------------------------------
-                # Shutters commands
-                if command == 'get_shutters':
-                    shutters = cs8p.get_shutters()
-                    output = { 'status': 'ok', 'shutters': shutters }
-                elif command == 'get_groups':
-                    groups = cs8p.get_groups()
-                    output = { 'status': 'ok', 'groups': groups }
-
-                # -------------------------------------------------------------
-                # Programs commands
-                elif command == 'get_programs':
-                    programs = cs8p.get_programs()
-                    output = { 'status': 'ok', 'programs': programs }
-                elif command == 'set_programs':
-                    try:
-                        programs = data['args']['programs']
-                        cs8p.set_programs(programs)
-                    except:
-                        logger.exception('Failed to update programs')
-                        output = { 'status': 'error' }
-                    else:
-                        output = { 'status': 'ok' }
-
-                # -------------------------------------------------------------
-                # Config commands
-                elif command == 'get_config':
-                    config = cs8p.get_config()
-                    output = { 'status': 'ok', 'config': config }
-                elif command == 'set_config':
-                    try:
-                        config = data['args']['config']
-                        cs8p.set_config(config)
-                    except:
-                        logger.exception('Failed to update config')
-                        output = { 'status': 'error' }
-                    else:
-                        output = { 'status': 'ok' }
-
-                # -------------------------------------------------------------
-                # Drive commands
-                elif command == 'drive_shutter':
-                    try:
-                        command = data['args']['command']
-                        shutter = data['args']['shutter']
-                    except:
-                        output = { 'status': 'error' }
-                    else:
-                        cs8p.drive_shutter(shutter,command)
-                        output = { 'status': 'ok' }
-                elif command == 'drive_group':
-                    try:
-                        command = data['args']['command']
-                        group   = data['args']['group']
-                    except:
-                        output = { 'status': 'error' }
+                try:
+                    if data['command'] in ( 'subscribe', 'unsubscribe' ):
+                        output = process_subscription(data['command'],data,subscriber)
                     else:
-                        cs8p.drive_group(group,command)
-                        output = { 'status': 'ok' }
-
-                # -------------------------------------------------------------
-                # Utilities commands
-                elif command == 'restart':
-                    cs8p.stop( True )
-                    output = { 'status': 'ok' }
-    return output
\ No newline at end of file
+                        output = process_command(data['command'],data)
+                except:
+                    logger.exception('Failed to process command %s',data['command'])
+                    output = { 'status': 'error' }
+
+                # Replies carry the id of their request as they may be sent
+                # out of order
+                if output is not None and 'id' in data:
+                    output['id'] = data['id']
+    return output
+
+def process_subscription(command,data,subscriber):
+    # Subscribers are only updated from the event loop
+    if command == 'subscribe':
+        events = data.get('args',dict()).get('events')
+        if events is not None:
+            events = frozenset(events)
+        event_loop.call_soon_threadsafe(subscriber.subscribe,events)
+    else:
+        event_loop.call_soon_threadsafe(subscriber.unsubscribe)
+    return { 'status': 'ok' }
+
+def process_command(command,data):
+    output = None
+
+    # -------------------------------------------------------------------------
+    # Shutters commands
+    if command == 'get_shutters':
+        shutters = cs8p.get_shutters()
+        output = { 'status': 'ok', 'shutters': shutters }
+    elif command == 'get_groups':
+        groups = cs8p.get_groups()
+        output = { 'status': 'ok', 'groups': groups }
+
+    # -------------------------------------------------------------------------
+    # Programs commands
+    elif command == 'get_programs':
+        programs = cs8p.get_programs()
+        output = { 'status': 'ok', 'programs': programs }
+    elif command == 'set_programs':
+        try:
+            programs = data['args']['programs']
+            cs8p.set_programs(programs)
+        except:
+            logger.exception('Failed to update programs')
+            output = { 'status': 'error' }
+        else:
+            output = { 'status': 'ok' }
+    elif command == 'get_scheduled_programs':
+        scheduled = cs8p.get_scheduled_programs()
+        output = { 'status': 'ok', 'scheduled': scheduled }
+    elif command == 'get_upcoming_triggers':
+        # Next day by default
+        args = data.get('args',dict())
+        try:
+            start = float(args.get('from',cs8p.get_clock().time()))
+            end   = float(args.get('to',start + 86400))
+        except:
+            output = { 'status': 'error' }
+        else:
+            triggers = cs8p.get_upcoming_triggers(start,end)
+            output = { 'status': 'ok', 'triggers': triggers }
+    elif command == 'get_program_history':
+        history = cs8p.get_program_history()
+        output = { 'status': 'ok', 'history': history }
+
+    # -------------------------------------------------------------------------
+    # Config commands
+    elif command == 'get_config':
+        config = cs8p.get_config()
+        output = { 'status': 'ok', 'config': config }
+    elif command == 'set_config':
+        try:
+            config = data['args']['config']
+            cs8p.set_config(config)
+        except:
+            logger.exception('Failed to update config')
+            output = { 'status': 'error' }
+        else:
+            output = { 'status': 'ok' }
+
+    # -------------------------------------------------------------------------
+    # Drive commands
+    elif command == 'drive_shutter':
+        try:
+            command = data['args']['command']
+            shutter = data['args']['shutter']
+        except:
+            output = { 'status': 'error' }
+        else:
+            handle = cs8p.drive_shutter(shutter,command)
+            output = get_drive_output(handle)
+    elif command == 'drive_shutter_to':
+        try:
+            shutter  = data['args']['shutter']
+            position = float(data['args']['position'])
+        except:
+            output = { 'status': 'error' }
+        else:
+            handle = cs8p.drive_shutter_to(shutter,position)
+            output = get_drive_output(handle)
+    elif command == 'get_positions':
+        positions = cs8p.get_positions()
+        output = { 'status': 'ok', 'positions': positions }
+    elif command == 'get_command_steps':
+        steps = cs8p.get_command_steps()
+        output = { 'status': 'ok', 'steps': steps }
+    elif command == 'drive_group':
+        try:
+            command = data['args']['command']
+            group   = data['args']['group']
+        except:
+            output = { 'status': 'error' }
+        else:
+            handles = cs8p.drive_group(group,command)
+            output = { 'status': 'ok'
+                     , 'command_status': { handle.shutter: handle.get_status() for handle in handles }
+                     , 'eta': { handle.shutter: cs8p.get_eta(handle) for handle in handles } }
+    elif command == 'get_etas':
+        etas = cs8p.get_etas()
+        output = { 'status': 'ok', 'etas': etas }
+
+    elif command == 'get_metrics':
+        metrics = cs8p.get_metrics()
+        output = { 'status': 'ok', 'metrics': metrics }
+
+    # -------------------------------------------------------------------------
+    # Utilities commands
+    elif command == 'get_status':
+        status = cs8p.get_status()
+        output = { 'status': 'ok', 'state': status }
+    elif command == 'restart':
+        cs8p.stop( True )
+        output = { 'status': 'ok' }
+    elif command == 'reload_shutters':
+        try:
+            cs8p.reload_shutters()
+        except:
+            logger.exception('Failed to reload shutters')
+            output = { 'status': 'error' }
+        else:
+            output = { 'status': 'ok' }
+    return output
+
+def get_drive_output(handle):
+    # Rejected commands (unknown shutter or command) weren't queued
+    if handle.get_status() == 'rejected':
+        return { 'status': 'error', 'command_status': handle.get_status() }
+    return { 'status': 'ok'
+           , 'command_status': handle.get_status()
+           , 'eta': cs8p.get_eta(handle) }
+
+# =============================================================================
+# Classes
+class Subscriber:
+    # Events waiting to be sent to a connection
+    def __init__(self,websocket,endpoint):
+        self._websocket = websocket
+        self._endpoint = endpoint
+        self._events = None
+        self._queue = collections.deque()
+        self._ready = asyncio.Event()
+        self._dropped = 0
+
+    def subscribe(self,events):
+        # All events are sent when events is None
+        logger.info('%s subscribed to %s',self._endpoint,'all events' if events is None else ','.join(sorted(events)))
+        self._events = events
+        subscribers.add(self)
+
+    def unsubscribe(self):
+        logger.info('%s unsubscribed',self._endpoint)
+        subscribers.discard(self)
+        self._queue.clear()
+        self._dropped = 0
+
+    def push(self,event,remote,message):
+        if self._events is not None and event not in self._events:
+            return
+        if event in coalesced_events:
+            for (index,(queued_event,queued_remote,queued_message)) in enumerate(self._queue):
+                if queued_event == event and queued_remote == remote:
+                    del self._queue[index]
+                    break
+        if len(self._queue) >= max_queued_events:
+            self._queue.popleft()
+            self._dropped = self._dropped + 1
+        self._queue.append( (event,remote,message) )
+        self._ready.set()
+
+    async def send_events(self):
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                while len(self._queue):
+                    # Subscribers are told how many events they missed before
+                    # receiving the next ones
+                    if self._dropped:
+                        logger.warning('Dropped %d events for slow subscriber %s',self._dropped,self._endpoint)
+                        await self._websocket.send( json.dumps( { 'cs8p' : { 'event': 'events_dropped'
+                                                                           , 'data' : { 'count': self._dropped } } } ) )
+                        self._dropped = 0
+                    (event,remote,message) = self._queue.popleft()
+                    await self._websocket.send(message)
+        except websockets.ConnectionClosed:
+            logger.debug('Events to %s dropped, connection closed',self._endpoint)
@@ -0,0 +1,57 @@
+# =============================================================================
+# System imports
+import pytest
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import Chronosoft8Simulator,Dispatcher,Remote,VirtualClock
+
+# =============================================================================
+# Globals
+START_DATE = 1600000000.0
+
+CONFIG = { 'gpio': { 'pins'   : { 'return'   : 16
+                                , 'validate' : 18
+                                , 'up'       : 11
+                                , 'stop'     : 13
+                                , 'down'     : 15
+                                , 'power'    : 22 }
+                   , 'config' : { 'active_low': True } } }
+
+SHUTTERS = [ { 'name': 'Général',  'channel': 1 }
+           , { 'name': 'Cuisine',  'channel': 2, 'override': { 'int': [ 'down', 'wait 14', 'stop' ] } }
+           , { 'name': 'Salon 2',  'channel': 3 }
+           , { 'name': 'Salon 1',  'channel': 4, 'override': { 'int': [ 'down', 'wait 17', 'stop' ] } }
+           , { 'name': 'Entrée 2', 'channel': 5 }
+           , { 'name': 'Entrée 1', 'channel': 6 }
+           , { 'name': 'Chambre',  'channel': 7 } ]
+
+# =============================================================================
+# Fixtures
+@pytest.fixture
+def clock():
+    return VirtualClock(START_DATE)
+
+@pytest.fixture
+def simulator(clock):
+    return Chronosoft8Simulator(clock)
+
+@pytest.fixture
+def remote(clock,simulator):
+    # Booted remote, the simulator must not have seen unexpected presses
+    remote = Remote(CONFIG,SHUTTERS,clock=clock,backend=simulator)
+    remote.start()
+    yield remote
+    assert simulator.errors == []
+
+@pytest.fixture
+def dispatcher(remote,clock):
+    return Dispatcher(remote,clock=clock)
+
+@pytest.fixture
+def orders(remote,clock,simulator):
+    # Returns the orders received by shutters since the remote booted, as
+    # (delay,channel,order) tuples
+    start_date = clock.time()
+    simulator.orders.clear()
+    return lambda: [ ( date - start_date, channel, order ) for (date,channel,order) in simulator.orders ]
@@ -0,0 +1,88 @@
+# =============================================================================
+# System imports
+import threading
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import Clock,VirtualClock
+from conftest import START_DATE
+
+# =============================================================================
+# Functions
+def record(clock,calls,name):
+    # Timer function recording its name and the date it ran at
+    return lambda: calls.append( (name,clock.time()) )
+
+# -----------------------------------------------------------------------------
+# Virtual clock
+def test_timers_run_in_date_order(clock):
+    # Timers due at the same date run in the order they were set
+    calls = list()
+    for (name,delay) in ( ('c',30), ('a',10), ('b1',20), ('b2',20) ):
+        clock.call_later(delay,record(clock,calls,name))
+    assert clock.get_timer_count() == 4
+    assert clock.get_next_timer_date() == START_DATE + 10
+
+    clock.sleep(60)
+    assert calls == [ ('a',START_DATE + 10), ('b1',START_DATE + 20), ('b2',START_DATE + 20), ('c',START_DATE + 30) ]
+    assert clock.get_timer_count() == 0
+
+def test_cancelled_timers_do_not_run(clock):
+    calls = list()
+    timers = [ clock.call_later(delay,record(clock,calls,delay)) for delay in ( 10, 20, 30 ) ]
+    timers[0].cancel()
+    timers[1].cancel()
+    assert clock.get_timer_count() == 1
+    assert clock.get_next_timer_date() == START_DATE + 30
+
+    clock.sleep(60)
+    assert calls == [ (30,START_DATE + 30) ]
+
+def test_timers_can_set_timers(clock):
+    # Timers set by timers due before the end of the sleep run along
+    calls = list()
+    clock.call_later(10,lambda: clock.call_later(5,record(clock,calls,'nested')))
+    clock.sleep(60)
+    assert calls == [ ('nested',START_DATE + 15) ]
+
+def test_wall_clock_jump_only_moves_wall_clock_timers(clock):
+    # Wall clock timers keep their date, monotonic ones their delay
+    calls = list()
+    clock.call_later(100,record(clock,calls,'wall'))
+    clock.call_later(100,record(clock,calls,'monotonic'),monotonic=True)
+    clock.jump(50)
+    assert clock.get_next_timer_date() == START_DATE + 100
+
+    clock.sleep(100)
+    assert calls == [ ('wall',START_DATE + 100), ('monotonic',START_DATE + 150) ]
+
+def test_wait_returns_once_a_timer_ran(clock):
+    condition = threading.Condition()
+    calls = list()
+    clock.call_later(10,record(clock,calls,'timer'))
+    with condition:
+        assert clock.wait(condition,60) is True
+        assert clock.time() == START_DATE + 10
+        assert clock.wait(condition,60) is False
+    assert calls == [ ('timer',START_DATE + 10) ]
+    assert clock.time() == START_DATE + 70
+
+# -----------------------------------------------------------------------------
+# Wall clock
+def test_timers_run_on_a_single_thread():
+    clock = Clock()
+    threads = list()
+    done = threading.Event()
+    def run(last):
+        threads.append(threading.current_thread())
+        if last:
+            done.set()
+
+    cancelled = clock.call_later(0.01,run,[True])
+    for index in range(20):
+        clock.call_later(0.01 * index,run,[index == 19])
+    cancelled.cancel()
+    assert done.wait(5)
+    assert len(threads) == 20
+    assert { thread.name for thread in threads } == { 'clock-timers', }
+    assert len(set(threads)) == 1
@@ -0,0 +1,309 @@
+# =============================================================================
+# System imports
+import threading
+
+import pytest
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import Command,Dispatcher,Parameters,Remote,RemotePool
+from conftest import CONFIG,SHUTTERS
+
+# =============================================================================
+# Functions
+def make_command(shutter,command):
+    priority = Dispatcher.PRIORITY_STOP if command == 'stop' else Dispatcher.PRIORITY_DEFAULT
+    return Command(priority,shutter,command)
+
+def put_later(clock,dispatcher,delay,shutter,command,handles):
+    clock.call_later(delay,lambda: handles.extend(dispatcher.put( [ make_command(shutter,command), ] )))
+
+# -----------------------------------------------------------------------------
+# Channel ring sweep
+def test_commands_are_sent_in_channel_ring_order(clock,dispatcher,orders):
+    # Channels are only reached going up the ring from channel 1
+    dispatcher.put( [ make_command('Chambre','up'), make_command('Cuisine','up'), make_command('Salon 2','up') ] )
+    dispatcher.run( until=clock.time() + 60 )
+    assert [ (channel,order) for (_,channel,order) in orders() ] == [ (2,'up'), (3,'up'), (7,'up') ]
+
+@pytest.mark.parametrize('max_delay',[ 10.0, 1000.0 ])
+def test_reordered_command_delay_is_bounded(clock,dispatcher,orders,monkeypatch,max_delay):
+    # Commands keep coming on the current channel, the command on the next
+    # channel is only sent once it waited for the maximum delay
+    monkeypatch.setattr(Parameters,'dispatcher_command_max_delay',max_delay)
+    handles = list()
+    for index in range(30):
+        put_later(clock,dispatcher,index,'Cuisine',( 'up', 'down' )[index%2],handles)
+    put_later(clock,dispatcher,0.1,'Salon 2','up',handles)
+    dispatcher.run( until=clock.time() + 120 )
+
+    delay = [ delay for (delay,channel,order) in orders() if channel == 3 ][0] - 0.1
+    command_duration = Parameters.remote_cmd_button_press_duration \
+                     + Parameters.remote_cmd_button_release_duration \
+                     + Parameters.remote_menu_button_press_duration \
+                     + Parameters.remote_menu_button_release_duration
+    if max_delay < 30:
+        assert max_delay <= delay <= max_delay + command_duration
+    else:
+        assert delay > 30
+
+# -----------------------------------------------------------------------------
+# Coalescing
+def test_identical_commands_are_merged(clock,dispatcher,orders):
+    handles = dispatcher.put( [ make_command('Chambre','up'), make_command('Chambre','up') ] )
+    assert handles[1].get_status() == Command.STATUS_MERGED
+    dispatcher.run( until=clock.time() + 60 )
+    assert [ handle.get_status() for handle in handles ] == [ Command.STATUS_EXECUTED, Command.STATUS_MERGED ]
+    assert [ (channel,order) for (_,channel,order) in orders() ] == [ (7,'up') ]
+
+def test_newer_command_supersedes_pending_one(clock,dispatcher,orders):
+    handles = dispatcher.put( [ make_command('Chambre','up'), ] ) \
+            + dispatcher.put( [ make_command('Chambre','down'), ] )
+    assert handles[0].get_status() == Command.STATUS_SUPERSEDED
+    dispatcher.run( until=clock.time() + 60 )
+    assert handles[1].get_status() == Command.STATUS_EXECUTED
+    assert [ (channel,order) for (_,channel,order) in orders() ] == [ (7,'down') ]
+
+def test_invalid_commands_are_rejected(clock,dispatcher,orders):
+    handles = dispatcher.put( [ make_command('Chambre','up'), ] ) \
+            + dispatcher.put( [ make_command('Chambre','sideways'), make_command('Garage','up') ] )
+    assert [ handle.get_status() for handle in handles ] == [ Command.STATUS_PENDING, Command.STATUS_REJECTED, Command.STATUS_REJECTED ]
+    dispatcher.run( until=clock.time() + 60 )
+    assert [ (channel,order) for (_,channel,order) in orders() ] == [ (7,'up') ]
+
+# -----------------------------------------------------------------------------
+# Continuations
+def test_continuation_is_sent_on_time(clock,dispatcher,orders):
+    # Other channels are served during the wait step of the override
+    handles = dispatcher.put( [ make_command('Cuisine','int'), make_command('Chambre','up') ] )
+    dispatcher.run( until=clock.time() + 60 )
+    assert [ handle.get_status() for handle in handles ] == [ Command.STATUS_EXECUTED, Command.STATUS_EXECUTED ]
+
+    sent = orders()
+    assert [ (channel,order) for (_,channel,order) in sent ] == [ (2,'down'), (7,'up'), (2,'stop') ]
+    press_duration = Parameters.remote_cmd_button_press_duration + Parameters.remote_cmd_button_release_duration
+    assert sent[2][0] - sent[0][0] == pytest.approx( 14 + press_duration, abs=0.05 )
+
+# -----------------------------------------------------------------------------
+# Stop commands
+def test_stop_is_sent_before_queued_moves(clock,dispatcher,orders):
+    handles = dispatcher.put( [ make_command(shutter,'down') for shutter in ( 'Entrée 2', 'Entrée 1', 'Chambre' ) ] )
+    put_later(clock,dispatcher,1.0,'Cuisine','stop',handles)
+    dispatcher.run( until=clock.time() + 60 )
+
+    channels = [ channel for (_,channel,order) in orders() ]
+    assert channels.index(2) < channels.index(6) and channels.index(2) < channels.index(7)
+    assert dispatcher.get_metrics()['stop_latency']['count'] == 1
+
+@pytest.mark.parametrize('cut_press',[ False, True ])
+def test_stop_preempts_move_being_sent(clock,dispatcher,orders,monkeypatch,cut_press):
+    # The stop arrives while the up button of Chambre is pressed, the press
+    # is only cut short when enabled and the continuation of Cuisine is still
+    # sent on time
+    monkeypatch.setattr(Parameters,'remote_cmd_button_cut_press',cut_press)
+    handles = dispatcher.put( [ make_command('Cuisine','int'), make_command('Chambre','up') ] )
+    put_later(clock,dispatcher,3.2,'Salon 2','stop',handles)
+    dispatcher.run( until=clock.time() + 60 )
+    assert all( handle.get_status() == Command.STATUS_EXECUTED for handle in handles )
+
+    sent = orders()
+    assert [ (channel,order) for (_,channel,order) in sent ] == [ (2,'down'), (7,'up'), (3,'stop'), (2,'stop') ]
+    press_end = sent[1][0] + Parameters.remote_cmd_button_press_duration + Parameters.remote_cmd_button_release_duration
+    if cut_press:
+        assert sent[2][0] < press_end
+    else:
+        assert sent[2][0] >= press_end
+    assert sent[3][0] - sent[0][0] == pytest.approx( 14 + Parameters.remote_cmd_button_press_duration
+                                                        + Parameters.remote_cmd_button_release_duration, abs=0.05 )
+
+def test_stop_cancels_continuation_of_its_shutter(clock,dispatcher,orders):
+    handles = dispatcher.put( [ make_command('Cuisine','int'), ] )
+    put_later(clock,dispatcher,5.0,'Cuisine','stop',handles)
+    dispatcher.run( until=clock.time() + 60 )
+    assert [ handle.get_status() for handle in handles ] == [ Command.STATUS_CANCELLED, Command.STATUS_EXECUTED ]
+
+    sent = orders()
+    assert [ (channel,order) for (_,channel,order) in sent ] == [ (2,'down'), (2,'stop') ]
+    assert sent[1][0] == pytest.approx( 5.0, abs=0.05 )
+
+# -----------------------------------------------------------------------------
+# Group planning
+def test_group_command_uses_general_channel_with_corrections(clock,dispatcher,orders):
+    # All shutters but one going down are sent on the general channel, the
+    # other one is corrected afterwards
+    shutters = ( 'Cuisine', 'Salon 2', 'Salon 1', 'Entrée 2', 'Entrée 1', 'Chambre' )
+    handles = dispatcher.put( [ make_command(shutter,'up' if shutter == 'Salon 2' else 'down') for shutter in shutters ] )
+    dispatcher.run( until=clock.time() + 120 )
+    assert all( handle.get_status() == Command.STATUS_EXECUTED for handle in handles )
+    assert [ (channel,order) for (_,channel,order) in orders() ] == [ (1,'down'), (3,'up') ]
+
+    (report,) = dispatcher.get_plan_reports()
+    assert report['commands'] == 6 and report['planned_commands'] == 2
+    assert report['estimated_duration'] < report['unplanned_duration']
+
+# -----------------------------------------------------------------------------
+# Reconfiguration
+def test_shutter_added_by_reload_can_be_driven_at_once(clock,remote,dispatcher,orders):
+    # Commands for the new shutter are queued behind the reconfiguration
+    pool = RemotePool()
+    pool.add('main',remote,dispatcher,SHUTTERS)
+    pool.reconfigure( SHUTTERS + [ { 'name': 'Garage', 'channel': 8 } ] )
+    handles = pool.put( [ make_command('Garage','up'), ] )
+    assert handles[0].get_status() == Command.STATUS_PENDING
+    assert dispatcher.get_eta(handles[0]) is None
+    dispatcher.run( until=clock.time() + 60 )
+    assert handles[0].get_status() == Command.STATUS_EXECUTED
+    assert [ (channel,order) for (_,channel,order) in orders() ] == [ (8,'up') ]
+
+def test_commands_issued_during_reload_wait_for_it(clock,remote,dispatcher,orders):
+    # Commands arrive while channels are being reconfigured, the one for the
+    # removed shutter is rejected
+    shutters = [ shutter for shutter in SHUTTERS if shutter['name'] != 'Chambre' ] \
+             + [ { 'name': 'Garage', 'channel': 8 } ]
+    start_date = clock.time()
+    handles = list()
+    reconfiguration = dispatcher.reconfigure(shutters)
+    for shutter in ( 'Garage', 'Chambre', 'Salon 2' ):
+        put_later(clock,dispatcher,1.0,shutter,'stop',handles)
+    dispatcher.run( until=clock.time() + 60 )
+
+    assert reconfiguration.get_status() == Command.STATUS_EXECUTED
+    assert [ handle.get_status() for handle in handles ] == [ Command.STATUS_EXECUTED, Command.STATUS_REJECTED, Command.STATUS_EXECUTED ]
+    sent = orders()
+    assert sorted( (channel,order) for (_,channel,order) in sent ) == [ (3,'stop'), (8,'stop') ]
+    assert start_date + sent[0][0] >= reconfiguration.end_date
+
+def test_reconfiguration_only_toggles_changed_channels(clock,remote,dispatcher,simulator):
+    # Chambre on channel 7 is replaced by Garage on channel 8, other channels
+    # are only validated
+    shutters = [ shutter for shutter in SHUTTERS if shutter['name'] != 'Chambre' ] \
+             + [ { 'name': 'Garage', 'channel': 8 } ]
+    simulator.events.clear()
+    dispatcher.reconfigure(shutters)
+    dispatcher.run( until=clock.time() + 60 )
+
+    presses = [ name for (_,name,value) in simulator.events if value ]
+    assert presses.count('Up') == 1 and presses.count('Down') == 1
+    assert simulator.enabled_channels == [ 1, 2, 3, 4, 5, 6, 8 ]
+    assert remote.get_channel_list() == [ 1, 2, 3, 4, 5, 6, 8 ]
+
+def test_reconfiguration_without_channel_change_presses_nothing(clock,remote,dispatcher,simulator,orders):
+    # Renamed shutter keeps its channel, it is driven under its new name
+    shutters = [ dict(shutter,name='Garage') if shutter['name'] == 'Chambre' else shutter for shutter in SHUTTERS ]
+    simulator.events.clear()
+    dispatcher.reconfigure(shutters)
+    dispatcher.run( until=clock.time() + 1 )
+    assert simulator.events == []
+
+    handles = dispatcher.put( [ make_command('Garage','up'), make_command('Chambre','up') ] )
+    dispatcher.run( until=clock.time() + 60 )
+    assert [ handle.get_status() for handle in handles ] == [ Command.STATUS_EXECUTED, Command.STATUS_REJECTED ]
+    assert [ (channel,order) for (_,channel,order) in orders() ] == [ (7,'up') ]
+
+# -----------------------------------------------------------------------------
+# Keep awake
+@pytest.mark.parametrize('mode',[ Dispatcher.KEEP_AWAKE_OFF, Dispatcher.KEEP_AWAKE_PREDICTIVE, Dispatcher.KEEP_AWAKE_ON ])
+def test_keep_awake_mode_of_expected_command(clock,remote,orders,monkeypatch,mode):
+    # Command on the current channel is expected in 100 s, the remote only
+    # has to be woken up when it arrives in off mode
+    monkeypatch.setattr(Parameters,'remote_keep_awake_mode',mode)
+    monkeypatch.setattr(Parameters,'remote_keep_awake_horizon',200.0)
+    expected_date = clock.time() + 100
+    dispatcher = Dispatcher(remote,lambda: expected_date,clock)
+    put_later(clock,dispatcher,100,'Général','up',list())
+    dispatcher.run( until=clock.time() + 120 )
+
+    metrics = remote.get_metrics()
+    sent = orders()
+    assert [ (channel,order) for (_,channel,order) in sent ] == [ (1,'up') ]
+    if mode == Dispatcher.KEEP_AWAKE_OFF:
+        assert metrics['wake_count'] == 1 and metrics['keep_awake_press_count'] == 0
+        assert sent[0][0] > 100 + Parameters.remote_wake_button_press_duration
+    elif mode == Dispatcher.KEEP_AWAKE_PREDICTIVE:
+        assert metrics['predictive_wake_count'] == 1 and metrics['keep_awake_press_count'] == 0
+        assert sent[0][0] == pytest.approx( 100, abs=0.05 )
+    else:
+        assert metrics['wake_count'] == 0 and metrics['keep_awake_press_count'] > 0
+
+def test_plugin_queuing_commands_under_its_lock_does_not_deadlock(clock,remote,orders,monkeypatch):
+    # Plugin holds its lock while queuing a command, as the dispatcher asks
+    # it for its next command date
+    monkeypatch.setattr(Parameters,'remote_keep_awake_mode',Dispatcher.KEEP_AWAKE_PREDICTIVE)
+    plugin_lock = threading.Lock()
+    asking = threading.Event()
+    def get_next_command_date():
+        asking.set()
+        with plugin_lock:
+            return clock.time() + 100
+    dispatcher = Dispatcher(remote,get_next_command_date,clock)
+
+    def run_plugin():
+        with plugin_lock:
+            asking.wait(5)
+            threading.Event().wait(0.1)
+            dispatcher.put( [ make_command('Chambre','up'), ] )
+    threads = [ threading.Thread(target=run_plugin,daemon=True)
+              , threading.Thread(target=lambda: dispatcher.run( until=clock.time() + 30 ),daemon=True) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert not any( thread.is_alive() for thread in threads )
+    assert [ (channel,order) for (_,channel,order) in orders() ] == [ (7,'up') ]
+
+def test_keep_awake_on_follows_plugin_activity(clock,remote,monkeypatch):
+    # Remote is kept awake while a plugin is active, then left asleep
+    monkeypatch.setattr(Parameters,'remote_keep_awake_mode',Dispatcher.KEEP_AWAKE_ON)
+    active = [ True ]
+    dispatcher = Dispatcher(remote,clock=clock,is_active=lambda: active[0])
+    dispatcher.run( until=clock.time() + 60 )
+    press_count = remote.get_metrics()['keep_awake_press_count']
+    assert press_count >= 60 // Parameters.remote_sleep_timer_duration
+    assert not remote.is_sleeping(clock.time())
+
+    active[0] = False
+    dispatcher.run( until=clock.time() + 60 )
+    assert remote.get_metrics()['keep_awake_press_count'] == press_count
+    assert remote.is_sleeping(clock.time())
+
+# -----------------------------------------------------------------------------
+# Positions
+@pytest.fixture
+def travel_remote(clock,simulator):
+    # Chambre takes 20 s to open or close
+    shutters = [ dict(shutter,travel={ 'up': 20, 'down': 20 }) if shutter['name'] == 'Chambre' else shutter
+                 for shutter in SHUTTERS ]
+    remote = Remote(CONFIG,shutters,clock=clock,backend=simulator)
+    remote.start()
+    simulator.orders.clear()
+    yield remote
+    assert simulator.errors == []
+
+def test_unknown_position_is_calibrated_before_partial_move(clock,simulator,travel_remote):
+    dispatcher = Dispatcher(travel_remote,clock=clock)
+    handles = dispatcher.put( [ make_command('Chambre',Remote.get_position_command(50)), ] )
+    dispatcher.run( until=clock.time() + 60 )
+    assert handles[0].get_status() == Command.STATUS_EXECUTED
+
+    sent = simulator.orders
+    assert [ (channel,order) for (_,channel,order) in sent ] == [ (7,'up'), (7,'down'), (7,'stop') ]
+    # Remote falls asleep during the calibration, the down order waits for
+    # the wake press
+    assert sent[1][0] - sent[0][0] >= 20
+    assert sent[2][0] - sent[1][0] == pytest.approx( 10, abs=0.05 )
+    assert travel_remote.get_position('Chambre') == pytest.approx( 50, abs=Parameters.position_tolerance )
+
+def test_move_to_current_position_is_skipped(clock,simulator,travel_remote):
+    dispatcher = Dispatcher(travel_remote,clock=clock)
+    dispatcher.put( [ make_command('Chambre','up'), ] )
+    dispatcher.run( until=clock.time() + 30 )
+    handles = dispatcher.put( [ make_command('Chambre','up'), make_command('Chambre',Remote.get_position_command(100)) ] )
+    dispatcher.run( until=clock.time() + 30 )
+    assert [ handle.get_status() for handle in handles ] == [ Command.STATUS_SUPERSEDED, Command.STATUS_SKIPPED ]
+    assert [ (channel,order) for (_,channel,order) in simulator.orders ] == [ (7,'up') ]
+
+def test_position_of_shutter_without_travel_is_rejected(clock,travel_remote):
+    dispatcher = Dispatcher(travel_remote,clock=clock)
+    handles = dispatcher.put( [ make_command('Cuisine',Remote.get_position_command(50))
+                              , make_command('Chambre',Remote.get_position_command(150)) ] )
+    assert [ handle.get_status() for handle in handles ] == [ Command.STATUS_REJECTED, Command.STATUS_REJECTED ]
@@ -0,0 +1,108 @@
+# =============================================================================
+# System imports
+import importlib.util
+import json
+import os
+import threading
+
+import pytest
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import Chronosoft8Simulator,Command,Dispatcher,Remote,RemotePool,VirtualClock
+from conftest import CONFIG,SHUTTERS,START_DATE
+
+# =============================================================================
+# Globals
+SECOND_PINS = { 'return': 29, 'validate': 31, 'up': 33, 'stop': 35, 'down': 37, 'power': 40 }
+SECOND_SHUTTERS = [ { 'name': 'Garage', 'channel': 1, 'remote': 'second' }
+                  , { 'name': 'Atelier', 'channel': 2, 'remote': 'second' }
+                  , { 'name': 'Cellier', 'channel': 3, 'remote': 'second' } ]
+
+# =============================================================================
+# Functions
+def load_puppeteer(tmp_path,monkeypatch,config,shutters):
+    # Puppeteer using the config files written to tmp_path, without plugins
+    spec = importlib.util.spec_from_file_location( 'cs8p_main'
+                                                 , os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'chronosoft8puppeteer.py') )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    monkeypatch.setattr(module,'config_path',str(tmp_path))
+
+    config = dict(config,plugins=list(),watch_config=False)
+    (tmp_path/'chronosoft8-puppeteer.json').write_text( json.dumps(config) )
+    (tmp_path/'shutters.json').write_text( json.dumps( { 'shutters': shutters } ) )
+    (tmp_path/'groups.json').write_text( json.dumps( { 'groups': list() } ) )
+    return module.Chronosoft8Puppeteer()
+
+def get_gpio(pins):
+    return dict(CONFIG['gpio'],pins=pins,backend='simulator')
+
+def make_remote(name,shutters,pins):
+    # Each remote has its own virtual clock, as it is driven by its own thread
+    clock = VirtualClock(START_DATE)
+    simulator = Chronosoft8Simulator(clock)
+    remote = Remote( { 'gpio': dict(CONFIG['gpio'],pins=pins) }, shutters, clock=clock, backend=simulator, name=name )
+    return (remote,Dispatcher(remote,clock=clock),simulator)
+
+# -----------------------------------------------------------------------------
+# Remote pool
+def test_remotes_are_driven_in_parallel():
+    # Each remote waits for the other one to send its first order
+    pool = RemotePool()
+    simulators = dict()
+    both_sending = threading.Barrier(2,timeout=5)
+    for (name,shutters,pins) in ( ( 'main', SHUTTERS, CONFIG['gpio']['pins'] ), ( 'second', SECOND_SHUTTERS, SECOND_PINS ) ):
+        (remote,dispatcher,simulator) = make_remote(name,shutters,pins)
+        on_press = simulator._on_press
+        def wait_other(date,buttons,duration,on_press=on_press,simulator=simulator):
+            if simulator.screen == simulator.SCREEN_MAIN and buttons == { 'up' }:
+                both_sending.wait()
+            on_press(date,buttons,duration)
+        simulator._on_press = wait_other
+        pool.add(name,remote,dispatcher,shutters)
+        simulators[name] = simulator
+
+    # Commands are routed to the remote of their shutter while remotes boot
+    handles = pool.put( [ Command(Dispatcher.PRIORITY_DEFAULT,'Chambre','up'), Command(Dispatcher.PRIORITY_DEFAULT,'Atelier','up') ] )
+    pool.run( until=START_DATE + 120 )
+    assert [ handle.get_status() for handle in handles ] == [ Command.STATUS_EXECUTED, Command.STATUS_EXECUTED ]
+    assert [ order[1:] for order in simulators['main'].orders ] == [ (7,'up') ]
+    assert [ order[1:] for order in simulators['second'].orders ] == [ (2,'up') ]
+    assert all( simulator.errors == [] for simulator in simulators.values() )
+
+def test_unknown_shutters_are_rejected_by_first_remote():
+    pool = RemotePool()
+    for (name,shutters,pins) in ( ( 'main', SHUTTERS, CONFIG['gpio']['pins'] ), ( 'second', SECOND_SHUTTERS, SECOND_PINS ) ):
+        (remote,dispatcher,simulator) = make_remote(name,shutters,pins)
+        pool.add(name,remote,dispatcher,shutters)
+    assert pool.get_route('Garage') == 'second'
+    assert pool.get_route('Véranda') == 'main'
+    (handle,) = pool.put( [ Command(Dispatcher.PRIORITY_DEFAULT,'Véranda','up'), ] )
+    assert handle.get_status() == Command.STATUS_REJECTED
+
+# -----------------------------------------------------------------------------
+# Configuration
+def test_single_remote_config_is_unchanged(tmp_path,monkeypatch):
+    puppeteer = load_puppeteer( tmp_path, monkeypatch, { 'gpio': get_gpio(CONFIG['gpio']['pins']) }, SHUTTERS )
+    assert puppeteer._remotes.get_names() == [ 'main', ]
+    assert all( puppeteer._remotes.get_route(shutter['name']) == 'main' for shutter in SHUTTERS )
+
+def test_shutters_are_split_between_remotes(tmp_path,monkeypatch):
+    config = { 'remotes': [ { 'name': 'main',   'gpio': get_gpio(CONFIG['gpio']['pins']) }
+                          , { 'name': 'second', 'gpio': get_gpio(SECOND_PINS) } ] }
+    puppeteer = load_puppeteer( tmp_path, monkeypatch, config, SHUTTERS + SECOND_SHUTTERS )
+    assert puppeteer._remotes.get_names() == [ 'main', 'second' ]
+    assert puppeteer._remotes.get_remote('second').get_channel_list() == [ 1, 2, 3 ]
+    assert puppeteer._remotes.get_route('Garage') == 'second'
+    assert puppeteer._remotes.get_route('Chambre') == 'main'
+
+@pytest.mark.parametrize('second_pins,second_shutters',[ ( dict(SECOND_PINS,power=CONFIG['gpio']['pins']['power']), SECOND_SHUTTERS )
+                                                       , ( SECOND_PINS, SECOND_SHUTTERS[1:] )
+                                                       , ( SECOND_PINS, [ dict(SECOND_SHUTTERS[0],remote='third') ] ) ])
+def test_invalid_remotes_config_is_rejected(tmp_path,monkeypatch,second_pins,second_shutters):
+    # Shared GPIO pin, remote without channel 1 and unknown remote
+    config = { 'remotes': [ { 'name': 'main',   'gpio': get_gpio(CONFIG['gpio']['pins']) }
+                          , { 'name': 'second', 'gpio': get_gpio(second_pins) } ] }
+    with pytest.raises(ValueError):
+        load_puppeteer( tmp_path, monkeypatch, config, SHUTTERS + second_shutters )
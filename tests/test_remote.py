@@ -0,0 +1,134 @@
+# =============================================================================
+# System imports
+import os
+
+import pytest
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import Parameters,Remote
+from chronosoft8puppeteer.steps import PressStep,WaitStep
+from conftest import CONFIG,SHUTTERS
+
+# =============================================================================
+# Functions
+def restart(clock,simulator,state_file,shutters=SHUTTERS):
+    # Remote of a new run, the previous one kept the remote powered
+    remote = Remote(CONFIG,shutters,str(state_file),Remote.STATE_VALIDATION_BOOT,clock=clock,backend=simulator)
+    simulator.events.clear()
+    remote.start()
+    return remote
+
+# -----------------------------------------------------------------------------
+# Shutters configuration
+def test_overrides_are_compiled_to_steps():
+    (_,channel_list,plans) = Remote.parse_shutters(SHUTTERS)
+    assert channel_list == [ 1, 2, 3, 4, 5, 6, 7 ]
+    assert plans[('Cuisine','int')] == ( PressStep('down',('down',)), WaitStep(14.0), PressStep('stop',('stop',)) )
+    assert plans[('Chambre','int')] == ( PressStep('int',('stop','down')), )
+
+@pytest.mark.parametrize('override',[ { 'int': [ 'down', 'wait', 'stop' ] }
+                                    , { 'int': [ 'down', 'wait 14s', 'stop' ] }
+                                    , { 'int': [ 'down', 'wait -1', 'stop' ] }
+                                    , { 'int': [ 'down', 'wait nan', 'stop' ] }
+                                    , { 'int': [ 'down', 'wait 14' ] }
+                                    , { 'int': [ 'down', 'pause', 'stop' ] }
+                                    , { 'int': [ 'down', 14, 'stop' ] }
+                                    , { 'int': [] }
+                                    , { 'int': 'down' }
+                                    , { 'open': [ 'up', ] } ])
+def test_bad_overrides_are_rejected(override):
+    shutters = SHUTTERS[:-1] + [ dict(SHUTTERS[-1],override=override), ]
+    with pytest.raises(ValueError):
+        Remote.parse_shutters(shutters)
+
+@pytest.mark.parametrize('shutters',[ SHUTTERS[1:]
+                                    , SHUTTERS + [ { 'name': 'Grenier', 'channel': 7 }, ]
+                                    , SHUTTERS + [ { 'name': 'Grenier', 'channel': 9 }, ]
+                                    , SHUTTERS + [ { 'name': 'Grenier', 'channel': 'eight' }, ] ])
+def test_bad_channels_are_rejected(shutters):
+    with pytest.raises(ValueError):
+        Remote.parse_shutters(shutters)
+
+# -----------------------------------------------------------------------------
+# State restore
+def test_state_is_restored_without_boot(clock,simulator,tmp_path):
+    remote = restart(clock,simulator,tmp_path/'state.json')
+    remote.drive_shutter('Chambre','up')
+    remote.checkpoint()
+    remote.stop( power_off=False )
+
+    remote = restart(clock,simulator,tmp_path/'state.json')
+    assert simulator.events == []
+    assert remote.get_channel_list()[remote.get_current_channel_index()] == 7
+
+    # Channel is still in sync with the remote
+    remote.drive_shutter('Cuisine','down')
+    assert simulator.orders[-1][1:] == (2,'down')
+    assert simulator.errors == []
+
+@pytest.mark.parametrize('power_off',[ True, False ])
+def test_state_is_not_restored_after_power_off_or_channel_change(clock,simulator,tmp_path,power_off):
+    remote = restart(clock,simulator,tmp_path/'state.json')
+    remote.stop( power_off=power_off )
+
+    # Remote is booted again when powered down or for other channels
+    shutters = SHUTTERS if power_off else SHUTTERS[:-1]
+    clock.sleep(60)
+    remote = restart(clock,simulator,tmp_path/'state.json',shutters)
+    assert simulator.events != []
+    assert simulator.enabled_channels == sorted( shutter['channel'] for shutter in shutters )
+    assert remote.get_current_channel_index() == 0
+    assert simulator.errors == []
+
+class Killed(Exception):
+    pass
+
+def test_state_is_not_restored_after_kill_while_changing_channel(clock,simulator,tmp_path,monkeypatch):
+    # Process is killed once the remote moved to the next channel
+    remote = restart(clock,simulator,tmp_path/'state.json')
+    on_output = simulator.on_output
+    def kill(date,name,value):
+        on_output(date,name,value)
+        if name == 'Return' and not value:
+            raise Killed()
+    monkeypatch.setattr(simulator,'on_output',kill)
+    with pytest.raises(Killed):
+        remote.drive_shutter('Chambre','up')
+    monkeypatch.setattr(simulator,'on_output',on_output)
+
+    clock.sleep(60)
+    remote = restart(clock,simulator,tmp_path/'state.json')
+    assert simulator.events != []
+    remote.drive_shutter('Chambre','up')
+    assert simulator.orders[-1][1:] == (7,'up')
+    assert simulator.errors == []
+
+def test_checkpoint_is_only_saved_when_channel_changed(clock,simulator,tmp_path,monkeypatch):
+    remote = restart(clock,simulator,tmp_path/'state.json')
+    saved = list()
+    replace = os.replace
+    monkeypatch.setattr(os,'replace',lambda source,destination: saved.append(destination) or replace(source,destination))
+
+    # Changing channel invalidates the state until the checkpoint
+    remote.drive_shutter('Chambre','up')
+    remote.checkpoint()
+    assert len(saved) == 2
+    remote.drive_shutter('Chambre','down')
+    remote.checkpoint()
+    assert len(saved) == 2
+
+def test_state_saved_by_checkpoint_waits_for_remote_to_sleep(clock,simulator,tmp_path):
+    # Last presses may be missing from the state of a killed process
+    remote = restart(clock,simulator,tmp_path/'state.json')
+    remote.drive_shutter('Chambre','up')
+    remote.checkpoint()
+    remote.drive_shutter('Chambre','down')
+
+    start_date = clock.time()
+    remote = restart(clock,simulator,tmp_path/'state.json')
+    assert simulator.events == []
+    assert clock.time() - start_date >= Parameters.remote_sleep_timer_duration
+    remote.drive_shutter('Cuisine','up')
+    assert simulator.orders[-1][1:] == (2,'up')
+    assert simulator.errors == []
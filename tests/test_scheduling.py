@@ -0,0 +1,348 @@
+# =============================================================================
+# System imports
+import datetime
+import importlib
+import json
+import threading
+
+import pytest
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import Command,Dispatcher,Remote
+
+# =============================================================================
+# Classes
+class Puppeteer:
+    # Plugins side of the puppeteer, commands are queued on the dispatcher
+    # of the simulated remote
+    CMD_UP   = Remote.CMD_UP
+    CMD_DOWN = Remote.CMD_DOWN
+    CMD_STOP = Remote.CMD_STOP
+    CMD_INT  = Remote.CMD_INT
+
+    def __init__(self,clock,dispatcher):
+        self._clock = clock
+        self._dispatcher = dispatcher
+        # Dates and commands of each call queueing commands
+        self.dispatches = list()
+
+    def get_clock(self):
+        return self._clock
+
+    def notify_activity(self):
+        self._dispatcher.notify()
+
+    def emit_event(self,event,data=None):
+        pass
+
+    def drive_shutters(self,commands):
+        self.dispatches.append( (self._clock.time(),commands) )
+        return self._dispatcher.put( [ Command(Dispatcher.PRIORITY_DEFAULT,shutter,command) for (shutter,command) in commands ] )
+
+class LockingPuppeteer(Puppeteer):
+    # Takes a lock where the dispatcher takes its condition, a thread holding
+    # it asks the plugin for the next command date once the plugin schedules
+    # programs, as the dispatcher does when idle. Waiting for the lock gives
+    # up on deadlocks
+    def __init__(self,clock,dispatcher,plugin_name):
+        super().__init__(clock,dispatcher)
+        self.lock = threading.Lock()
+        self.scheduling = threading.Event()
+        self.deadlocked = False
+        self._plugin_name = plugin_name
+
+    def _acquire(self):
+        if not self.lock.acquire(timeout=2):
+            self.deadlocked = True
+            return False
+        return True
+
+    def notify_activity(self):
+        if self._acquire():
+            try:
+                super().notify_activity()
+            finally:
+                self.lock.release()
+
+    def emit_event(self,event,data=None):
+        if event == 'program_scheduled' and not self.scheduling.is_set():
+            self.scheduling.set()
+            # Let the dispatcher thread block on the plugin
+            threading.Event().wait(0.1)
+
+    def drive_shutters(self,commands):
+        if not self._acquire():
+            return list()
+        try:
+            return super().drive_shutters(commands)
+        finally:
+            self.lock.release()
+
+    def run_dispatcher(self,held):
+        plugin = importlib.import_module(self._plugin_name)
+        with self.lock:
+            held.set()
+            self.scheduling.wait(5)
+            plugin.get_next_command_date()
+
+# =============================================================================
+# Fixtures
+@pytest.fixture
+def start_scheduling(tmp_path,clock,dispatcher):
+    # Returns a function starting the plugin with programs, as the puppeteer
+    # would after a restart. Config files and journal are kept in tmp_path
+    (tmp_path/'location.json').write_text( json.dumps( { 'location': { 'latitude': 48.85, 'longitude': 2.35 } } ) )
+    running = list()
+
+    def start(programs,puppeteer=None):
+        if len(running):
+            running.pop().stop_plugin()
+        plugin = importlib.reload( importlib.import_module('plugins.scheduling') )
+        plugin.location_config_file = str(tmp_path/'location.json')
+        plugin.programs_config_file = str(tmp_path/'programs.json')
+        plugin.journal_file = str(tmp_path/'journal.json')
+        (tmp_path/'programs.json').write_text( json.dumps( { 'programs': programs } ) )
+        plugin.init_plugin( puppeteer or Puppeteer(clock,dispatcher) )
+        plugin.start_plugin()
+        running.append(plugin)
+        return plugin
+
+    yield start
+    if len(running):
+        running.pop().stop_plugin()
+
+# =============================================================================
+# Functions
+def make_program(name,date,catch_up=None,**fields):
+    program = { 'name'     : name
+              , 'enable'   : True
+              , 'days'     : [ 'mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun' ]
+              , 'trigger'  : { 'source': 'time', 'time': date.strftime('%H:%M') }
+              , 'action'   : 'close'
+              , 'shutters' : [ 'Chambre', ] }
+    if catch_up is not None:
+        program['catch_up'] = catch_up
+    program.update(fields)
+    return program
+
+# -----------------------------------------------------------------------------
+def test_missed_program_is_caught_up_once(clock,dispatcher,orders,start_scheduling,tmp_path):
+    # Program missed 5 minutes ago, while stopped, is run on start and
+    # journaled so that restarting doesn't run it again
+    date = clock.now().replace(second=0,microsecond=0) - datetime.timedelta(minutes=5)
+    programs = [ make_program('close',date,catch_up=30), ]
+
+    start_scheduling(programs)
+    dispatcher.run( until=clock.time() + 60 )
+    assert [ (channel,order) for (_,channel,order) in orders() ] == [ (7,'down') ]
+    assert json.loads( (tmp_path/'journal.json').read_text() ) == { 'close': date.timestamp() }
+
+    start_scheduling(programs)
+    dispatcher.run( until=clock.time() + 60 )
+    assert [ (channel,order) for (_,channel,order) in orders() ] == [ (7,'down') ]
+
+def test_missed_program_is_skipped_by_default(clock,dispatcher,orders,start_scheduling,tmp_path):
+    date = clock.now().replace(second=0,microsecond=0) - datetime.timedelta(minutes=5)
+    start_scheduling( [ make_program('close',date), ] )
+    dispatcher.run( until=clock.time() + 60 )
+    assert orders() == []
+    assert not (tmp_path/'journal.json').exists()
+
+def test_program_runs_on_time_and_is_journaled(clock,simulator,dispatcher,orders,start_scheduling,tmp_path):
+    date = clock.now().replace(second=0,microsecond=0) + datetime.timedelta(minutes=2)
+    start_scheduling( [ make_program('close',date), ] )
+    dispatcher.run( until=date.timestamp() + 60 )
+
+    assert [ (channel,order) for (_,channel,order) in orders() ] == [ (7,'down') ]
+    (order_date,_,_) = simulator.orders[0]
+    assert date.timestamp() <= order_date < date.timestamp() + 5
+    assert json.loads( (tmp_path/'journal.json').read_text() ) == { 'close': date.timestamp() }
+
+def test_rescheduling_does_not_hold_lock_while_dispatching(clock,dispatcher,start_scheduling):
+    # The dispatcher thread asks for the next command date while the plugin
+    # reschedules and catches up a missed program
+    date = clock.now().replace(second=0,microsecond=0) - datetime.timedelta(minutes=5)
+    puppeteer = LockingPuppeteer(clock,dispatcher,'plugins.scheduling')
+    plugin = start_scheduling( [ make_program('close',date,catch_up=30), ], puppeteer )
+    plugin.journal.clear()
+    puppeteer.scheduling.clear()
+
+    held = threading.Event()
+    threads = [ threading.Thread(target=puppeteer.run_dispatcher,args=(held,),daemon=True)
+              , threading.Thread(target=lambda: held.wait(5) and plugin.schedule(),daemon=True) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert not any( thread.is_alive() for thread in threads )
+    assert not puppeteer.deadlocked
+    assert [ command.shutter for command in dispatcher.get_etas() ] == [ 'Chambre', ]
+
+def test_editing_program_only_reschedules_it(clock,start_scheduling):
+    # Timers of programs left unchanged are kept, all of them on the clock
+    date = clock.now().replace(second=0,microsecond=0) + datetime.timedelta(minutes=2)
+    programs = [ make_program('program {}'.format(index),date + datetime.timedelta(minutes=index)) for index in range(50) ]
+    thread_count = threading.active_count()
+    plugin = start_scheduling(programs)
+    timers = { name: [ timer for (_,timer,_) in entries ] for (name,entries) in plugin.scheduled_programs.items() }
+    assert threading.active_count() == thread_count
+    assert len( plugin.get_scheduled_programs() ) == 50 * plugin.calendar_days
+    timer_count = clock.get_timer_count()
+
+    edited = dict(programs[1],action='open')
+    plugin.set_programs( [ programs[0], edited ] + programs[2:] )
+    edited_timers = { name: [ timer for (_,timer,_) in entries ] for (name,entries) in plugin.scheduled_programs.items() }
+    assert [ name for name in timers if edited_timers[name] != timers[name] ] == [ 'program 1', ]
+    assert all( timer.cancelled for timer in timers['program 1'] )
+    assert clock.get_timer_count() == timer_count
+
+def test_reloading_programs_file_only_reschedules_changed_programs(clock,start_scheduling,tmp_path):
+    date = clock.now().replace(second=0,microsecond=0) + datetime.timedelta(minutes=2)
+    programs = [ make_program('close',date), make_program('open',date,action='open') ]
+    plugin = start_scheduling(programs)
+    get_timers = lambda: { name: [ timer for (_,timer,_) in entries ] for (name,entries) in plugin.scheduled_programs.items() }
+    timers = get_timers()
+
+    # Programs file saved unchanged, then with one program changed
+    (tmp_path/'programs.json').write_text( json.dumps( { 'programs': programs }, indent=4 ) )
+    plugin.reload_programs()
+    assert get_timers() == timers
+
+    programs = [ programs[0], make_program('open',date + datetime.timedelta(minutes=1),action='open') ]
+    (tmp_path/'programs.json').write_text( json.dumps( { 'programs': programs } ) )
+    plugin.reload_programs()
+    reloaded_timers = get_timers()
+    assert reloaded_timers['close'] == timers['close']
+    assert reloaded_timers['open'] != timers['open']
+    assert plugin.get_programs() == programs
+
+# -----------------------------------------------------------------------------
+# Batches
+def test_programs_firing_together_are_dispatched_at_once(clock,dispatcher,orders,start_scheduling):
+    date = clock.now().replace(second=0,microsecond=0) + datetime.timedelta(minutes=2)
+    puppeteer = Puppeteer(clock,dispatcher)
+    start_scheduling( [ make_program('bedroom',date), make_program('kitchen',date,shutters=[ 'Cuisine', ]) ], puppeteer )
+    dispatcher.run( until=date.timestamp() + 120 )
+
+    assert puppeteer.dispatches == [ ( date.timestamp(), [ ('Chambre','down'), ('Cuisine','down') ] ) ]
+    assert sorted( (channel,order) for (_,channel,order) in orders() ) == [ (2,'down'), (7,'down') ]
+
+@pytest.mark.parametrize('priorities,order',[ ( (1,0), 'down' ), ( (0,1), 'up' ), ( (0,0), 'up' ) ])
+def test_conflicting_programs_are_resolved_by_priority(clock,dispatcher,orders,start_scheduling,priorities,order):
+    # On equal priorities, the program listed last drives the shutter
+    date = clock.now().replace(second=0,microsecond=0) + datetime.timedelta(minutes=2)
+    puppeteer = Puppeteer(clock,dispatcher)
+    start_scheduling( [ make_program('close',date,priority=priorities[0])
+                      , make_program('open',date,priority=priorities[1],action='open') ], puppeteer )
+    dispatcher.run( until=date.timestamp() + 120 )
+
+    assert [ commands for (_,commands) in puppeteer.dispatches ] == [ [ ('Chambre',order) ] ]
+    assert [ (channel,order) for (_,channel,order) in orders() ] == [ (7,order) ]
+
+def test_spread_and_jitter_are_bounded(clock,dispatcher,start_scheduling):
+    # Shutters are driven in the order they are listed, within spread and
+    # jitter of the program date
+    date = clock.now().replace(second=0,microsecond=0) + datetime.timedelta(minutes=2)
+    puppeteer = Puppeteer(clock,dispatcher)
+    shutters = [ 'Chambre', 'Cuisine', 'Salon 1' ]
+    start_scheduling( [ make_program('close',date,shutters=shutters,spread=60,jitter=10), ], puppeteer )
+    dispatcher.run( until=date.timestamp() + 300 )
+
+    assert [ commands for (_,commands) in puppeteer.dispatches ] == [ [ (shutter,'down') ] for shutter in shutters ]
+    dates = [ dispatch_date - date.timestamp() for (dispatch_date,_) in puppeteer.dispatches ]
+    assert 0 <= dates[0] <= 10
+    assert [ later - earlier for (earlier,later) in zip(dates,dates[1:]) ] == pytest.approx( [ 30, 30 ] )
+
+def test_program_history_is_recorded(clock,dispatcher,start_scheduling):
+    date = clock.now().replace(second=0,microsecond=0) + datetime.timedelta(minutes=2)
+    plugin = start_scheduling( [ make_program('close',date,priority=1)
+                               , make_program('open',date,action='open',shutters=[ 'Chambre', 'Cuisine' ]) ] )
+    dispatcher.run( until=date.timestamp() + 120 )
+
+    history = { record['name']: record for record in plugin.get_program_history() }
+    assert history.keys() == { 'close', 'open' }
+    assert all( record['date'] == date.timestamp() for record in history.values() )
+    assert [ (entry['shutter'],entry['command'],entry['status']) for entry in history['close']['commands'] ] \
+        == [ ('Chambre','down',Command.STATUS_EXECUTED) ]
+    assert [ (entry['shutter'],entry['driver'],entry['status']) for entry in history['open']['commands'] ] \
+        == [ ('Chambre','close','overridden'), ('Cuisine','open',Command.STATUS_EXECUTED) ]
+    assert all( 0 <= entry['skew'] < 30 for record in history.values()
+                                        for entry in record['commands'] if entry['skew'] is not None )
+
+# -----------------------------------------------------------------------------
+# Trigger calendar
+CALENDAR_PROGRAMS = [ { 'name': 'morning', 'enable': True,  'days': [ 'mon', 'tue', 'wed', 'thu', 'fri' ]
+                      , 'trigger': { 'source': 'time', 'time': '07:30' }, 'action': 'open', 'shutters': [ 'Chambre', ] }
+                    , { 'name': 'sunset',  'enable': True,  'days': [ 'mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun' ]
+                      , 'trigger': { 'source': 'sun', 'event': 'sunset', 'offset': 15 }, 'action': 'close', 'shutters': [ 'Chambre', ] }
+                    , { 'name': 'disabled', 'enable': False, 'days': [ 'sat', 'sun' ]
+                      , 'trigger': { 'source': 'time', 'time': '10:00' }, 'action': 'open', 'shutters': [ 'Chambre', ] } ]
+
+def make_calendar(first_day,days=7):
+    from plugins.scheduling.triggers import TriggerCalendar
+
+    calendar = TriggerCalendar((48.85,2.35),days)
+    calendar.set_window(first_day)
+    for program in CALENDAR_PROGRAMS:
+        calendar.set_program(program)
+    return calendar
+
+def test_moving_calendar_window_computes_new_day_only(monkeypatch):
+    from plugins.scheduling import triggers
+
+    calendar = make_calendar(datetime.date(2024,3,1))
+    days = list()
+    get_program_date = triggers.get_program_date
+    monkeypatch.setattr(triggers,'get_program_date',lambda trigger,day,location: days.append(day) or get_program_date(trigger,day,location))
+
+    # Friday 8th enters the window, its morning and sunset programs fire
+    added = calendar.set_window(datetime.date(2024,3,2))
+    assert set(days) == { datetime.date(2024,3,8), }
+    assert [ ( date.date(), program['name'] ) for (date,program) in added ] \
+        == [ ( datetime.date(2024,3,8), 'morning' ), ( datetime.date(2024,3,8), 'sunset' ) ]
+    assert [ date.date() for date in calendar.get_program_dates('sunset') ] \
+        == [ datetime.date(2024,3,2) + datetime.timedelta(days=index) for index in range(7) ]
+
+@pytest.mark.parametrize('start_day,end_day',[ ( datetime.date(2024,3,2), datetime.date(2024,3,6) )
+                                             , ( datetime.date(2024,2,27), datetime.date(2024,3,4) )
+                                             , ( datetime.date(2024,3,5), datetime.date(2024,3,20) ) ])
+def test_calendar_triggers_match_full_recompute(start_day,end_day):
+    # Triggers within and out of the window, after it moved, are the same as
+    # those of a calendar computed from scratch over the whole range
+    calendar = make_calendar(datetime.date(2024,2,28))
+    calendar.set_window(datetime.date(2024,3,1))
+    start = datetime.datetime.combine(start_day,datetime.time(12)).astimezone()
+    end   = datetime.datetime.combine(end_day,datetime.time(12)).astimezone()
+
+    full = make_calendar( start_day - datetime.timedelta(days=1), ( end_day - start_day ).days + 3 )
+    expected = [ (date,program['name']) for program in CALENDAR_PROGRAMS
+                                        for date in full.get_program_dates(program['name']) if start <= date < end ]
+    expected.sort()
+    assert [ (date,program['name']) for (date,program) in calendar.get_triggers(start,end) ] == expected
+
+# -----------------------------------------------------------------------------
+# Sun tables
+@pytest.mark.parametrize('location',[ (48.85,2.35), (-33.87,151.21), (37.77,-122.42) ])
+def test_sun_table_matches_astral(location):
+    # At mid latitudes, events of every day are within 30 s of astral's
+    pytest.importorskip('numpy')
+    from plugins.scheduling.suntable import SunTable
+    from plugins.scheduling.triggers import get_astral_sun_events
+
+    table = SunTable.build(2024,location)
+    for day in ( datetime.date(2024,1,1) + datetime.timedelta(days=days) for days in range(366) ):
+        events = table.get_events(day)
+        astral_events = get_astral_sun_events(day,location)
+        assert events.keys() == astral_events.keys()
+        for (event,date) in events.items():
+            assert abs( ( date - astral_events[event] ).total_seconds() ) < 30
+
+def test_sun_table_is_saved_and_rebuilt_for_another_location(tmp_path):
+    pytest.importorskip('numpy')
+    from plugins.scheduling.suntable import SunTable
+
+    table = SunTable.get(str(tmp_path),2024,(48.85,2.35))
+    assert SunTable.load(SunTable.get_file(str(tmp_path),2024)).location == (48.85,2.35)
+    assert SunTable.get(str(tmp_path),2024,(48.85,2.35)).get_events(datetime.date(2024,6,21)) == table.get_events(datetime.date(2024,6,21))
+    assert SunTable.get(str(tmp_path),2024,(43.6,1.44)).location == (43.6,1.44)
@@ -0,0 +1,82 @@
+# =============================================================================
+# System imports
+import pytest
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import Chronosoft8Simulator,Parameters
+from conftest import START_DATE
+
+# =============================================================================
+# Fixtures
+@pytest.fixture
+def awake(clock,simulator):
+    # Simulator powered up and showing the main screen
+    simulator.on_output(clock.time(),'Power',True)
+    clock.sleep(1)
+    press(clock,simulator,'Validate')
+    press(clock,simulator,'Return')
+    assert simulator.screen == Chronosoft8Simulator.SCREEN_MAIN
+    return simulator
+
+# =============================================================================
+# Functions
+def press(clock,simulator,*buttons,duration=0.1):
+    # Buttons are pressed and released together, then left released
+    for button in buttons:
+        simulator.on_output(clock.time(),button,True)
+    clock.sleep(duration)
+    for button in buttons:
+        simulator.on_output(clock.time(),button,False)
+    clock.sleep(0.1)
+
+def test_first_press_only_wakes_remote_up(clock,simulator):
+    simulator.on_output(clock.time(),'Power',True)
+    assert simulator.screen == Chronosoft8Simulator.SCREEN_CLOCK
+
+    clock.sleep(Parameters.remote_sleep_timer_duration + 1)
+    press(clock,simulator,'Return')
+    assert simulator.screen == Chronosoft8Simulator.SCREEN_CLOCK
+    assert [ description for (_,description) in simulator.errors ] == [ 'press return while sleeping', ]
+
+    press(clock,simulator,'Return')
+    assert simulator.screen == Chronosoft8Simulator.SCREEN_MAIN
+
+def test_orders_are_sent_on_current_channel(clock,awake):
+    awake.enabled_channels = [ 1, 3, 5 ]
+    press(clock,awake,'Up')
+    press(clock,awake,'Return')
+    press(clock,awake,'Stop','Down')
+    press(clock,awake,'Return')
+    press(clock,awake,'Return')
+    press(clock,awake,'Down')
+
+    assert [ order[1:] for order in awake.orders ] == [ (1,'up'), (3,'int'), (1,'down') ]
+    assert awake.orders[0][0] == pytest.approx(START_DATE + 1.4,abs=1e-6)
+    assert awake.errors == []
+
+def test_unexpected_press_is_an_error(clock,awake):
+    press(clock,awake,'Up','Down')
+    assert awake.orders == []
+    assert [ description for (_,description) in awake.errors ] == [ 'unexpected down+up press on main screen', ]
+
+def test_channels_are_configured_in_menu(clock,awake):
+    # Channel 1 can't be disabled, the menu is left after channel 8
+    press(clock,awake,'Validate',duration=Chronosoft8Simulator.LONG_PRESS_DURATION)
+    assert awake.screen == Chronosoft8Simulator.SCREEN_CHANNELS
+    for channel in range(1,9):
+        if channel in ( 1, 3, 5 ):
+            press(clock,awake,'Down' if channel == 1 else 'Up')
+        press(clock,awake,'Validate')
+
+    assert awake.screen == Chronosoft8Simulator.SCREEN_MAIN
+    assert awake.get_state()['enabled_channels'] == [ 1, 3, 5 ]
+    assert awake.current_channel == 1
+    assert awake.errors == []
+
+def test_power_off_turns_screen_off(clock,awake):
+    awake.on_output(clock.time(),'Power',False)
+    press(clock,awake,'Up')
+    assert awake.screen == Chronosoft8Simulator.SCREEN_OFF
+    assert awake.orders == []
+    assert awake.errors == []
@@ -0,0 +1,90 @@
+# =============================================================================
+# System imports
+import pytest
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import PressTimer
+
+# =============================================================================
+# Globals
+LAG = 0.005
+PRESS_DURATION = 0.1
+RELEASE_DURATION = 0.1
+
+# =============================================================================
+# Classes
+class Button:
+    # Records its edges (monotonic date,value), setting it takes a while
+    def __init__(self,clock):
+        self._clock = clock
+        self.edges = list()
+
+    def set(self,value):
+        self._clock.sleep(LAG)
+        self.edges.append( (self._clock.monotonic(),value) )
+
+# =============================================================================
+# Functions
+def approx(value):
+    # Virtual dates are large, their differences are rounded
+    return pytest.approx(value,abs=1e-5)
+
+def press(timer,button,count,delay=0.0):
+    # Presses button count times, the caller being delayed before each press
+    for _ in range(count):
+        timer._clock.sleep(delay)
+        timer.press( [ button, ], PRESS_DURATION, RELEASE_DURATION )
+
+def test_edges_do_not_drift_over_presses(clock):
+    # Edge lags and delays between presses are caught up, as long as presses
+    # aren't shortened below their minimum duration
+    timer = PressTimer(clock)
+    button = Button(clock)
+    start = clock.monotonic()
+    press(timer,button,10,0.01)
+
+    period = PRESS_DURATION + RELEASE_DURATION
+    assert clock.monotonic() - start == approx( 0.01 + 10 * period )
+    presses = [ date - start for (date,value) in button.edges if value ]
+    releases = [ date - start for (date,value) in button.edges if not value ]
+    assert presses[1:] == approx( [ 0.01 + index * period + 0.01 + LAG for index in range(1,10) ] )
+    assert releases == approx( [ 0.01 + index * period + PRESS_DURATION + LAG for index in range(10) ] )
+
+def test_durations_are_not_shortened_too_much(clock):
+    # Presses late by more than the drift tolerance start a new chain
+    timer = PressTimer(clock)
+    button = Button(clock)
+    press(timer,button,2)
+    clock.sleep(1)
+    press(timer,button,1)
+
+    (press_date,_) = button.edges[-2]
+    (release_date,_) = button.edges[-1]
+    assert release_date - press_date == approx(PRESS_DURATION)
+
+def test_late_presses_are_counted(clock):
+    timer = PressTimer(clock)
+    button = Button(clock)
+    press(timer,button,3)
+    press(timer,button,2,0.03)
+
+    metrics = timer.get_metrics()
+    bounds = metrics['press_jitter']['bounds']
+    counts = dict( zip( bounds + [ None, ], metrics['press_jitter']['counts'] ) )
+    assert metrics['press_jitter']['count'] == 5
+    assert counts[0.01] == 3
+    assert counts[0.05] == 2
+    assert metrics['press_jitter']['max'] == approx(0.03 + LAG)
+    assert metrics['release_jitter']['count'] == 5
+    assert metrics['preempted_count'] == 0
+    assert timer.last_jitter == approx( (0.03 + LAG,LAG) )
+
+def test_wall_clock_jump_does_not_stretch_presses(clock):
+    timer = PressTimer(clock)
+    button = Button(clock)
+    press(timer,button,1)
+    clock.jump(-3600)
+    start = clock.monotonic()
+    press(timer,button,1)
+    assert clock.monotonic() - start == approx( PRESS_DURATION + RELEASE_DURATION )
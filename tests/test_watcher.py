@@ -0,0 +1,70 @@
+# =============================================================================
+# System imports
+import json
+import os
+import threading
+
+import pytest
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer.watcher import ConfigWatcher
+
+# =============================================================================
+# Fixtures
+@pytest.fixture
+def watch(tmp_path):
+    # Returns a function watching a config file of tmp_path, its reloads are
+    # counted and signaled
+    watchers = list()
+
+    def watch(inotify=True):
+        file = tmp_path/'programs.json'
+        file.write_text( json.dumps( { 'programs': list() } ) )
+        reloads = list()
+        reloaded = threading.Event()
+        watcher = ConfigWatcher(poll_period=0.05,debounce=0.1)
+        if not inotify:
+            watcher._init_inotify = lambda: None
+        watcher.add(str(file),lambda: reloads.append(file.read_text()) or reloaded.set())
+        watcher.start()
+        watchers.append(watcher)
+        return (file,reloads,reloaded)
+
+    yield watch
+    for watcher in watchers:
+        watcher.stop()
+
+# =============================================================================
+# Functions
+def replace(file,content):
+    # Written to a temporary file then moved over file, as editors do
+    tmp_file = str(file) + '.tmp'
+    with open(tmp_file,'w') as f:
+        f.write(content)
+    os.replace(tmp_file,str(file))
+
+def test_atomic_replace_reloads_once(watch):
+    inotify = ConfigWatcher()._init_inotify()
+    if inotify is None:
+        pytest.skip('inotify is not available')
+    os.close(inotify[0])
+    (file,reloads,reloaded) = watch()
+    content = json.dumps( { 'programs': [ { 'name': 'close' } ] } )
+    replace(file,content)
+    assert reloaded.wait(5)
+
+    # Events of the temporary file and the move are debounced
+    threading.Event().wait(0.3)
+    assert reloads == [ content ]
+
+def test_polling_reloads_changed_file(watch):
+    (file,reloads,reloaded) = watch(inotify=False)
+    threading.Event().wait(0.2)
+    assert reloads == []
+
+    content = json.dumps( { 'programs': [ { 'name': 'close' } ] } )
+    replace(file,content)
+    assert reloaded.wait(5)
+    threading.Event().wait(0.2)
+    assert reloads == [ content ]
@@ -0,0 +1,93 @@
+# =============================================================================
+# System imports
+import asyncio
+import concurrent.futures
+import json
+import threading
+
+import pytest
+
+# =============================================================================
+# Local imports
+websocket_plugin = pytest.importorskip('plugins.websocket')
+
+# =============================================================================
+# Classes
+class Handle:
+    def __init__(self,shutter):
+        self.shutter = shutter
+
+    def get_status(self):
+        return 'pending'
+
+class Puppeteer:
+    # Records drive calls, moves take a while to be queued
+    def __init__(self):
+        self.calls = list()
+
+    def notify_activity(self):
+        pass
+
+    def drive_shutter(self,shutter,command):
+        if command != 'stop':
+            threading.Event().wait(0.2)
+        self.calls.append( (shutter,command) )
+        return Handle(shutter)
+
+    def get_eta(self,handle):
+        return 0
+
+    def get_shutters(self):
+        threading.Event().wait(0.2)
+        return list()
+
+class WebSocket:
+    # Connection sending messages, then waiting for replies
+    remote_address = ( '127.0.0.1', 4242 )
+
+    def __init__(self,messages):
+        self.messages = messages
+        self.replies = list()
+        self._replied = None
+
+    async def send(self,message):
+        self.replies.append( json.loads(message)['cs8p'] )
+        if len(self.replies) == len(self.messages):
+            self._replied.set()
+
+    async def _receive(self):
+        self._replied = asyncio.Event()
+        for message in self.messages:
+            yield json.dumps( { 'cs8p': message } )
+        await asyncio.wait_for(self._replied.wait(),5)
+
+    def __aiter__(self):
+        return self._receive()
+
+# =============================================================================
+# Fixtures
+@pytest.fixture
+def puppeteer(monkeypatch):
+    puppeteer = Puppeteer()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    monkeypatch.setattr(websocket_plugin,'cs8p',puppeteer)
+    monkeypatch.setattr(websocket_plugin,'executor',executor)
+    yield puppeteer
+    executor.shutdown()
+
+# =============================================================================
+# Functions
+def drive(request_id,shutter,command):
+    return { 'id': request_id, 'command': 'drive_shutter', 'args': { 'shutter': shutter, 'command': command } }
+
+def test_pipelined_drive_commands_are_queued_in_order(puppeteer):
+    websocket = WebSocket( [ drive(1,'Chambre','down'), drive(2,'Chambre','stop'), drive(3,'Cuisine','up') ] )
+    asyncio.run( websocket_plugin.on_client_connected(websocket,'/') )
+    assert puppeteer.calls == [ ('Chambre','down'), ('Chambre','stop'), ('Cuisine','up') ]
+    assert sorted( reply['id'] for reply in websocket.replies ) == [ 1, 2, 3 ]
+
+def test_read_requests_do_not_wait_for_drive_commands(puppeteer):
+    # Replies are tagged with their request id as they come out of order
+    websocket = WebSocket( [ { 'id': 1, 'command': 'get_shutters' }, drive(2,'Chambre','stop') ] )
+    asyncio.run( websocket_plugin.on_client_connected(websocket,'/') )
+    assert [ reply['id'] for reply in websocket.replies ] == [ 2, 1 ]
@@ -0,0 +1,72 @@
+# =============================================================================
+# System imports
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+# =============================================================================
+# Local imports
+from chronosoft8puppeteer import GPIO,GPIOWorker
+
+# =============================================================================
+# Fixtures
+@pytest.fixture
+def worker():
+    # Worker process recording its GPIOs, with a button set up
+    worker = GPIOWorker('recording',heartbeat_period=0.05,heartbeat_timeout=2.0)
+    worker.button = GPIO('Up',11,GPIO.OUT,0,False,backend=worker)
+    yield worker
+    worker.stop()
+
+# =============================================================================
+# Functions
+def wait_until(predicate,timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def get_worker_metrics(worker):
+    return worker.get_metrics()['worker']
+
+def test_press_is_timed_by_worker(worker):
+    (press_date,release_date) = worker.press( [ worker.button, ], 0.1, 0.05 )
+    assert 0.1 <= release_date - press_date < 0.2
+    metrics = worker.get_metrics()
+    assert metrics['press_jitter']['count'] == 1
+    assert metrics['release_jitter']['count'] == 1
+    assert get_worker_metrics(worker)['pid'] == worker._process.pid
+
+def test_dead_worker_is_respawned(worker):
+    pid = get_worker_metrics(worker)['pid']
+    os.kill(pid,signal.SIGKILL)
+    assert wait_until( lambda: get_worker_metrics(worker)['pid'] not in ( None, pid ) )
+    assert get_worker_metrics(worker)['respawn_count'] == 1
+
+    # GPIOs are set up again by the new worker
+    worker.press( [ worker.button, ], 0.1, 0.05 )
+    assert worker.get_metrics()['press_jitter']['count'] == 1
+
+def test_press_of_hung_worker_is_sent_again(worker):
+    # Worker stops sending heartbeats before getting the press, it is killed
+    # once they timed out and the press sent to the new worker
+    pid = get_worker_metrics(worker)['pid']
+    os.kill(pid,signal.SIGSTOP)
+    results = list()
+    thread = threading.Thread(target=lambda: results.append( worker.press( [ worker.button, ], 0.1, 0.05 ) ),daemon=True)
+    start = time.monotonic()
+    thread.start()
+    thread.join(15)
+
+    assert len(results) == 1
+    assert time.monotonic() - start >= worker.get_options()['heartbeat_timeout']
+    metrics = get_worker_metrics(worker)
+    assert metrics['pid'] != pid
+    assert metrics['respawn_count'] == 1
+    assert metrics['retry_count'] == 1
+    assert worker.get_metrics()['press_jitter']['count'] == 1